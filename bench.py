@@ -0,0 +1,1509 @@
+"""Бенчмарки бота без сети.
+
+Запуск:  python bench.py keyboards
+         python bench.py cache [--users 100000] [-n 200000] [--cache-sizes 1000,10000,100000]
+         python bench.py callbacks
+         python bench.py ids
+         python bench.py load [--users 1000] [--digest] [--save base.json | --gate base.json]
+         python bench.py metrics [--users 200]
+         python bench.py outbox [--users 200] [--scale 50] [--flood-p 0.02]
+         python bench.py shards [--users 300] [--workers 1,2,4]
+         python bench.py verify [--users 300]
+         python bench.py deposits [--users 300]
+         python bench.py dedup [--users 300] [--proofs 100000]
+         python bench.py rates [--users 300]
+         python bench.py render [--users 300]
+         python bench.py throttle [--users 300]
+         python bench.py sessions [--state-sizes 10000,100000,1000000]
+         python bench.py startup [--state-sizes 0,100000,1000000]
+         python bench.py webhook [--updates recorded.jsonl]
+Токен подставляется фейковый, state.json и прочие файлы пишутся во временную папку,
+вместо Telegram API — FakeTelegramSession.
+"""
+import argparse
+import asyncio
+import itertools
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+import tracemalloc
+from collections import defaultdict
+from datetime import datetime
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+os.environ.setdefault("BOT_TOKEN", "123456:BENCH")
+os.environ.setdefault("ADMIN_ID", "1")
+os.environ.setdefault("WEBHOOK_SECRET", "bench-secret")
+# сброс нагрузки мерил бы сам себя: load гоняет тысячи апдейтов разом; throttle включает его сам
+os.environ.setdefault("THROTTLE_INFLIGHT", "0")
+os.environ.setdefault("THROTTLE_LAG_MS", "0")
+os.chdir(tempfile.mkdtemp(prefix="bot-bench-"))
+sys.path.insert(0, HERE)
+
+import bot  # noqa: E402
+from aiogram import BaseMiddleware, Bot  # noqa: E402
+from aiogram.client.session.base import BaseSession  # noqa: E402
+from aiogram.exceptions import TelegramRetryAfter, TelegramServerError  # noqa: E402
+from aiogram.methods import AnswerCallbackQuery, EditMessageText, SendDocument, SendMessage, SendPhoto  # noqa: E402
+from aiogram.types import CallbackQuery, Chat, Message, Update  # noqa: E402
+from aiogram.utils.keyboard import InlineKeyboardBuilder  # noqa: E402
+from aiohttp import ClientSession, web  # noqa: E402
+
+
+def measure(fn, n: int = 2000) -> tuple[float, int]:
+    """(мкс на вызов, пик выделенной памяти на вызов в байтах)"""
+    fn()
+    t0 = time.perf_counter()
+    for _ in range(n):
+        fn()
+    us = (time.perf_counter() - t0) / n * 1e6
+
+    tracemalloc.start()
+    peaks = []
+    for _ in range(50):
+        base, _ = tracemalloc.get_traced_memory()
+        tracemalloc.reset_peak()
+        fn()
+        peaks.append(tracemalloc.get_traced_memory()[1] - base)
+    tracemalloc.stop()
+    return us, sorted(peaks)[len(peaks) // 2]
+
+
+def print_table(header: tuple, rows: list[tuple]):
+    widths = [max(len(str(x)) for x in col) for col in zip(header, *rows)]
+    for row in (header, *rows):
+        print("  ".join(str(x).rjust(w) for x, w in zip(row, widths)))
+
+
+def percentile(values: list[float], p: float) -> float:
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p))]
+
+
+# =====================
+# FAKE TELEGRAM
+# =====================
+class FakeTelegramSession(BaseSession):
+    """Отвечает на любые методы Bot API без сети: send* -> Message, остальное -> True."""
+
+    def __init__(self):
+        super().__init__()
+        self.calls: list = []
+        self._ids = itertools.count(1)
+
+    async def make_request(self, bot, method, timeout=None):
+        self.calls.append(method)
+        if isinstance(method, (SendMessage, SendPhoto, SendDocument)):
+            return Message(message_id=next(self._ids), date=datetime.now(),
+                           chat=Chat(id=method.chat_id, type="private"))
+        return True
+
+    async def stream_content(self, *args, **kwargs):
+        yield b""
+
+    async def close(self):
+        pass
+
+
+# =====================
+# UPDATES
+# =====================
+_update_ids = itertools.count(1)
+
+
+def _user(uid: int) -> dict:
+    return {"id": uid, "is_bot": False, "first_name": f"u{uid}", "username": f"user{uid}"}
+
+
+def cb_update(uid: int, data: str) -> dict:
+    n = next(_update_ids)
+    return {"update_id": n, "callback_query": {
+        "id": str(n), "from": _user(uid), "chat_instance": str(uid), "data": data,
+        "message": {"message_id": 1, "date": int(time.time()), "chat": {"id": uid, "type": "private"},
+                    "from": {"id": 42, "is_bot": True, "first_name": "bot"}, "text": "menu"}}}
+
+
+def msg_update(uid: int, text: str | None = None, photo: bool = False) -> dict:
+    n = next(_update_ids)
+    msg = {"message_id": n, "date": int(time.time()), "chat": {"id": uid, "type": "private"}, "from": _user(uid)}
+    if text is not None:
+        msg["text"] = text
+    if photo:
+        msg["photo"] = [{"file_id": f"photo{n}", "file_unique_id": f"uniq{n}", "width": 10, "height": 10}]
+    return {"update_id": n, "message": msg}
+
+
+def flow_sub_crypto(uid: int) -> list[dict]:
+    return [cb_update(uid, "lang:ru"), cb_update(uid, "menu:buy_sub"), cb_update(uid, "sub:3"),
+            cb_update(uid, "pay:crypto"), cb_update(uid, "coin:USDT_TRC20"), msg_update(uid, f"txid{uid:012d}")]
+
+
+def flow_topup_sbp(uid: int) -> list[dict]:
+    return [cb_update(uid, "lang:en"), cb_update(uid, "menu:topup"), cb_update(uid, "topup:20"),
+            msg_update(uid, f"user{uid}@example.com"), cb_update(uid, "pay:sbp"), msg_update(uid, photo=True)]
+
+
+# =====================
+# KEYBOARDS
+# =====================
+def _legacy_kb_admin_decision(order_id: str):
+    kb = InlineKeyboardBuilder()
+    kb.button(text="✅ Подтвердить", callback_data=f"adm:approve:{order_id}")
+    kb.button(text="❌ Отклонить", callback_data=f"adm:reject:{order_id}")
+    kb.adjust(2)
+    return kb.as_markup()
+
+
+def bench_keyboards(args):
+    names = ["main", "support", "cancel_payment", "sub_months", "topup_amounts", "pay_method", "crypto_coin"]
+    rows = []
+    for name in names:
+        for lang in bot.LANGS:
+            build = getattr(bot, f"_build_kb_{name}")
+            cached = getattr(bot, f"kb_{name}")
+            b_us, b_mem = measure(lambda: build(lang), args.n)
+            c_us, c_mem = measure(lambda: cached(lang), args.n)
+            rows.append((f"kb_{name}({lang})", f"{b_us:.1f}", f"{c_us:.2f}", b_mem, c_mem))
+    order_id = bot.make_order_id()
+    b_us, b_mem = measure(lambda: _legacy_kb_admin_decision(order_id), args.n)
+    c_us, c_mem = measure(lambda: bot.kb_admin_decision(order_id), args.n)
+    rows.append(("kb_admin_decision", f"{b_us:.1f}", f"{c_us:.2f}", b_mem, c_mem))
+    print_table(("keyboard", "builder µs", "cached µs", "builder B", "cached B"), rows)
+
+
+# =====================
+# ORDER IDS
+# =====================
+def bench_ids(args):
+    legacy = lambda uid: f"ORD-{uid}-{int(datetime.now().timestamp())}"  # noqa: E731  (как было)
+    rows = []
+    for name, gen in (("legacy ORD-uid-ts", lambda: legacy(1234567890)), ("snowflake b32", bot.make_order_id)):
+        us, mem = measure(gen, args.n)
+        burst = [gen() for _ in range(args.n)]
+        oid = burst[-1]
+        worst = max(len(f"{p}{oid}".encode()) for p in ("adm:approve:", "adm:reject:", "dg:proof:", "orders:"))
+        rows.append((name, oid, len(oid), worst, args.n - len(set(burst)), burst == sorted(burst), f"{us:.2f}"))
+    print_table(("scheme", "example", "len", "max callback B (of 64)", f"collisions in {args.n} burst",
+                 "sorted = created", "µs/id"), rows)
+
+
+# =====================
+# CALLBACK DISPATCH
+# =====================
+def _legacy_filter_dispatcher():
+    """Старая схема: отдельный хендлер на каждый F.data-фильтр, проверяются по порядку."""
+    from aiogram import Dispatcher, F
+
+    dp = Dispatcher()
+
+    async def noop(cb):
+        cb.data.split(":", 1)
+
+    for flt in (F.data.startswith("orders:"), F.data == "nav:home", F.data == "nav:cancel",
+                F.data == "nav:back_prev", F.data == "nav:back_pay", F.data.startswith("lang:"),
+                F.data.startswith("menu:"), F.data.startswith("sub:"), F.data.startswith("topup:"),
+                F.data.startswith("pay:"), F.data.startswith("coin:"), F.data.startswith("adm:")):
+        dp.callback_query.register(noop, flt)
+    return dp
+
+
+def _router_dispatcher():
+    """Новая схема: один хендлер, разбор callback_data и поиск по bot.CALLBACK_ROUTES."""
+    from aiogram import Dispatcher
+
+    dp = Dispatcher()
+
+    async def route(cb):
+        bot.resolve_callback(cb.data)
+
+    dp.callback_query.register(route)
+    return dp
+
+
+async def _bench_callbacks(args):
+    bot.bot.session = FakeTelegramSession()
+    legacy, router = _legacy_filter_dispatcher(), _router_dispatcher()
+    rows = []
+    for data in ("orders:ORD-1-1", "nav:home", "lang:en", "sub:3", "pay:crypto", "coin:BTC", "adm:approve:ORD-1-1"):
+        updates = [Update.model_validate(cb_update(100, data), context={"bot": bot.bot}) for _ in range(args.n)]
+        res = []
+        for dp in (legacy, router):
+            await dp.feed_update(bot.bot, updates[0])
+            t0 = time.perf_counter()
+            for upd in updates:
+                await dp.feed_update(bot.bot, upd)
+            res.append((time.perf_counter() - t0) / args.n * 1e6)
+        rows.append((data, f"{res[0]:.1f}", f"{res[1]:.1f}", f"{res[0] / res[1]:.2f}x"))
+    print_table(("callback_data", "filter chain µs/upd", "router µs/upd", "speedup"), rows)
+
+    t0 = time.perf_counter()
+    for _ in range(args.n):
+        bot.resolve_callback("adm:approve:ORD-1-1")
+    print(f"resolve_callback alone: {(time.perf_counter() - t0) / args.n * 1e6:.2f} µs")
+
+
+def bench_callbacks(args):
+    asyncio.run(_bench_callbacks(args))
+
+
+# =====================
+# LOAD TEST (real Dispatcher)
+# =====================
+class HandlerTimer(BaseMiddleware):
+    """Inner-middleware только для бенча: время каждого хендлера бота по имени функции."""
+
+    def __init__(self):
+        self.samples: dict[str, list[float]] = defaultdict(list)
+
+    async def __call__(self, handler, event, data):
+        if isinstance(event, CallbackQuery):
+            # маршрут уже разобран CallbackRouteMiddleware бота — он зарегистрирован раньше
+            target, _ = data["callback_route"]
+            name = target.__name__ if target else "unhandled"
+        else:
+            name = data["handler"].callback.__name__
+        t0 = time.perf_counter()
+        try:
+            return await handler(event, data)
+        finally:
+            self.samples[name].append(time.perf_counter() - t0)
+
+
+def _validate(updates: list[dict]) -> list[Update]:
+    return [Update.model_validate(u, context={"bot": bot.bot}) for u in updates]
+
+
+async def _run_streams(streams: list[list[Update]], concurrency: int, as_tasks: bool = False) -> list[float]:
+    """Юзеры параллельно (до concurrency), апдейты одного юзера — строго по порядку.
+
+    as_tasks: как polling/webhook — каждый апдейт отдельной задачей, вперемешку между
+    юзерами; порядок внутри юзера тогда держит только UserSerialMiddleware бота.
+    """
+    latencies: list[float] = []
+    sem = asyncio.Semaphore(concurrency)
+
+    async def feed(upd: Update):
+        async with sem:
+            t0 = time.perf_counter()
+            await bot.dp.feed_update(bot.bot, upd)
+            latencies.append(time.perf_counter() - t0)
+
+    async def run(stream: list[Update]):
+        for upd in stream:
+            await feed(upd)
+
+    if as_tasks:
+        interleaved = [s[i] for i in range(max(map(len, streams), default=0)) for s in streams if i < len(s)]
+        sem = asyncio.Semaphore(len(interleaved) or 1)  # без лимита: все апдейты сразу доходят до диспетчера
+        await asyncio.gather(*(asyncio.create_task(feed(u)) for u in interleaved))
+    else:
+        await asyncio.gather(*(run(s) for s in streams))
+    return latencies
+
+
+def _admin_order_ids(session: FakeTelegramSession) -> list[str]:
+    out = []
+    for call in session.calls:
+        markup = getattr(call, "reply_markup", None)
+        if getattr(call, "chat_id", None) == bot.ADMIN_ID and markup is not None:
+            data = markup.inline_keyboard[0][0].callback_data or ""
+            if data.startswith("adm:approve:"):
+                out.append(data.split(":", 2)[2])
+    return out
+
+
+def _digest_button(session: FakeTelegramSession, prefix: str) -> str:
+    """callback_data кнопки из последнего дайджеста, который видит админ."""
+    for call in reversed(session.calls):
+        markup = getattr(call, "reply_markup", None)
+        if getattr(call, "chat_id", None) == bot.ADMIN_ID and markup is not None:
+            for row in markup.inline_keyboard:
+                for button in row:
+                    if (button.callback_data or "").startswith(prefix):
+                        return button.callback_data
+    raise LookupError(prefix)
+
+
+async def _bench_flows(args, session: FakeTelegramSession | None = None, before_shutdown=None) -> dict:
+    session = bot.bot.session = session or FakeTelegramSession()
+    timer = HandlerTimer()
+    bot.dp.callback_query.middleware(timer)
+    bot.dp.message.middleware(timer)
+    bot.ADMIN_DIGEST = args.digest
+    await bot.dp.emit_startup(bot=bot.bot)
+
+    users = [20_000 + i for i in range(args.users)]
+    streams = [_validate(flow_sub_crypto(uid) if i % 2 else flow_topup_sbp(uid)) for i, uid in enumerate(users)]
+    t0 = time.perf_counter()
+    latencies = await _run_streams(streams, args.concurrency, args.as_tasks)
+
+    await bot.OUTBOX.drain()  # уведомления админу уходят в фоне
+    if args.digest:
+        # одно сообщение-дайджест и "✅ Всю страницу", пока есть открытые заявки
+        order_ids = []
+        await bot.publish_digest()
+        while bot._DIGEST_SHOWN:
+            order_ids += bot._DIGEST_SHOWN
+            page = _digest_button(session, "dg:approve_page:")
+            latencies += await _run_streams([_validate([cb_update(bot.ADMIN_ID, page)])], 1)
+    else:
+        order_ids = _admin_order_ids(session)
+        approvals = [_validate([cb_update(bot.ADMIN_ID, f"adm:approve:{oid}")]) for oid in order_ids]
+        latencies += await _run_streams(approvals, args.concurrency)
+    await bot.OUTBOX.drain()  # в дайджест-режиме уведомления юзерам тоже уходят в фоне
+    elapsed = time.perf_counter() - t0
+    if before_shutdown is not None:
+        await before_shutdown()
+    await bot.dp.emit_shutdown(bot=bot.bot)
+    admin_calls = sum(1 for c in session.calls if getattr(c, "chat_id", None) == bot.ADMIN_ID)
+
+    approved_msgs = sum(1 for c in session.calls if isinstance(c, SendMessage) and c.chat_id in set(users)
+                        and c.text.startswith("✅") and "Спасибо" in c.text)
+    result = {
+        "updates": len(latencies),
+        "throughput": len(latencies) / elapsed,
+        "p50_ms": percentile(latencies, .5) * 1e3,
+        "p99_ms": percentile(latencies, .99) * 1e3,
+        "orders": len(order_ids),
+        "approved": approved_msgs,
+        "ok": len(order_ids) == len(users) and approved_msgs == len(users),
+        "handlers": {name: {"count": len(v), "p50_ms": percentile(v, .5) * 1e3, "p99_ms": percentile(v, .99) * 1e3}
+                     for name, v in sorted(timer.samples.items())},
+    }
+
+    print(f"users: {len(users)}  updates: {result['updates']}  elapsed: {elapsed:.2f}s  "
+          f"throughput: {result['throughput']:.0f} upd/s")
+    print(f"update latency: p50 {result['p50_ms']:.2f} ms  p99 {result['p99_ms']:.2f} ms")
+    print(f"same-user updates that waited on the per-user lock: {bot.USER_LOCKS.contended}")
+    print(f"API calls to the admin chat: {admin_calls}")
+    print(f"orders sent to admin: {result['orders']}  approved & notified: {result['approved']}  "
+          f"-> {'OK' if result['ok'] else 'FLOWS INCOMPLETE'}")
+    print_table(("handler", "count", "p50 ms", "p99 ms"),
+                [(k, v["count"], f"{v['p50_ms']:.3f}", f"{v['p99_ms']:.3f}") for k, v in result["handlers"].items()])
+    return result
+
+
+def _legacy_session(i: int) -> dict:
+    """Сессия в старом формате (dict на 9 ключей); каждая третья — посреди оплаты."""
+    rec = {k: None for k in bot.USER_FIELDS} | {"lang": "ru"}
+    if i % 3 == 0:
+        rec |= {"flow": "topup", "step": "wait_txid", "topup_usd": 20, "pay_method": "crypto", "coin": "BTC",
+                "order_id": bot.make_order_id(), "email": f"user{i}@mail.ru"}
+    return rec
+
+
+async def _bench_state_cost(sizes: list[int]) -> list[tuple]:
+    """Стоимость save_state / фоновой записи в зависимости от числа сессий."""
+    rows = []
+    base_dir = os.getcwd()
+    for n in sizes:
+        os.chdir(tempfile.mkdtemp(dir=base_dir))
+        legacy = {uid: _legacy_session(uid) for uid in range(1, n + 1)}
+        sessions = {uid: bot.Session.from_record(rec) for uid, rec in legacy.items()}
+        probe = random.sample(range(1, n + 1), min(n, 100))
+
+        # как было: полная перезапись state.json с indent=2 на каждое нажатие
+        t0 = time.perf_counter()
+        with open("legacy_state.json", "w", encoding="utf-8") as f:
+            json.dump(legacy, f, ensure_ascii=False, indent=2)
+        legacy_ms = (time.perf_counter() - t0) * 1e3
+
+        for backend in ("json", "sqlite"):
+            storage = bot.JsonStorage() if backend == "json" else bot.SqliteStorage(f"bench-{n}.db")
+            if backend == "json":
+                storage.users.rows.update((uid, s.to_row()) for uid, s in sessions.items())
+            else:
+                storage.put_users([(uid, s.to_row()) for uid, s in sessions.items()])
+            bot.STORAGE = storage
+            bot.USER = bot.SessionCache(n, 0)
+            for uid, sess in sessions.items():
+                bot.USER.put(uid, sess)
+
+            t0 = time.perf_counter()
+            for uid in probe * 100:
+                bot.save_state(uid)
+            mark_us = (time.perf_counter() - t0) / (len(probe) * 100) * 1e6
+
+            t0 = time.perf_counter()
+            await bot.flush_state()
+            flush_ms = (time.perf_counter() - t0) * 1e3
+
+            bot.save_state(probe[0])
+            t0 = time.perf_counter()
+            await bot.flush_state(compact=True)
+            compact_ms = (time.perf_counter() - t0) * 1e3
+            storage.close()
+            rows.append((f"{n:,}", backend, f"{legacy_ms:.1f}", f"{mark_us:.2f}", f"{flush_ms:.2f}", f"{compact_ms:.1f}"))
+        bot.USER.clear()
+    os.chdir(base_dir)
+    print_table(("sessions", "backend", "legacy save ms", "save_state µs", "flush 100 dirty ms", "compact ms"), rows)
+    return rows
+
+
+async def _bench_cache(args):
+    """Zipf-подобный трафик по --users юзерам через get_user при разных размерах кэша."""
+    n = args.users
+    sizes = [int(x) for x in args.cache_sizes.split(",") if x]
+    bot.STORAGE = bot.JsonStorage()
+    bot.STORAGE.users.rows.update((uid, bot.Session.from_record(_legacy_session(uid)).to_row())
+                                  for uid in range(1, n + 1))
+    # 80/20: большая часть нажатий — от небольшой активной доли юзеров
+    weights = [1 / rank for rank in range(1, n + 1)]
+    trace = random.choices(range(1, n + 1), weights, k=args.n)
+    rows = []
+    for size in sizes:
+        bot.USER = bot.SessionCache(size, 0)
+        bot._DIRTY.clear()
+        tracemalloc.start()
+        t0 = time.perf_counter()
+        for i, uid in enumerate(trace):
+            u = await bot.get_user(uid)
+            if i % 5 == 0:  # часть нажатий меняет сессию
+                u["step"] = "wait_txid"
+                bot.save_state(uid)
+        elapsed = time.perf_counter() - t0
+        mem = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+        await bot.flush_state()
+        st = bot.USER.stats()
+        rows.append((f"{size:,}", st["resident"], f"{st['hit_rate']}%", st["evictions"],
+                     f"{elapsed / len(trace) * 1e6:.1f}", f"{mem / 2**20:.1f}"))
+    print(f"{n:,} users in storage, {len(trace):,} get_user calls (zipf)")
+    print_table(("cache size", "resident", "hit rate", "evictions", "µs/get_user", "traced MB"), rows)
+
+
+def bench_cache(args):
+    asyncio.run(_bench_cache(args))
+
+
+_STARTUP_CHILD = """
+import asyncio, os, sys
+sys.path.insert(0, {here!r})
+os.environ.update(BOT_TOKEN="123456:BENCH", ADMIN_ID="1", STORAGE="json")
+import bot
+from aiogram.client.session.base import BaseSession
+from aiogram.types import Update
+
+class Session(BaseSession):
+    async def make_request(self, bot_, method, timeout=None):
+        return True
+    async def stream_content(self, *a, **kw):
+        yield b""
+    async def close(self):
+        pass
+
+async def main():
+    bot.bot.session = Session()
+    upd = Update.model_validate({update!r}, context={{"bot": bot.bot}})
+    await bot.dp.feed_update(bot.bot, upd)
+    assert bot.USER[{uid}]["topup_usd"] == 20, "session not loaded"
+    with open("/proc/self/statm") as f:  # resident сейчас; ru_maxrss наследуется от родителя через fork
+        print(int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") // 1024, flush=True)
+
+asyncio.run(main())
+"""
+
+
+def bench_startup(args):
+    """Время от запуска процесса до первого обработанного апдейта при разном размере state.json."""
+    import subprocess
+
+    base_dir = os.getcwd()
+    runs = []
+    for n in [int(x) for x in args.state_sizes.split(",") if x]:
+        rows_by_uid = {uid: bot.Session.from_record(_legacy_session(uid)).to_row() for uid in range(1, n + 1)}
+        uid = n // 2 - n // 2 % 3 or 3  # каждая третья сессия — посреди оплаты с topup_usd=20
+        rows_by_uid.setdefault(uid, bot.Session.from_record(_legacy_session(3)).to_row())
+        for fmt in ("one-line (full load)", "sorted lines (mmap)"):
+            path = tempfile.mkdtemp(dir=base_dir)
+            if fmt.startswith("one-line"):
+                with open(os.path.join(path, bot.STATE_FILE), "w", encoding="utf-8") as f:
+                    json.dump(rows_by_uid, f, separators=(",", ":"))
+            else:
+                table = bot._SortedSnapshotTable(os.path.join(path, bot.STATE_FILE), os.path.join(path, "journal"))
+                table.rows.update(rows_by_uid)
+                table.put([], compact=True)
+                table.close()
+            runs.append((n, fmt, path, uid))
+        del rows_by_uid
+
+    # дочерние процессы запускаем уже без гигабайтных словарей в родителе
+    rows = []
+    for n, fmt, path, uid in runs:
+        child = _STARTUP_CHILD.format(here=HERE, update=cb_update(uid, "nav:back_pay"), uid=uid)
+        size = os.path.getsize(os.path.join(path, bot.STATE_FILE))
+        t0 = time.perf_counter()
+        out = subprocess.run([sys.executable, "-c", child], cwd=path, capture_output=True, text=True, check=True)
+        elapsed = time.perf_counter() - t0
+        rows.append((f"{n:,}", fmt, f"{size / 2**20:.1f}", f"{elapsed * 1e3:.0f}", f"{int(out.stdout) / 1024:.0f}"))
+    print_table(("sessions", "state.json", "MB", "start -> first update ms", "RSS MB"), rows)
+
+
+def bench_sessions(args):
+    """Память и размер state.json: dict-сессии против Session (__slots__ + кодбуки)."""
+    rows = []
+    for n in [int(x) for x in args.state_sizes.split(",") if x]:
+        res = {}
+        for name, make in (("dict", _legacy_session), ("Session", lambda i: bot.Session.from_record(_legacy_session(i)))):
+            tracemalloc.start()
+            table = {uid: make(uid) for uid in range(1, n + 1)}
+            res[name] = tracemalloc.get_traced_memory()[0]
+            tracemalloc.stop()
+            res[name + "_table"] = table
+        legacy, sessions = res.pop("dict_table"), res.pop("Session_table")
+        old_json = json.dumps(legacy, ensure_ascii=False, separators=(",", ":"))
+        new_json = json.dumps({uid: s.to_row() for uid, s in sessions.items()}, ensure_ascii=False, separators=(",", ":"))
+        t0 = time.perf_counter()
+        {int(k): bot.Session.from_record(v) for k, v in json.loads(old_json).items()}
+        old_load = time.perf_counter() - t0
+        t0 = time.perf_counter()
+        {int(k): bot.Session(*v) for k, v in json.loads(new_json).items()}
+        new_load = time.perf_counter() - t0
+        rows.append((f"{n:,}", f"{res['dict'] / n:.0f}", f"{res['Session'] / n:.0f}",
+                     f"{len(old_json) / 2**20:.1f}", f"{len(new_json) / 2**20:.1f}",
+                     f"{old_load * 1e3:.0f}", f"{new_load * 1e3:.0f}"))
+        del legacy, sessions
+    print_table(("sessions", "dict B/user", "Session B/user", "dict json MB", "rows json MB",
+                 "load+migrate dict ms", "load rows ms"), rows)
+
+
+def _gate(result: dict, baseline_path: str, tolerance: float) -> int:
+    with open(baseline_path, "r", encoding="utf-8") as f:
+        base = json.load(f)
+    problems = []
+    if not result["ok"]:
+        problems.append("flows incomplete")
+    if result["throughput"] < base["throughput"] * (1 - tolerance):
+        problems.append(f"throughput {result['throughput']:.0f} < baseline {base['throughput']:.0f}")
+    for name, h in result["handlers"].items():
+        b = base["handlers"].get(name)
+        # +2 ms абсолютного запаса: p99 суб-миллисекундных хендлеров — сплошной шум планировщика
+        if b and h["p99_ms"] > b["p99_ms"] * (1 + tolerance) + 2:
+            problems.append(f"{name} p99 {h['p99_ms']:.2f} ms > baseline {b['p99_ms']:.2f} ms")
+    for p in problems:
+        print(f"❌ REGRESSION: {p}")
+    if not problems:
+        print(f"✅ no regressions vs {baseline_path} (tolerance {tolerance:.0%})")
+    return 1 if problems else 0
+
+
+def bench_load(args):
+    result = asyncio.run(_bench_flows(args))
+    if args.state_sizes:
+        print()
+        asyncio.run(_bench_state_cost([int(x) for x in args.state_sizes.split(",") if x]))
+    if args.save:
+        with open(args.save, "w", encoding="utf-8") as f:
+            json.dump(result, f, indent=2)
+    if args.gate:
+        return _gate(result, args.gate, args.tolerance)
+    return 0 if result["ok"] else 1
+
+
+# =====================
+# METRICS (/metrics после нагрузки)
+# =====================
+async def _bench_metrics(args):
+    session = FakeTelegramSession()
+    session.middleware(bot.ApiMetricsMiddleware())
+    session.middleware(bot.RenderCacheMiddleware())
+    times: list[float] = []
+    scraped = {}
+
+    async def scrape():
+        # пока хранилище ещё открыто (до on_shutdown бота)
+        app = web.Application()
+        app.router.add_get("/metrics", bot.metrics_view)
+        runner = web.AppRunner(app)
+        await runner.setup()
+        site = web.TCPSite(runner, "127.0.0.1", 0)
+        await site.start()
+        port = site._server.sockets[0].getsockname()[1]
+        async with ClientSession() as http:
+            for _ in range(20):
+                t0 = time.perf_counter()
+                async with http.get(f"http://127.0.0.1:{port}/metrics") as r:
+                    scraped["body"] = await r.text()
+                    scraped["ctype"] = r.headers["Content-Type"]
+                times.append(time.perf_counter() - t0)
+        await runner.cleanup()
+
+    await _bench_flows(args, session, before_shutdown=scrape)
+    body, ctype = scraped["body"], scraped["ctype"]
+
+    lines = [ln for ln in body.splitlines() if not ln.startswith("#")]
+    print()
+    print(f"/metrics: {ctype}, {len(lines)} samples, {len(body)} bytes, "
+          f"scrape p50 {percentile(times, .5) * 1e3:.2f} ms")
+    for ln in lines:
+        if ln.startswith(("bot_updates", "bot_pending", "bot_sessions", "bot_save_state_bytes", "bot_render_cache",
+                          "bot_flood_control", "bot_event_loop_lag")) or (
+                "_count" in ln and ("handler_seconds" in ln or "api_request" in ln or "save_state" in ln)):
+            print("  " + ln)
+
+
+def bench_metrics(args):
+    asyncio.run(_bench_metrics(args))
+
+
+# =====================
+# SHARDS (ingress + процессы-воркеры)
+# =====================
+class FakeBotApi:
+    """Локальный Bot API по HTTP: отдаёт апдейты через getUpdates, на send*/edit* отвечает Message.
+
+    Пишет (метод, chat_id, text, время) каждого вызова — по ним проверяется, что дошло до юзеров
+    и что общий лимит исходящих держится на все воркеры сразу.
+    """
+
+    SENDS = {"sendMessage", "sendPhoto", "sendDocument", "editMessageText", "editMessageReplyMarkup"}
+
+    def __init__(self):
+        self.updates: list[dict] = []
+        self.offset = 0
+        self.arrived = asyncio.Event()
+        self.calls: list[tuple[str, int | None, str, float, str]] = []
+        self._ids = itertools.count(1)
+        self._update_ids = itertools.count(1)
+
+    def push(self, updates: list[dict]):
+        # update_id в порядке выдачи, как у Telegram — от этого зависит offset в getUpdates
+        for upd in updates:
+            upd["update_id"] = next(self._update_ids)
+        self.updates += updates
+        self.arrived.set()
+
+    async def handle(self, request: web.Request) -> web.Response:
+        method = request.match_info["method"]
+        form = await request.post()
+        if method == "getUpdates":
+            self.offset = max(self.offset, int(form.get("offset") or 0))
+            self.updates = [u for u in self.updates if u["update_id"] >= self.offset]
+            if not self.updates:
+                self.arrived.clear()
+                try:
+                    await asyncio.wait_for(self.arrived.wait(), 1)
+                except asyncio.TimeoutError:
+                    pass
+            return web.json_response({"ok": True, "result": self.updates[:100]})
+        chat_id = int(form["chat_id"]) if "chat_id" in form else None
+        markup = form.get("reply_markup") or ""
+        self.calls.append((method, chat_id, form.get("text") or form.get("caption") or "", time.monotonic(), markup))
+        if method in self.SENDS:
+            return web.json_response({"ok": True, "result": {
+                "message_id": next(self._ids), "date": int(time.time()),
+                "chat": {"id": chat_id or 0, "type": "private"}}})
+        return web.json_response({"ok": True, "result": True})
+
+    def max_per_second(self, chat_id: int | None = None) -> int:
+        # максимум отправок в любом скользящем окне в 1 сек
+        stamps = [ts for m, c, _, ts, _ in self.calls if m in self.SENDS and (chat_id is None or c == chat_id)]
+        best, lo = 0, 0
+        for hi, ts in enumerate(stamps):
+            while ts - stamps[lo] >= 1:
+                lo += 1
+            best = max(best, hi - lo + 1)
+        return best
+
+
+async def _wait_for(cond, timeout: float, what: str):
+    deadline = time.monotonic() + timeout
+    while not cond():
+        if time.monotonic() > deadline:
+            raise RuntimeError(f"timeout waiting for {what}")
+        await asyncio.sleep(0.05)
+
+
+async def _bench_shards_once(args, workers: int, global_rate: float) -> dict:
+    import sqlite3
+    from aiogram.client.session.aiohttp import AiohttpSession
+    from aiogram.client.telegram import TelegramAPIServer
+
+    api = FakeBotApi()
+    app = web.Application()
+    app.router.add_post("/bot{token}/{method}", api.handle)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    site = web.TCPSite(runner, "127.0.0.1", 0)
+    await site.start()
+    url = f"http://127.0.0.1:{site._server.sockets[0].getsockname()[1]}"
+
+    # конфиг воркеров — через ENV (spawn: каждый воркер заново импортирует bot)
+    db = os.path.abspath(f"shards-{workers}.db")
+    os.environ.update(STORAGE="sqlite", STATE_DB=db, TELEGRAM_API_URL=url, WORKERS=str(workers), SLOW_UPDATE_MS="0",
+                      OUTBOX_GLOBAL_RATE=str(global_rate), OUTBOX_CHAT_RATE=str(args.chat_rate), OUTBOX_CHAT_BURST="10")
+    bot.OUTBOX_GLOBAL_RATE, bot.OUTBOX_CHAT_RATE, bot.OUTBOX_CHAT_BURST = global_rate, args.chat_rate, 10
+    bot.bot.session = AiohttpSession(api=TelegramAPIServer.from_base(url))
+
+    ingress = bot.Ingress(workers)
+    t0 = time.perf_counter()
+    await asyncio.to_thread(ingress.start)
+    started = time.perf_counter() - t0
+    poller = asyncio.create_task(bot.poll_into(ingress))
+
+    users = [30_000 + i for i in range(args.users)]
+    flows = [flow_sub_crypto(uid) if i % 2 else flow_topup_sbp(uid) for i, uid in enumerate(users)]
+    # как из getUpdates: вперемешку между юзерами, у каждого — по порядку
+    api.push([f[i] for i in range(max(map(len, flows))) for f in flows if i < len(f)])
+    t0 = time.perf_counter()
+
+    def order_ids() -> list[str]:
+        return [m.split('"adm:approve:')[1].split('"')[0] for meth, c, _, _, m in api.calls
+                if c == bot.ADMIN_ID and "adm:approve:" in m]
+
+    await _wait_for(lambda: len(order_ids()) >= len(users), 120, "admin notifications")
+    api.push([cb_update(bot.ADMIN_ID, f"adm:approve:{oid}") for oid in order_ids()])
+    user_set = set(users)
+    approved = lambda: sum(1 for meth, c, text, _, _ in api.calls
+                           if c in user_set and text.startswith("✅") and "Спасибо" in text)
+    await _wait_for(lambda: approved() >= len(users), 120, "approvals")
+    elapsed = time.perf_counter() - t0
+
+    poller.cancel()
+    await asyncio.gather(poller, return_exceptions=True)
+    await asyncio.to_thread(ingress.stop)
+    await bot.bot.session.close()
+    await runner.cleanup()
+
+    with sqlite3.connect(db) as conn:
+        statuses = dict(conn.execute("SELECT status, count(*) FROM orders GROUP BY status").fetchall())
+        sessions = conn.execute("SELECT count(*) FROM users").fetchone()[0]
+    n_updates = sum(map(len, flows)) + len(users)
+    return {"workers": workers, "start_s": started, "updates": n_updates, "elapsed": elapsed,
+            "throughput": n_updates / elapsed, "per_worker": ingress.dispatched,
+            "approved": statuses.get("approved", 0), "sessions": sessions,
+            "max_global_per_s": api.max_per_second(), "max_admin_per_s": api.max_per_second(bot.ADMIN_ID),
+            "ok": statuses.get("approved", 0) == len(users) and approved() == len(users)
+            and all(p.exitcode == 0 for p in ingress.procs)}
+
+
+# fake API видит время прихода запроса, а не отправки: на одном занятом ядре воркеры и сервер
+# делят CPU, и запросы доходят пачками. Окно в 1 с для проверки лимита расширяем на столько.
+ARRIVAL_JITTER = 0.1
+
+
+async def _bench_shards(args) -> int:
+    rows, ok = [], True
+    global_cap = args.global_rate * (1 + ARRIVAL_JITTER) + bot.OUTBOX_GLOBAL_BURST
+    admin_cap = args.chat_rate * (1 + ARRIVAL_JITTER) + 10
+    for workers in [int(x) for x in args.workers.split(",") if x]:
+        r = await _bench_shards_once(args, workers, args.global_rate)
+        r["ok"] &= r["max_global_per_s"] <= global_cap and r["max_admin_per_s"] <= admin_cap
+        ok &= r["ok"]
+        rows.append((r["workers"], f"{r['start_s']:.1f}", r["updates"], f"{r['elapsed']:.2f}",
+                     f"{r['throughput']:.0f}", "/".join(map(str, r["per_worker"])), r["approved"],
+                     f"{r['max_global_per_s']} (≤{global_cap:.0f})",
+                     f"{r['max_admin_per_s']} (≤{admin_cap:.0f})", "OK" if r["ok"] else "FAIL"))
+    print(f"cpu cores: {os.cpu_count()}  users: {args.users}  "
+          f"(caps: rate x {1 + ARRIVAL_JITTER:g} s + burst, for arrival jitter at the fake API)")
+    print_table(("workers", "start s", "updates", "elapsed s", "upd/s", "updates per worker", "approved",
+                 "max sends/s", "max admin/s", ""), rows)
+    return 0 if ok else 1
+
+
+def bench_shards(args):
+    return asyncio.run(_bench_shards(args))
+
+
+# =====================
+# OUTBOX (rate limits, 429)
+# =====================
+class FloodTelegramSession(FakeTelegramSession):
+    """Fake API с лимитами Telegram: >global_limit за окно на бота или >chat_limit в чат -> 429.
+
+    Плюс случайные 429 (flood_p) и 502 (error_p). Окно = 1 / scale сек, чтобы бенч шёл быстро;
+    retry_after при этом честная 1 сек.
+    """
+
+    def __init__(self, scale: float, flood_p: float, error_p: float, global_limit: int = 30, chat_limit: int = 4):
+        super().__init__()
+        self.window, self.flood_p, self.error_p = 1 / scale, flood_p, error_p
+        self.global_limit, self.chat_limit = global_limit, chat_limit
+        self._global: list[float] = []
+        self._chats: dict[int, list[float]] = defaultdict(list)
+        self.flood_429 = self.random_429 = self.errors_5xx = 0
+
+    def _hit(self, stamps: list[float], now: float, limit: int) -> bool:
+        while stamps and stamps[0] <= now - self.window:
+            stamps.pop(0)
+        if len(stamps) >= limit:
+            return True
+        stamps.append(now)
+        return False
+
+    async def make_request(self, bot_, method, timeout=None):
+        now = time.monotonic()
+        chat_id = getattr(method, "chat_id", None)
+        if random.random() < self.error_p:
+            self.errors_5xx += 1
+            raise TelegramServerError(method, "Bad Gateway")
+        if random.random() < self.flood_p:
+            self.random_429 += 1
+            raise TelegramRetryAfter(method, "Flood control exceeded", retry_after=1)
+        if self._hit(self._global, now, self.global_limit) or (
+                chat_id is not None and self._hit(self._chats[chat_id], now, self.chat_limit)):
+            self.flood_429 += 1
+            raise TelegramRetryAfter(method, "Flood control exceeded", retry_after=1)
+        return await super().make_request(bot_, method, timeout)
+
+
+async def _bench_outbox(args):
+    scale = args.scale
+    fake = FloodTelegramSession(scale, args.flood_p, args.error_p)
+    client = Bot(bot.TOKEN, session=fake)
+    outbox = bot.Outbox(global_rate=bot.OUTBOX_GLOBAL_RATE * scale, global_burst=bot.OUTBOX_GLOBAL_BURST,
+                        chat_rate=bot.OUTBOX_CHAT_RATE * scale, chat_burst=bot.OUTBOX_CHAT_BURST, max_retries=10)
+    fake.middleware(outbox)
+    bot.OUTBOX_BACKOFF = 0.5 / scale
+
+    latency: dict[str, list[float]] = defaultdict(list)
+    depth = {"queued_user": 0, "queued_admin": 0, "chat_waiting": 0}
+
+    async def timed(kind: str, coro):
+        t0 = time.perf_counter()
+        await coro
+        latency[kind].append(time.perf_counter() - t0)
+
+    async def sample():
+        while True:
+            for k, v in outbox.stats().items():
+                if k in depth:
+                    depth[k] = max(depth[k], v)
+            await asyncio.sleep(0.005)
+
+    sampler = asyncio.create_task(sample())
+    t0 = time.perf_counter()
+    # худший случай: пачка уведомлений админу уже в очереди, когда приходят ответы юзерам
+    for i in range(args.users):
+        outbox.post(timed("admin", client.send_message(bot.ADMIN_ID, f"order {i}")))
+    await asyncio.sleep(0)
+    users = [30_000 + i for i in range(args.users)]
+    await asyncio.gather(*(timed("user", client.send_message(uid, "reply")) for uid in users))
+    users_done = time.perf_counter() - t0
+    await outbox.drain()
+    elapsed = time.perf_counter() - t0
+    sampler.cancel()
+
+    delivered = sum(1 for c in fake.calls if isinstance(c, SendMessage))
+    expected = 2 * args.users
+    print(f"scale x{scale:g}: global {bot.OUTBOX_GLOBAL_RATE * scale:g}/s, "
+          f"per chat {bot.OUTBOX_CHAT_RATE * scale:g}/s (burst {bot.OUTBOX_CHAT_BURST:g})")
+    print(f"delivered: {delivered}/{expected}  all user replies in {users_done:.2f}s  everything in {elapsed:.2f}s")
+    print(f"fake API: {fake.flood_429} limit 429s, {fake.random_429} random 429s, {fake.errors_5xx} 5xx; "
+          f"outbox stats: {outbox.stats()}")
+    print(f"max depth: {depth}")
+    print_table(("kind", "count", "p50 ms", "p99 ms"),
+                [(k, len(v), f"{percentile(v, .5) * 1e3:.1f}", f"{percentile(v, .99) * 1e3:.1f}")
+                 for k, v in sorted(latency.items(), reverse=True)])
+    return 0 if delivered == expected and not outbox.failed else 1
+
+
+def bench_outbox(args):
+    return asyncio.run(_bench_outbox(args))
+
+
+# =====================
+# VERIFY (автопроверка TXID)
+# =====================
+class FakeExplorer:
+    """TronGrid, Esplora и Etherscan в одном локальном сервере.
+
+    Каждому TXID при регистрации задаётся исход: ok / wrong amount / wrong address / пока без
+    подтверждений / не найден. Подтверждения растут на 1 за каждый запрос к сети.
+    """
+
+    def __init__(self):
+        self.txs: dict[str, dict] = {}   # txid -> {coin, to, amount, conf}
+        self.requests: defaultdict[str, int] = defaultdict(int)
+        self.height = 800_000
+
+    def add(self, coin: str, txid: str, to: str, amount, conf: int):
+        self.txs[txid] = {"coin": coin, "to": to, "amount": amount, "conf": conf, "first": self.height}
+
+    def _tick(self, kind: str):
+        self.requests[kind] += 1
+        self.height += 1
+        for tx in self.txs.values():
+            tx["conf"] = tx["conf"] + 1 if tx["conf"] else 0
+
+    async def trongrid(self, request: web.Request) -> web.Response:
+        self._tick("trongrid")
+        addr = request.match_info["addr"]
+        data = [{"transaction_id": txid, "to": tx["to"], "value": str(int(tx["amount"] * 10**6)),
+                 "token_info": {"decimals": 6}}
+                for txid, tx in self.txs.items() if tx["coin"] == "USDT_TRC20" and tx["to"] in (addr, "other")
+                and tx["conf"] >= bot.VERIFY_CONFIRMATIONS["USDT_TRC20"]]
+        return web.json_response({"data": data, "success": True})
+
+    async def esplora_tip(self, request: web.Request) -> web.Response:
+        self._tick("esplora_tip")
+        return web.Response(text=str(self.height))
+
+    async def esplora_tx(self, request: web.Request) -> web.Response:
+        self.requests["esplora_tx"] += 1
+        tx = self.txs.get(request.match_info["txid"])
+        if tx is None or tx["coin"] != "BTC":
+            return web.Response(status=404, text="Transaction not found")
+        status = {"confirmed": bool(tx["conf"])}
+        if tx["conf"]:
+            status["block_height"] = self.height - tx["conf"] + 1
+        return web.json_response({"vout": [{"scriptpubkey_address": tx["to"], "value": int(tx["amount"] * 10**8)}],
+                                  "status": status})
+
+    async def etherscan(self, request: web.Request) -> web.Response:
+        self._tick("etherscan")
+        addr = request.query["address"].lower()
+        result = [{"hash": txid, "to": tx["to"].lower(), "value": str(int(tx["amount"] * 10**18)), "isError": "0",
+                   "confirmations": str(tx["conf"])}
+                  for txid, tx in self.txs.items() if tx["coin"] == "ETH" and tx["to"].lower() in (addr, "other")]
+        return web.json_response({"status": "1", "message": "OK", "result": result})
+
+    async def start(self) -> tuple[web.AppRunner, str]:
+        app = web.Application()
+        app.router.add_get("/tron/v1/accounts/{addr}/transactions/trc20", self.trongrid)
+        app.router.add_get("/esplora/blocks/tip/height", self.esplora_tip)
+        app.router.add_get("/esplora/tx/{txid}", self.esplora_tx)
+        app.router.add_get("/etherscan", self.etherscan)
+        runner = web.AppRunner(app, access_log=None)
+        await runner.setup()
+        site = web.TCPSite(runner, "127.0.0.1", 0)
+        await site.start()
+        return runner, f"http://127.0.0.1:{site._server.sockets[0].getsockname()[1]}"
+
+
+def flow_crypto_coin(uid: int, coin: str) -> list[dict]:
+    return [cb_update(uid, "lang:ru"), cb_update(uid, "menu:topup"), cb_update(uid, "topup:20"),
+            msg_update(uid, f"user{uid}@example.com"), cb_update(uid, "pay:crypto"), cb_update(uid, f"coin:{coin}"),
+            msg_update(uid, f"tx{coin[:3].lower()}{uid:012d}")]
+
+
+async def _bench_verify(args):
+    from decimal import Decimal
+    fake = FakeExplorer()
+    runner, base = await fake.start()
+    bot.TRONGRID_URL, bot.ESPLORA_URL, bot.ETHERSCAN_URL = f"{base}/tron", f"{base}/esplora", f"{base}/etherscan"
+    bot.CRYPTO_USD_RATES.update({"BTC": Decimal(50_000), "ETH": Decimal(2_500)})
+    bot.TXID_VERIFY = True
+    bot.VERIFY_INTERVAL, bot.VERIFY_MAX_INTERVAL, bot.VERIFY_GIVE_UP = 0.2, 0.5, 3.0
+    # у каждой заявки свой адрес из пула; последние 9 юзеров его не получат и платят на общий CRYPTO_ADDR
+    coins = list(bot.CRYPTO_ADDR)
+    with open("pool.txt", "w", encoding="utf-8") as f:
+        for j, coin in enumerate(coins):
+            f.writelines(f"{coin} {coin.lower()}-addr-{i:06d}\n" for i in range(j, args.users, len(coins)))
+    bot.DEPOSIT_POOL_FILE = "pool.txt"
+    bot.bot.session = session = FakeTelegramSession()
+    await bot.dp.emit_startup(bot=bot.bot)
+
+    # исход по uid: 70% ok, 10% ещё без подтверждений (дойдут), 7% мало денег, 5% чужой адрес, 8% не найден
+    outcomes = ["ok"] * 70 + ["late"] * 10 + ["short"] * 7 + ["addr"] * 5 + ["missing"] * 8
+    users = [30_000 + i for i in range(args.users + 9)]
+    flows = [flow_crypto_coin(uid, coins[i % len(coins)]) for i, uid in enumerate(users)]
+    t0 = time.perf_counter()
+    await _run_streams([_validate(updates[:-1]) for updates in flows[:args.users]], args.concurrency)
+    await _run_streams([_validate(updates[:-1]) for updates in flows[args.users:]], args.concurrency)  # пул уже пуст
+
+    expect = defaultdict(int)
+    for i, (uid, updates) in enumerate(zip(users, flows)):
+        coin, outcome = coins[i % len(coins)], outcomes[(i * 37) % len(outcomes)]
+        shared = i >= args.users
+        if shared:
+            outcome = "ok"
+        txid = updates[-1]["message"]["text"]
+        amount = Decimal(bot.quote_coin_amount(coin, 20))
+        to = "other" if outcome == "addr" else bot.DEPOSITS.address_for(bot.USER.peek(uid)["order_id"], coin)
+        if outcome != "missing":
+            fake.add(coin, txid, to, amount * Decimal("0.5") if outcome == "short" else amount,
+                     0 if outcome == "late" and coin == "USDT_TRC20" else (1 if outcome == "late" else 50))
+        expect["approved" if outcome in ("ok", "late") and not shared else "flagged"] += 1
+    await _run_streams([_validate(updates[-1:]) for updates in flows], args.concurrency)
+    # USDT "late": в сети появляются, когда уже идёт проверка
+    asyncio.get_running_loop().call_later(0.6, lambda: [tx.update(conf=1) for tx in fake.txs.values()
+                                                        if tx["coin"] == "USDT_TRC20" and not tx["conf"]])
+    verifier = bot.VERIFIER
+    await _wait_for(lambda: not verifier.pending, 30, "verifier to settle every order")
+    elapsed = time.perf_counter() - t0
+    await bot.OUTBOX.drain()
+    await bot.dp.emit_shutdown(bot=bot.bot)
+    await runner.cleanup()
+
+    users = set(users)
+    thanked = sum(1 for c in session.calls if isinstance(c, SendMessage) and c.chat_id in users
+                  and "Спасибо" in c.text)
+    st = verifier.stats()
+    ok = st["approved"] == expect["approved"] == thanked and st["flagged"] == expect["flagged"]
+    print(f"orders: {len(users)} ({len(users) - args.users} on the shared address)  expected approved {expect['approved']} / flagged {expect['flagged']}")
+    print(f"verifier: {st}  users notified: {thanked}  in {elapsed:.2f}s -> {'OK' if ok else 'MISMATCH'}")
+    print(f"explorer requests: {dict(fake.requests)}  (txid lookups without batching: ~{args.users} per round)")
+    return 0 if ok else 1
+
+
+def bench_verify(args):
+    return asyncio.run(_bench_verify(args))
+
+
+# =====================
+# DEPOSITS (адрес на заявку)
+# =====================
+async def _bench_deposits(args):
+    """Пул на --users адресов монеты, --users + 10 заявок: уникальность, O(1)-поиск заявки по адресу,
+    переживание рестарта, возврат адресов в пул после остывания."""
+    n, coins = args.users, list(bot.CRYPTO_ADDR)
+    # один юзер до основных флоу перебирает монеты: coins[0] -> coins[1] -> coins[0]; под него в пуле запас
+    extra = {coins[0]: 2, coins[1]: 1}
+    with open("pool.txt", "w", encoding="utf-8") as f:
+        f.write("# coin address\n")
+        for coin in coins:
+            f.writelines(f"{coin} {coin.lower()}-addr-{i:06d}\n" for i in range(n // len(coins) + extra.get(coin, 0)))
+    bot.DEPOSIT_POOL_FILE, bot.DEPOSIT_POOL_LOW = "pool.txt", 5
+    bot.bot.session = session = FakeTelegramSession()
+    await bot.dp.emit_startup(bot=bot.bot)
+
+    switcher = flow_crypto_coin(39_999, coins[0])
+    switcher[-1:-1] = [cb_update(39_999, f"coin:{coins[1]}"), cb_update(39_999, f"coin:{coins[0]}")]
+    await _run_streams([_validate(switcher)], 1)
+    switched = sorted(row["state"] for row in bot.STORAGE.list_held_addresses() if row["user_id"] == 39_999)
+
+    users = [40_000 + i for i in range(n + 10)]
+    streams = [_validate(flow_crypto_coin(uid, coins[i % len(coins)])) for i, uid in enumerate(users)]
+    t0 = time.perf_counter()
+    await _run_streams(streams, args.concurrency)
+    flows_s = time.perf_counter() - t0
+    orders = [r for uid in users for r in await bot.db_call(bot.STORAGE.list_user_orders, uid, 1)]
+    pooled = [r for r in orders if r["address"] not in bot.CRYPTO_ADDR.values()]
+    orders += await bot.db_call(bot.STORAGE.list_user_orders, 39_999, 1)
+    unique = len({r["address"] for r in pooled}) == len(pooled)
+    resolved = sum(bot.DEPOSITS.order_for(r["address"]) == r["order_id"] for r in pooled)
+
+    addrs = [r["address"] for r in pooled] * 50
+    t0 = time.perf_counter()
+    for addr in addrs:
+        bot.DEPOSITS.order_for(addr)
+    lookup_us = (time.perf_counter() - t0) / max(len(addrs), 1) * 1e6
+
+    await bot.settle_bulk([r["order_id"] for r in orders], "approved")
+    await bot.OUTBOX.drain()
+    warned = sum(1 for c in session.calls if isinstance(c, SendMessage) and c.chat_id == bot.ADMIN_ID
+                 and "Заканчиваются адреса" in c.text)
+    await bot.dp.emit_shutdown(bot=bot.bot)
+
+    # рестарт: привязка адрес -> заявка читается из бэкенда
+    bot.STORAGE = bot.make_storage()
+    await bot.DEPOSITS.reload()
+    after_restart = sum(bot.DEPOSITS.order_for(r["address"]) == r["order_id"] for r in pooled)
+    states = {row["state"] for row in bot.STORAGE.list_held_addresses()}
+    # через DEPOSIT_COOLDOWN адреса возвращаются в пул
+    bot.STORAGE.expire_addresses(time.time() + bot.DEPOSIT_COOLDOWN + 1, bot.DEPOSIT_COOLDOWN)
+    free = bot.STORAGE.count_free_addresses()
+    bot.STORAGE.close()
+
+    ok = (unique and resolved == after_restart == len(pooled) == n // len(coins) * len(coins)
+          and states == {"cooling"} and sum(free.values()) == len(pooled) + 3 and warned
+          and switched == ["cooling", "cooling", "leased"])
+    print(f"{bot.STORAGE_BACKEND}: {len(users)} orders in {flows_s:.2f}s, {len(pooled)} got pool addresses "
+          f"(unique: {unique}), {bot.DEPOSITS.fallbacks} fell back to CRYPTO_ADDR, admin warned: {warned}")
+    print(f"address -> order: {resolved}/{len(pooled)} live, {after_restart}/{len(pooled)} after restart, "
+          f"{lookup_us:.2f} µs/lookup")
+    print(f"coin switched twice on one order: {switched}")
+    print(f"after settle: {states}; after cooldown free again: {free} -> {'OK' if ok else 'MISMATCH'}")
+    return 0 if ok else 1
+
+
+def bench_deposits(args):
+    return asyncio.run(_bench_deposits(args))
+
+
+# =====================
+# DEDUP (повторные TXID и чеки)
+# =====================
+async def _bench_dedup(args):
+    """--proofs старых TXID в индексе, потом --users флоу, из них каждый пятый предъявляет
+    чужой TXID/чек: все повторы должны отбиться до админа, остальные — пройти."""
+    storage = bot.STORAGE
+    t0 = time.perf_counter()
+    for i in range(0, args.proofs, 10_000):
+        for j in range(i, min(i + 10_000, args.proofs)):
+            proof = bot.txid_proof(f"old{j:012d}")
+            storage.claim_proof(bot.proof_hash(proof), proof, f"OLD{j}", 1, True)
+        storage.put_users([], compact=True)  # JSON: старое уходит в снапшот, в памяти не остаётся
+    print(f"{bot.STORAGE_BACKEND}: {args.proofs:,} proofs preloaded in {time.perf_counter() - t0:.1f}s")
+
+    bot.bot.session = session = FakeTelegramSession()
+    await bot.dp.emit_startup(bot=bot.bot)
+    print(f"bloom: {bot.PROOFS.bloom.count:,} items, k={bot.PROOFS.bloom.k}, {len(bot.PROOFS.bloom.array) / 2**20:.2f} MB")
+
+    users = [50_000 + i for i in range(args.users)]
+    streams, dups = [], set()
+    for i, uid in enumerate(users):
+        updates = flow_sub_crypto(uid) if i % 2 else flow_topup_sbp(uid)
+        last = updates[-1]["message"]
+        if i % 5 == 0 and i >= 10:
+            dups.add(uid)
+            if "text" in last:      # TXID давно засчитанной заявки, в другом регистре и с 0x
+                last["text"] = "0x" + bot.txid_proof(f"OLD{i * 7 % args.proofs:012d}")[5:].upper()
+            else:                   # тот же файл, что у юзера на 2 раньше (его флоу уже прошёл)
+                last["photo"][0]["file_unique_id"] = streams[i - 2][-1].message.photo[0].file_unique_id
+        streams.append(_validate(updates))
+    # сначала "честные" потоки, потом повторы — чтобы было что повторять
+    await _run_streams([s for u, s in zip(users, streams) if u not in dups], args.concurrency)
+    await _run_streams([s for u, s in zip(users, streams) if u in dups], args.concurrency)
+    await bot.OUTBOX.drain()
+
+    flagged = sum(1 for c in session.calls if isinstance(c, SendMessage) and c.chat_id == bot.ADMIN_ID
+                  and c.text.startswith("🚩"))
+    rejected = {c.chat_id for c in session.calls if isinstance(c, SendMessage) and c.chat_id in dups
+                and c.text.startswith("⚠️")}
+    orders = {r["user_id"] for uid in users for r in await bot.db_call(storage.list_user_orders, uid, 1)}
+
+    # цена проверки нового TXID: с фильтром (поиск по снапшоту пропускается) и без
+    fresh = [bot.txid_proof(f"new{j:012d}") for j in range(2000)]
+    costs = {}
+    for label, use_bloom in (("bloom", True), ("no bloom", False)):
+        t0 = time.perf_counter()
+        for j, proof in enumerate(fresh):
+            h = bot.proof_hash(proof + label)
+            storage.claim_proof(h, proof + label, f"N{j}", 2, use_bloom and h not in bot.PROOFS.bloom)
+        costs[label] = (time.perf_counter() - t0) / len(fresh) * 1e6
+    await bot.dp.emit_shutdown(bot=bot.bot)
+
+    st = bot.PROOFS.stats()
+    ok = rejected == dups and flagged == len(dups) and orders == set(users) - dups
+    print(f"flows: {len(users)}, duplicates submitted: {len(dups)}, rejected: {len(rejected)}, "
+          f"admin flags: {flagged}, orders created: {len(orders)} -> {'OK' if ok else 'MISMATCH'}")
+    print(f"index: {st}")
+    print("claim of a new proof: " + ", ".join(f"{k} {v:.1f} µs" for k, v in costs.items()))
+    return 0 if ok else 1
+
+
+def bench_dedup(args):
+    return asyncio.run(_bench_dedup(args))
+
+
+# =====================
+# RATES (живой курс)
+# =====================
+def _write_rates(rub: float, btc: float = 50_000):
+    with open(bot.RATES_FILE, "w", encoding="utf-8") as f:
+        json.dump({"RUB": rub, "BTC": btc, "ETH": 2_500}, f)
+
+
+async def _bench_rates(args):
+    """Курс из файла (FileRates) меняется каждые 10 мс, пока --users юзеров проходят оплату:
+    каждая заявка должна быть посчитана ровно по тому курсу, что в ней записан, и у юзеров,
+    начавших до смены курса, — по старому."""
+    _write_rates(90)
+    bot.RATES_TTL = 0.005
+    bot.RATES_SOURCE = ["file"]
+    bot.RATES = bot.RateProvider(["file"])
+    bot.bot.session = session = FakeTelegramSession()
+    await bot.dp.emit_startup(bot=bot.bot)
+    await _wait_for(lambda: "BTC" in bot.CRYPTO_USD_RATES, 5, "first rates")
+
+    # юзер начал оплату по 90, курс стал 100, дальше он доплачивает по 90; второй выбрал BTC
+    # по 50 000 $ и платит показанную сумму, хотя к его TXID BTC уже 40 000 $
+    early = _validate(flow_topup_sbp(1_000))
+    early_btc = _validate(flow_crypto_coin(1_001, "BTC"))
+    await _run_streams([early[:3], early_btc[:-1]], 1)
+    shown_btc = next(c.text for c in reversed(session.calls) if isinstance(c, EditMessageText) and c.chat_id == 1_001)
+    kb_before = bot.KEYBOARDS["topup_amounts", "ru"]
+    _write_rates(100, btc=40_000)
+    await _wait_for(lambda: bot.PRICES.rate == 100 and bot.CRYPTO_USD_RATES["BTC"] == 40_000, 5, "rate swap")
+    kb_after = bot.KEYBOARDS["topup_amounts", "ru"]
+    btn_20 = next(row[0].text for row in kb_after.inline_keyboard if row[0].callback_data == "topup:20")
+    await _run_streams([early[3:], early_btc[-1:]], 1)
+    early_order = bot.STORAGE.list_user_orders(1_000, 1)[0]
+    btc_order = bot.STORAGE.list_user_orders(1_001, 1)[0]
+
+    async def flap():
+        rub = 90
+        while True:
+            rub = 90 + (rub - 89) % 15     # 90..104
+            _write_rates(rub)
+            await asyncio.sleep(0.01)
+
+    flapper = asyncio.create_task(flap())
+    users = [60_000 + i for i in range(args.users)]
+    t0 = time.perf_counter()
+    await _run_streams([_validate(flow_sub_crypto(uid) if i % 2 else flow_topup_sbp(uid))
+                        for i, uid in enumerate(users)], args.concurrency)
+    elapsed = time.perf_counter() - t0
+    flapper.cancel()
+    orders = [r for uid in users for r in bot.STORAGE.list_user_orders(uid, 1)]
+    consistent = sum(r["amount_rub"] == bot.usd_to_rub_rounded(r["amount_usd"], r["rate"]) for r in orders)
+    rates_seen = len({r["rate"] for r in orders})
+
+    u = await bot.get_user(users[0])
+    t0 = time.perf_counter()
+    for _ in range(100_000):
+        bot.quoted(u).sub[3]["rub"]
+    read_us = (time.perf_counter() - t0) / 100_000 * 1e6
+    t0 = time.perf_counter()
+    for i in range(200):
+        bot.apply_rates({"RUB": bot.Decimal(110 + i)})
+    swap_us = (time.perf_counter() - t0) / 200 * 1e6
+    await bot.dp.emit_shutdown(bot=bot.bot)
+
+    ok = (early_order["rate"] == 90 and early_order["amount_rub"] == 1800 and kb_before is not kb_after
+          and "2000" in btn_20 and consistent == len(orders) == len(users)
+          and btc_order["amount_coin"] == "0.00040000" and "0.00040000 BTC" in shown_btc)
+    print(f"early user: order at rate {early_order['rate']:g} -> {early_order['amount_rub']} ₽ "
+          f"(keyboard now: {btn_20!r}); BTC user shown and checked against {btc_order['amount_coin']} BTC")
+    print(f"{len(users)} flows in {elapsed:.2f}s while the rate flapped: {bot.RATES.stats()['swaps']} swaps, "
+          f"{rates_seen} distinct rates locked into orders, {consistent}/{len(orders)} priced at their own rate")
+    print(f"price read {read_us:.3f} µs, full swap (tables + labels + keyboards) {swap_us:.0f} µs "
+          f"-> {'OK' if ok else 'MISMATCH'}")
+    return 0 if ok else 1
+
+
+def bench_rates(args):
+    return asyncio.run(_bench_rates(args))
+
+
+# =====================
+# RENDER (пустые правки)
+# =====================
+def flow_menu_taps(uid: int) -> list[dict]:
+    # типичное "тыканье": главное меню несколько раз, туда-обратно между оплатой и выбором монеты
+    taps = ["lang:ru", "nav:home", "nav:home", "nav:home", "menu:buy_sub", "sub:3", "pay:crypto",
+            "nav:back_pay", "nav:back_pay", "pay:crypto", "nav:back_pay", "nav:back_pay", "nav:home", "nav:home"]
+    return [cb_update(uid, data) for data in taps]
+
+
+async def _bench_render_once(args, size: int, first_uid: int) -> tuple[int, int, float, dict]:
+    bot.RENDERED = bot.RenderCache(size)
+    bot.USER.clear()
+    session = bot.bot.session = FakeTelegramSession()
+    session.middleware(bot.RenderCacheMiddleware())
+    # свои юзеры на каждый проход: у прошлых флуд-контроль уже потратил вёдра
+    users = [first_uid + i for i in range(args.users)]
+    t0 = time.perf_counter()
+    await _run_streams([_validate(flow_menu_taps(uid)) for uid in users], args.concurrency)
+    elapsed = time.perf_counter() - t0
+    edits = sum(isinstance(c, EditMessageText) for c in session.calls)
+    return len(users) * len(flow_menu_taps(0)), edits, elapsed, bot.RENDERED.stats()
+
+
+async def _bench_render(args):
+    await bot.dp.emit_startup(bot=bot.bot)
+    rows = []
+    for n, (label, size) in enumerate((("off", 0), ("on", bot.RENDER_CACHE_SIZE))):
+        taps, edits, elapsed, st = await _bench_render_once(args, size, 70_000 + n * 100_000)
+        rows.append((label, taps, edits, st["skipped"], f"{st['hit_rate']}%", f"{taps / elapsed:.0f}"))
+    await bot.dp.emit_shutdown(bot=bot.bot)
+    print_table(("render cache", "taps", "editMessageText calls", "skipped", "hit rate", "taps/s"), rows)
+    return 0 if rows[1][2] < rows[0][2] else 1
+
+
+def bench_render(args):
+    return asyncio.run(_bench_render(args))
+
+
+# =====================
+# THROTTLE (флуд и перегрузка)
+# =====================
+def _texts(session: FakeTelegramSession, key: str) -> dict[int, int]:
+    """chat_id -> сколько раз ушёл текст сообщения key (ru или en), сообщением или ответом на callback."""
+    variants = {bot.t(key, lang) for lang in ("ru", "en")}
+    out: dict[int, int] = defaultdict(int)
+    for c in session.calls:
+        text = getattr(c, "text", None)
+        if text in variants:
+            chat_id = getattr(c, "chat_id", None)
+            out[chat_id if chat_id is not None else c.callback_query_id] += 1
+    return out
+
+
+async def _bench_throttle(args):
+    """1) Флуд: каждый десятый юзер шлёт 100 тапов или сообщений разом, остальные проходят
+    обычные флоу — флоу должны дойти до заявок, флудеры — получить одно предупреждение.
+    2) Перегрузка: event loop заблокирован, юзеры на шаге TXID шлют TXID, остальные — болтовню;
+    TXID должны стать заявками, болтовня — сброситься."""
+    bot.SLOW_UPDATE_MS = 0              # при флуде "медленных" апдейтов сотни, лог здесь не нужен
+    bot.bot.session = session = FakeTelegramSession()
+    await bot.dp.emit_startup(bot=bot.bot)
+
+    users = [80_000 + i for i in range(args.users)]
+    spammers = set(users[::10])
+    tappers = set(list(spammers)[::2])
+    streams = []
+    for i, uid in enumerate(users):
+        if uid in tappers:
+            streams.append(_validate([cb_update(uid, "nav:home") for _ in range(100)]))
+        elif uid in spammers:
+            streams.append(_validate([msg_update(uid, f"spam {j}") for j in range(100)]))
+        else:
+            streams.append(_validate(flow_sub_crypto(uid) if i % 2 else flow_topup_sbp(uid)))
+    t0 = time.perf_counter()
+    await _run_streams(streams, args.concurrency, as_tasks=True)
+    await bot.OUTBOX.drain()
+    elapsed = time.perf_counter() - t0
+    flood = bot.FLOOD.stats()
+    honest = [uid for uid in users if uid not in spammers]
+    orders = {r["user_id"] for uid in honest for r in await bot.db_call(bot.STORAGE.list_user_orders, uid, 1)}
+    notices = _texts(session, "slow_down")
+    typers = spammers - tappers
+    # сверх запаса проходят те, кто успел зарезервировать токен в пределах THROTTLE_MAX_WAIT
+    passed = _texts(session, "open_menu")
+    expect_passed = bot.THROTTLE_BURST + int(bot.THROTTLE_RATE * bot.THROTTLE_MAX_WAIT) - 1
+    taps = {s[j].callback_query.id for uid, s in zip(users, streams) if uid in tappers for j in range(len(s))}
+    answered = {c.callback_query_id for c in session.calls if isinstance(c, AnswerCallbackQuery)}
+    spam_ok = (orders == set(honest) and all(notices.get(uid) == 1 for uid in typers)
+               and all(passed.get(uid, 0) >= expect_passed for uid in typers) and taps <= answered)
+    print(f"flood: {len(spammers)} spammers x 100 updates + {len(honest)} flows in {elapsed:.2f}s")
+    print(f"  throttled {flood['throttled']}, coalesced taps {flood['coalesced']}, notices {flood['notices']}; "
+          f"typed messages handled per spammer: {min(passed.get(uid, 0) for uid in typers)}+ "
+          f"(≥{expect_passed:g}), taps answered: {len(taps & answered)}/{len(taps)}")
+    print(f"  orders from honest users: {len(orders)}/{len(honest)} -> {'OK' if spam_ok else 'MISMATCH'}")
+
+    # перегрузка: те же честные юзеры снова на шаге TXID (сессии в кэше)
+    payers = honest[::2]
+    warmup = [_validate([cb_update(uid, "lang:ru"), cb_update(uid, "menu:buy_sub"), cb_update(uid, "sub:1"),
+                         cb_update(uid, "pay:crypto"), cb_update(uid, "coin:USDT_TRC20")]) for uid in payers]
+    await _run_streams(warmup, args.concurrency)
+    bot.FLOOD.buckets.clear()
+    bot.THROTTLE_LAG_MS = 250
+    lag_task = asyncio.create_task(bot.LOOP_LAG.run())
+    await asyncio.sleep(0.15)
+    time.sleep(0.5)                     # "тяжёлый" синхронный участок где-то в боте
+    await asyncio.sleep(0)
+    while bot.LOOP_LAG.lag * 1e3 <= bot.THROTTLE_LAG_MS:
+        await asyncio.sleep(0)
+    lagged = bot.LOOP_LAG.lag
+    before = dict(bot.FLOOD.stats())
+    calls_before = len(session.calls)
+    burst = [_validate([msg_update(uid, f"lag{uid:012d}")]) for uid in payers]
+    burst += [_validate([msg_update(uid, "hello?")]) for uid in honest[1::2]]
+    await _run_streams(burst, args.concurrency, as_tasks=True)
+    await bot.OUTBOX.drain()
+    lag_task.cancel()
+    bot.THROTTLE_LAG_MS = 0
+    shed = bot.FLOOD.stats()["shed_lag"] - before["shed_lag"]
+    paid = 0
+    for uid in payers:
+        last = await bot.db_call(bot.STORAGE.list_user_orders, uid, 1)
+        paid += bool(last) and last[0].get("months") == 1
+    replies = sum(1 for c in session.calls[calls_before:] if getattr(c, "chat_id", None) in set(honest[1::2]))
+    await bot.dp.emit_shutdown(bot=bot.bot)
+    lag_ok = paid == len(payers) and shed == len(honest[1::2]) and replies == 0
+    print(f"overload: loop lag {lagged * 1e3:.0f} ms, {len(payers)} TXIDs -> {paid} orders, "
+          f"{len(honest[1::2])} chatter messages -> {shed} shed -> {'OK' if lag_ok else 'MISMATCH'}")
+    print(f"flood control: {bot.FLOOD.stats()}")
+    return 0 if spam_ok and lag_ok else 1
+
+
+def bench_throttle(args):
+    return asyncio.run(_bench_throttle(args))
+
+
+# =====================
+# WEBHOOK
+# =====================
+def load_recorded_updates(path: str) -> list[dict]:
+    with open(path, "r", encoding="utf-8") as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+async def _bench_webhook(args):
+    """Локальный "Telegram": поднимает webhook-приложение бота и POST'ит в него апдейты."""
+    bot.bot.session = FakeTelegramSession()
+    app = bot.build_webhook_app()
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, "127.0.0.1", 0)
+    await site.start()
+    port = site._server.sockets[0].getsockname()[1]
+    url = f"http://127.0.0.1:{port}{bot.WEBHOOK_PATH}"
+
+    if args.updates:
+        by_user: dict[int, list[dict]] = {}
+        for upd in load_recorded_updates(args.updates):
+            ev = upd.get("message") or upd.get("callback_query") or {}
+            by_user.setdefault(ev.get("from", {}).get("id", 0), []).append(upd)
+        streams = list(by_user.values())
+    else:
+        streams = [flow_sub_crypto(10_000 + i) if i % 2 else flow_topup_sbp(10_000 + i) for i in range(args.users)]
+
+    acks: list[float] = []
+    headers = {"X-Telegram-Bot-Api-Secret-Token": bot.WEBHOOK_SECRET}
+    async with ClientSession() as http:
+        async with http.post(url, json=cb_update(1, "nav:home"), headers={"X-Telegram-Bot-Api-Secret-Token": "wrong"}) as r:
+            print(f"wrong secret -> HTTP {r.status}")
+
+        async def post_stream(stream: list[dict]):
+            for upd in stream:
+                t0 = time.perf_counter()
+                async with http.post(url, json=upd, headers=headers) as r:
+                    assert r.status == 200, r.status
+                acks.append(time.perf_counter() - t0)
+
+        t0 = time.perf_counter()
+        await asyncio.gather(*(post_stream(s) for s in streams))
+        posted = time.perf_counter() - t0
+    # on_shutdown приложения дожидается апдейтов, ещё висящих в обработке
+    await runner.cleanup()
+    total = time.perf_counter() - t0
+
+    n = len(acks)
+    print(f"updates: {n}  posted in {posted:.2f}s  fully handled in {total:.2f}s  ({n / total:.0f} upd/s)")
+    print(f"ack latency: p50 {percentile(acks, .5) * 1e3:.2f} ms  p99 {percentile(acks, .99) * 1e3:.2f} ms")
+    print(f"Bot API calls: {len(bot.bot.session.calls)}")
+
+
+def bench_webhook(args):
+    asyncio.run(_bench_webhook(args))
+
+
+BENCHES = {
+    "cache": bench_cache,
+    "callbacks": bench_callbacks,
+    "dedup": bench_dedup,
+    "deposits": bench_deposits,
+    "ids": bench_ids,
+    "keyboards": bench_keyboards,
+    "load": bench_load,
+    "metrics": bench_metrics,
+    "outbox": bench_outbox,
+    "rates": bench_rates,
+    "render": bench_render,
+    "sessions": bench_sessions,
+    "shards": bench_shards,
+    "startup": bench_startup,
+    "throttle": bench_throttle,
+    "verify": bench_verify,
+    "webhook": bench_webhook,
+}
+
+
+def main():
+    p = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    p.add_argument("bench", choices=sorted(BENCHES))
+    p.add_argument("-n", type=int, default=2000, help="итераций на замер")
+    p.add_argument("--users", type=int, default=200, help="сколько синтетических юзеров гонять через флоу")
+    p.add_argument("--updates", help="jsonl с записанными апдейтами (по одному Update на строку)")
+    p.add_argument("--concurrency", type=int, default=50, help="load: сколько юзеров обрабатываются одновременно")
+    p.add_argument("--as-tasks", action="store_true",
+                   help="load: все апдейты сразу задачами вперемешку (как polling), порядок держит бот")
+    p.add_argument("--cache-sizes", default="1000,10000,100000", help="cache: размеры SESSION_CACHE_SIZE")
+    p.add_argument("--digest", action="store_true", help="load: ADMIN_DIGEST=1, подтверждение пачками")
+    p.add_argument("--state-sizes", default="1000,10000,100000,1000000",
+                   help="load: размеры USER для замера стоимости save_state (пусто — пропустить)")
+    p.add_argument("--proofs", type=int, default=100_000, help="dedup: сколько TXID/чеков уже в индексе")
+    p.add_argument("--workers", default="1,2,4", help="shards: сколько процессов-воркеров")
+    p.add_argument("--global-rate", type=float, default=400, help="shards: общий лимит исходящих в сек")
+    p.add_argument("--chat-rate", type=float, default=100, help="shards: лимит в один чат (в т.ч. админа) в сек")
+    p.add_argument("--scale", type=float, default=50, help="outbox: во сколько раз ускорить лимиты Telegram")
+    p.add_argument("--flood-p", type=float, default=0.02, help="outbox: доля случайных 429 от fake API")
+    p.add_argument("--error-p", type=float, default=0.01, help="outbox: доля 5xx от fake API")
+    p.add_argument("--save", help="load: сохранить результат в json (baseline для --gate)")
+    p.add_argument("--gate", help="load: сравнить с baseline json, код выхода 1 при регрессии")
+    p.add_argument("--tolerance", type=float, default=0.25, help="load: допустимое ухудшение для --gate")
+    args = p.parse_args()
+    sys.exit(BENCHES[args.bench](args) or 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,14 +1,42 @@
 import asyncio
+import bisect
+import contextvars
+import cProfile
+import io
+import pstats
+import hashlib
+import heapq
 import json
+import math
+import mmap
+import multiprocessing
 import os
+import queue
+import signal
+import sqlite3
+import string
+import threading
+import time
+import tracemalloc
+from collections import OrderedDict
 from datetime import datetime
-from typing import Any
+from decimal import Decimal
+from types import MappingProxyType
+from typing import Any, Awaitable, Callable, Mapping, NamedTuple
 
-from aiogram import Bot, Dispatcher, F
+from aiogram import BaseMiddleware, Bot, Dispatcher
+from aiogram.dispatcher.event.bases import UNHANDLED
 from aiogram.filters import Command
-from aiogram.types import Message, CallbackQuery
+from aiogram.types import (BufferedInputFile, Message, CallbackQuery, InlineKeyboardMarkup, InlineKeyboardButton,
+                           TelegramObject, Update, User)
 from aiogram.utils.keyboard import InlineKeyboardBuilder
-from aiogram.exceptions import TelegramBadRequest
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
+from aiogram.client.telegram import TelegramAPIServer
+from aiogram.exceptions import TelegramBadRequest, TelegramRetryAfter, TelegramServerError
+from aiogram.methods import EditMessageText, SendMessage, TelegramMethod
+from aiogram.webhook.aiohttp_server import setup_application
+from aiohttp import ClientSession, ClientTimeout, TCPConnector, web
 
 # =====================
 # CONFIG
@@ -22,17 +50,112 @@ ADMIN_ID_ENV = os.getenv("ADMIN_ID", "").strip()
 
 ADMIN_FILE = "admin.json"
 STATE_FILE = "state.json"
+STATE_JOURNAL = "state.journal"
+ORDERS_FILE = "orders.json"
+ORDERS_JOURNAL = "orders.journal"
+ORDERS_BY_USER_FILE = "orders_by_user.json"
+ORDERS_BY_USER_JOURNAL = "orders_by_user.journal"
+DEPOSITS_FILE = "deposits.json"
+DEPOSITS_JOURNAL = "deposits.journal"
+PROOFS_FILE = "proofs.json"
+PROOFS_JOURNAL = "proofs.journal"
+
+# Хранилище сессий и заявок: json (state.json + журнал) или sqlite (STATE_DB)
+STORAGE_BACKEND = os.getenv("STORAGE", "json").strip().lower()
+STATE_DB = os.getenv("STATE_DB", "state.db")
+
+# Фоновая запись state.json: интервал (сек) и порог грязных сессий для досрочного сброса
+STATE_FLUSH_INTERVAL = float(os.getenv("STATE_FLUSH_INTERVAL", "2"))
+STATE_FLUSH_THRESHOLD = int(os.getenv("STATE_FLUSH_THRESHOLD", "500"))
+# После скольких строк журнала сворачивать его в снапшот state.json
+STATE_COMPACT_LINES = int(os.getenv("STATE_COMPACT_LINES", "20000"))
+
+# Сколько сессий держать в памяти (LRU) и через сколько секунд простоя выгружать (0 — не выгружать)
+SESSION_CACHE_SIZE = int(os.getenv("SESSION_CACHE_SIZE", "100000"))
+SESSION_TTL = float(os.getenv("SESSION_TTL", "3600"))
+
+# Флуд-контроль: ведро токенов на юзера (апдейтов/сек и запас), лишнее ждёт не дольше
+# THROTTLE_MAX_WAIT, потом отбрасывается с одним "не так быстро" раз в THROTTLE_NOTICE_INTERVAL.
+# При перегрузке (апдейтов в обработке >= THROTTLE_INFLIGHT или лаг loop'а > THROTTLE_LAG_MS)
+# сбрасываются неважные апдейты: меню и навигация; оплата и админ проходят всегда. 0 — выключено.
+THROTTLE_RATE = float(os.getenv("THROTTLE_RATE", "5"))
+THROTTLE_BURST = float(os.getenv("THROTTLE_BURST", "15"))
+THROTTLE_MAX_WAIT = float(os.getenv("THROTTLE_MAX_WAIT", "1"))
+THROTTLE_NOTICE_INTERVAL = float(os.getenv("THROTTLE_NOTICE_INTERVAL", "10"))
+THROTTLE_INFLIGHT = int(os.getenv("THROTTLE_INFLIGHT", "1000"))
+THROTTLE_LAG_MS = float(os.getenv("THROTTLE_LAG_MS", "250"))
+
+# Сколько последних сообщений бота помнить (текст+клавиатура), чтобы не слать пустые правки
+RENDER_CACHE_SIZE = int(os.getenv("RENDER_CACHE_SIZE", "20000"))
+
+# Режим: polling (по умолчанию) или webhook — aiohttp-сервер, куда Telegram сам шлёт апдейты.
+# На Render WEBHOOK_BASE_URL берётся из RENDER_EXTERNAL_URL, порт — из PORT.
+BOT_MODE = os.getenv("BOT_MODE", "polling").strip().lower()
+WEBHOOK_BASE_URL = os.getenv("WEBHOOK_BASE_URL", os.getenv("RENDER_EXTERNAL_URL", "")).strip().rstrip("/")
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/webhook")
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET", "").strip()
+WEB_HOST = os.getenv("WEB_HOST", "0.0.0.0")
+WEB_PORT = int(os.getenv("PORT", "8080"))
+
+# Сколько апдейтов (разных юзеров) обрабатывается одновременно; апдейты одного юзера — всегда по очереди
+UPDATE_CONCURRENCY = int(os.getenv("UPDATE_CONCURRENCY", "100"))
+
+# WORKERS > 0: один процесс принимает апдейты (polling/webhook), обрабатывают их WORKERS
+# процессов, шардированных по from_user.id. Нужен STORAGE=sqlite и ADMIN_ID в ENV.
+WORKERS = int(os.getenv("WORKERS", "0"))
+# Свой Bot API сервер (telegram-bot-api) или локальная заглушка, например http://127.0.0.1:8081
+TELEGRAM_API_URL = os.getenv("TELEGRAM_API_URL", "").strip().rstrip("/")
+
+# Лимиты исходящих (Telegram: ~30 сообщений/сек на бота, ~1/сек в один чат)
+OUTBOX_GLOBAL_RATE = float(os.getenv("OUTBOX_GLOBAL_RATE", "25"))
+OUTBOX_GLOBAL_BURST = float(os.getenv("OUTBOX_GLOBAL_BURST", "5"))
+OUTBOX_CHAT_RATE = float(os.getenv("OUTBOX_CHAT_RATE", "1"))
+OUTBOX_CHAT_BURST = float(os.getenv("OUTBOX_CHAT_BURST", "3"))
+OUTBOX_MAX_RETRIES = int(os.getenv("OUTBOX_MAX_RETRIES", "5"))
+OUTBOX_BACKOFF = float(os.getenv("OUTBOX_BACKOFF", "0.5"))
+
+# Prometheus /metrics на отдельном локальном порту (0 — выключено)
+METRICS_PORT = int(os.getenv("METRICS_PORT", "0"))
+METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1")
+
+# Апдейты дольше SLOW_UPDATE_MS логируются с разбивкой по времени (0 — не логировать)
+SLOW_UPDATE_MS = float(os.getenv("SLOW_UPDATE_MS", "500"))
+# /profile: максимум секунд захвата и сколько строк отчёта отдавать
+PROFILE_MAX_SECONDS = int(os.getenv("PROFILE_MAX_SECONDS", "300"))
+PROFILE_TOP = int(os.getenv("PROFILE_TOP", "60"))
+
+# Дайджест для админа: вместо сообщения на каждую заявку — одно сообщение со списком
+# открытых заявок, обновляется не чаще раза в ADMIN_DIGEST_INTERVAL сек
+ADMIN_DIGEST = os.getenv("ADMIN_DIGEST", "0").strip().lower() in ("1", "true", "yes")
+ADMIN_DIGEST_INTERVAL = float(os.getenv("ADMIN_DIGEST_INTERVAL", "30"))
 
 ADMIN_USERNAME = "@BenBell97"
 SUPPORT_URL = "https://t.me/BenBell97"
 
+# Языки. Чтобы добавить третий: ключ здесь + перевод в MESSAGES, WORK_HOURS_TEXT и AFTER_HOURS_NOTE
+LANG_NAMES = {"ru": "🇷🇺 Русский", "en": "🇬🇧 English"}
+LANGS = tuple(LANG_NAMES)
+FALLBACK_LANG = "en"
+
 # Часы работы (МСК)
-WORK_HOURS_TEXT_RU = "🕒 Работаем: 10:30–01:00 (МСК)"
-WORK_HOURS_TEXT_EN = "🕒 Working hours: 10:30–01:00 (MSK)"
-AFTER_HOURS_NOTE_RU = "⚠️ Если оплата отправлена вне 10:30–01:00 (МСК), платёж будет обработан на следующий день."
-AFTER_HOURS_NOTE_EN = "⚠️ If payment is sent outside 10:30–01:00 (MSK), it will be processed the next day."
+WORK_HOURS_TEXT = {
+    "ru": "🕒 Работаем: 10:30–01:00 (МСК)",
+    "en": "🕒 Working hours: 10:30–01:00 (MSK)",
+}
+AFTER_HOURS_NOTE = {
+    "ru": "⚠️ Если оплата отправлена вне 10:30–01:00 (МСК), платёж будет обработан на следующий день.",
+    "en": "⚠️ If payment is sent outside 10:30–01:00 (MSK), it will be processed the next day.",
+}
+
+USD_TO_RUB = float(os.getenv("USD_TO_RUB", "90"))   # стартовый курс; с RATES_SOURCE дальше обновляется
 
-USD_TO_RUB = 90
+# Живые курсы: источники через запятую — cbr (USD→RUB ЦБ), coingecko (BTC/ETH в USD), file (RATES_FILE,
+# {"RUB": 92.5, "BTC": 65000, ...} — локальная замена для тестов). Пусто — курсы из конфига.
+RATES_SOURCE = [x.strip() for x in os.getenv("RATES_SOURCE", "").split(",") if x.strip()]
+RATES_TTL = float(os.getenv("RATES_TTL", "3600"))
+RATES_FILE = os.getenv("RATES_FILE", "rates.json")
+CBR_URL = os.getenv("CBR_URL", "https://www.cbr-xml-daily.ru/daily_json.js")
+COINGECKO_URL = os.getenv("COINGECKO_URL", "https://api.coingecko.com/api/v3/simple/price")
 
 # Подписки (USD) + оригинальная цена для отображения скидки
 SUB_PRICES_USD     = {1: 29,  3: 78,  6: 139, 12: 209}
@@ -54,6 +177,258 @@ CRYPTO_ADDR = {
     "ETH": "0xA873EA0F3872338E02f1131a32862bd714D2fACe",
 }
 
+# Уникальный адрес на заявку: файл пула, строки "COIN адрес" (# — комментарий). Пусто — всем
+# общий CRYPTO_ADDR. Файл перечитывается, когда свободных адресов монеты меньше DEPOSIT_POOL_LOW.
+DEPOSIT_POOL_FILE = os.getenv("DEPOSIT_POOL_FILE", "").strip()
+DEPOSIT_POOL_LOW = int(os.getenv("DEPOSIT_POOL_LOW", "20"))
+DEPOSIT_LEASE = float(os.getenv("DEPOSIT_LEASE", str(24 * 3600)))         # адрес за заявкой, пока ждём оплату
+DEPOSIT_COOLDOWN = float(os.getenv("DEPOSIT_COOLDOWN", str(7 * 86400)))   # после — ещё помним, чей он (поздние платежи)
+DEPOSIT_SWEEP_INTERVAL = float(os.getenv("DEPOSIT_SWEEP_INTERVAL", "60"))
+
+# Автопроверка TXID по блокчейн-эксплорерам (TXID_VERIFY=1). Курс BTC/ETH к USD нужен, чтобы
+# сверить сумму; без курса транзакция проверяется по адресу и подтверждениям, а решает админ.
+TXID_VERIFY = os.getenv("TXID_VERIFY", "0").strip().lower() in ("1", "true", "yes")
+CRYPTO_USD_RATES = {k.strip(): Decimal(v) for k, v in
+                    (p.split("=", 1) for p in os.getenv("CRYPTO_USD_RATES", "").split(",") if "=" in p)}
+VERIFY_CONFIRMATIONS = {"USDT_TRC20": 1, "BTC": 2, "ETH": 12}
+VERIFY_AMOUNT_TOLERANCE = Decimal(os.getenv("VERIFY_AMOUNT_TOLERANCE", "0.01"))  # недоплата в пределах 1% — ок
+VERIFY_INTERVAL = float(os.getenv("VERIFY_INTERVAL", "30"))          # первая проверка, дальше backoff x2
+VERIFY_MAX_INTERVAL = float(os.getenv("VERIFY_MAX_INTERVAL", "600"))
+VERIFY_GIVE_UP = float(os.getenv("VERIFY_GIVE_UP", str(6 * 3600)))   # не нашли за столько — к админу
+VERIFY_POOL = int(os.getenv("VERIFY_POOL", "8"))                     # соединений к эксплорерам
+TRONGRID_URL = os.getenv("TRONGRID_URL", "https://api.trongrid.io").rstrip("/")
+TRONGRID_API_KEY = os.getenv("TRONGRID_API_KEY", "")
+ESPLORA_URL = os.getenv("ESPLORA_URL", "https://blockstream.info/api").rstrip("/")
+ETHERSCAN_URL = os.getenv("ETHERSCAN_URL", "https://api.etherscan.io/api").rstrip("/")
+ETHERSCAN_API_KEY = os.getenv("ETHERSCAN_API_KEY", "")
+
+# =====================
+# TEXTS (i18n)
+# =====================
+# Каталог сообщений: id -> {lang: шаблон}. Слоты {…} из CONFIG (реквизиты, часы работы) и ссылки
+# на другие постоянные сообщения подставляются один раз в compile_messages(), в хендлере
+# заполняются только переменные (суммы, email, order_id). Нет перевода — берётся FALLBACK_LANG.
+MESSAGES: dict[str, dict[str, str]] = {
+    # --- общее
+    "choose_language": {"ru": "Выберите язык / Choose language"},
+    "main_menu": {"ru": "Главное меню\n\n{work_hours}", "en": "Main menu\n\n{work_hours}"},
+    "cancelled": {"ru": "✅ Отменено.\n\n{main_menu}", "en": "✅ Cancelled.\n\n{main_menu}"},
+    "slow_down": {"ru": "⏳ Слишком часто. Подождите пару секунд.", "en": "⏳ Too fast. Please wait a couple of seconds."},
+    "open_menu": {"ru": "Откройте меню ниже 👇\n{work_hours}", "en": "Open the menu below 👇\n{work_hours}"},
+    "support": {"ru": "Поддержка: {admin_username}\n{work_hours}", "en": "Support: {admin_username}\n{work_hours}"},
+    "admin_not_set": {"ru": "❗ Админ не привязан. Админ должен написать /admin.",
+                      "en": "❗ Admin is not set. Admin must send /admin."},
+    "choose_sub": {"ru": "Выберите вариант подписки", "en": "Choose subscription option"},
+    "choose_topup": {"ru": "Выберите сумму пополнения", "en": "Choose top up amount"},
+    "choose_pay": {"ru": "Выберите способ оплаты", "en": "Choose payment method"},
+    "custom_sent": {"ru": "✅ Заявка на Custom отправлена.", "en": "✅ Custom request sent."},
+
+    # --- подписка / пополнение
+    "sub_disc_note": {"ru": " (скидка {discount}%)", "en": " ({discount}% off)"},
+    "sub_summary": {
+        "ru": "💳 Подписка: {months} мес.{disc}\nСумма: {rub} ₽  |  ${usd}\n\nВыберите способ оплаты:",
+        "en": "💳 Subscription: {months} mo.{disc}\nAmount: ${usd}  |  {rub} RUB\n\nChoose payment method:",
+    },
+    "topup_ask_email": {
+        "ru": "Пополнение: ${usd} | {rub} ₽\n\nТеперь отправьте почту от аккаунта одним сообщением.",
+        "en": "Top up: ${usd} | {rub} RUB\n\nNow send your account email in one message.",
+    },
+    "email_saved": {
+        "ru": "✅ Почта сохранена: {email}\nПополнение: ${usd}  |  {rub} ₽\n\nВыберите способ оплаты:",
+        "en": "✅ Email saved: {email}\nTop up: ${usd}  |  {rub} RUB\n\nChoose payment method:",
+    },
+    "email_invalid": {"ru": "Пришлите корректную почту (email).", "en": "Send a valid email."},
+    "need_email": {"ru": "Сначала укажите email.", "en": "Enter email first."},
+    "need_period": {"ru": "Сначала выберите срок подписки.", "en": "Choose period first."},
+
+    # --- оплата
+    "sbp_details": {
+        "ru": "Банк: {sbp_bank}\nПолучатель: {sbp_receiver}\nНомер/телефон: {sbp_to}\n\n"
+              "После оплаты пришлите сюда ЧЕК/СКРИН (как фото или файл).",
+        "en": "Bank: {sbp_bank}\nReceiver: {sbp_receiver}\nPhone/card: {sbp_to}\n\n"
+              "After payment, send RECEIPT/SCREENSHOT here (photo or file).",
+    },
+    "sbp_topup": {
+        "ru": "🏦 СБП/перевод\n\nПополнение: ${usd} | {rub} ₽\nEmail: {email}\n\n{sbp_details}",
+        "en": "🏦 SBP transfer\n\nTop up: ${usd} | {rub} RUB\nEmail: {email}\n\n{sbp_details}",
+    },
+    "sbp_sub": {
+        "ru": "🏦 СБП/перевод\n\nПодписка: {months} мес.\nСумма: {rub} ₽  |  ${usd}\n\n{sbp_details}",
+        "en": "🏦 SBP transfer\n\nSubscription: {months} mo.\nAmount: ${usd}  |  {rub} RUB\n\n{sbp_details}",
+    },
+    "topup_choose_coin": {
+        "ru": "Пополнение: ${usd} | {rub} ₽\nEmail: {email}\n\nВыберите монету:",
+        "en": "Top up: ${usd} | {rub} RUB\nEmail: {email}\n\nChoose coin:",
+    },
+    "sub_choose_coin": {
+        "ru": "Подписка: {months} мес.\nСумма: {rub} ₽  |  ${usd}\n\nВыберите монету:",
+        "en": "Subscription: {months} mo.\nAmount: ${usd}  |  {rub} RUB\n\nChoose coin:",
+    },
+    "crypto_head_sub": {
+        "ru": "Подписка: {months} мес.\nСумма: {rub} ₽  |  ${usd}\nМонета: {coin}",
+        "en": "Subscription: {months} mo.\nAmount: ${usd}  |  {rub} RUB\nCoin: {coin}",
+    },
+    "crypto_head_topup": {
+        "ru": "Пополнение: ${usd}  |  {rub} ₽\nEmail: {email}\nМонета: {coin}",
+        "en": "Top up: ${usd}  |  {rub} RUB\nEmail: {email}\nCoin: {coin}",
+    },
+    "crypto_due": {"ru": "К оплате: {amount} {coin}", "en": "Amount due: {amount} {coin}"},
+    "crypto_pay": {
+        "ru": "₿ Crypto оплата\n\n{head}\n\nАдрес для оплаты:\n{address}\n\n"
+              "После оплаты отправьте сюда txid / hash одним сообщением.",
+        "en": "₿ Crypto payment\n\n{head}\n\nPayment address:\n{address}\n\n"
+              "After payment, send txid / hash here in one message.",
+    },
+    "txid_ask": {"ru": "Пришлите txid/hash одним сообщением.", "en": "Send txid/hash in one message."},
+    "txid_received": {"ru": "✅ Данные получены. Ожидайте подтверждения.\n\n{after_hours}",
+                      "en": "✅ Data received. Please wait for confirmation.\n\n{after_hours}"},
+    "txid_duplicate": {"ru": "⚠️ Этот TXID уже был отправлен по другой заявке. Пришлите TXID именно этой оплаты.",
+                       "en": "⚠️ This TXID was already submitted for another order. Send the TXID of this payment."},
+    "receipt_duplicate": {"ru": "⚠️ Этот чек уже был отправлен по другой заявке. Пришлите чек именно этой оплаты.",
+                          "en": "⚠️ This receipt was already submitted for another order. Send the receipt for this payment."},
+    "receipt_ask": {"ru": "Пришлите чек как ФОТО или ФАЙЛ (document).", "en": "Send receipt as PHOTO or FILE (document)."},
+    "receipt_received": {"ru": "✅ Чек получен. Ожидайте подтверждения.\n\n{after_hours}",
+                         "en": "✅ Receipt received. Please wait for confirmation.\n\n{after_hours}"},
+
+    # --- ответы юзеру после решения админа
+    "approved_sub": {"ru": "✅ Подписка активна на {months} мес.\nСпасибо за оплату!"},
+    "approved_topup": {"ru": "✅ Платёж подтверждён. Баланс пополнен на ${usd}.\nСпасибо!"},
+    "rejected": {"ru": "❌ Платёж отклонён. Напишите в поддержку: {admin_username}"},
+
+    # --- админ
+    "admin_env_bound": {"ru": "✅ ADMIN_ID задан через Environment. Привязка /admin не требуется."},
+    "admin_bound": {"ru": "✅ Админ привязан. Теперь заявки будут приходить сюда."},
+    "not_allowed": {"ru": "Not allowed"},
+    "order_not_found": {"ru": "Заявка не найдена/уже обработана"},
+    "order_approved": {"ru": "✅ Подтверждено: {order_id}"},
+    "order_rejected": {"ru": "❌ Отклонено: {order_id}"},
+    "orders_header": {"ru": "📋 Открытые заявки:\n\n{lines}"},
+    "orders_none": {"ru": "Открытых заявок нет."},
+    "orders_no_more": {"ru": "Открытых заявок больше нет."},
+    "orders_user_none": {"ru": "У юзера нет заявок."},
+    "digest_header": {"ru": "📋 Дайджест заявок (старые сверху), {time}\n\n{lines}\n\n"
+                            "Отметьте номера кнопками ниже и подтвердите/отклоните пачкой."},
+    "digest_empty": {"ru": "📋 Открытых заявок нет. {time}"},
+    "digest_nothing_selected": {"ru": "Ничего не выбрано"},
+    "digest_settled": {"ru": "Готово: {n}"},
+    "digest_stale": {"ru": "Дайджест устарел — обновил, проверьте страницу ещё раз"},
+    "cache_stats": {"ru": "🧠 Сессии в памяти: {resident} из {size}\nПопадания: {hits} | Промахи: {misses} ({hit_rate}%)\n"
+                          "Вытеснено: {evictions} | Ждут записи: {pending_writeback}"},
+    "queue_stats": {"ru": "📤 Очередь отправки\nЖдут (юзеры / админ): {queued_user} / {queued_admin}\n"
+                          "Ждут лимита чата: {chat_waiting}\nВ фоне: {background}\n"
+                          "Отправлено: {sent} | Повторов: {retried} | Ошибок: {failed}"},
+    "deposit_pool_low": {"ru": "⚠️ Заканчиваются адреса {coin}: свободно {free}. Допишите новые в {path}."},
+    "admin_duplicate": {"ru": "🚩 Повторный {proof} от {user}\nЗаявка {order_id} не создана: он уже предъявлен "
+                              "по заявке {owner} (юзер {owner_uid})."},
+    "verify_approved": {"ru": "🤖 Автоподтверждено по блокчейну:\n{lines}"},
+    "verify_flagged": {"ru": "⚠️ Автопроверка TXID не прошла: {order_id}\nTXID: {txid}\n{reason}\nРешение за вами."},
+    "verify_timeout": {"ru": "⏳ TXID не найден в сети за {hours} ч: {order_id}\nTXID: {txid}\nПроверьте вручную."},
+    "profile_usage": {"ru": "Использование: /profile cpu|mem [секунд, 1–{max}]"},
+    "profile_busy": {"ru": "Профилирование уже идёт"},
+    "profile_started": {"ru": "⏱ Профилирую ({mode}) {seconds} сек, отчёт придёт файлом"},
+    "profile_done": {"ru": "Профиль {mode} за {seconds} сек"},
+    "admin_custom": {"ru": "🟣 CUSTOM REQUEST\nTime: {time}\nOrder: {order_id}\nUser: {user}\n"},
+    "admin_crypto_sub": {"ru": "🟢 PAYMENT (CRYPTO) — SUBSCRIPTION\nTime: {time}\nOrder: {order_id}\nUser: {user}\n"
+                               "Subscription: {months} months\nAmount: ${usd} | {rub} RUB\nCoin: {coin}\nTXID: {txid}\n"},
+    "admin_crypto_topup": {"ru": "🟢 PAYMENT (CRYPTO) — TOPUP\nTime: {time}\nOrder: {order_id}\nUser: {user}\n"
+                                 "Email: {email}\nTopup: ${usd} | {rub} RUB\nCoin: {coin}\nTXID: {txid}\n"},
+    "admin_sbp_sub": {"ru": "🟠 PAYMENT (SBP) — SUBSCRIPTION\nTime: {time}\nOrder: {order_id}\nUser: {user}\n"
+                            "Subscription: {months} months\nAmount: ${usd} | {rub} RUB\n"},
+    "admin_sbp_topup": {"ru": "🟠 PAYMENT (SBP) — TOPUP\nTime: {time}\nOrder: {order_id}\nUser: {user}\n"
+                              "Email: {email}\nTopup: ${usd} | {rub} RUB\n"},
+
+    # --- кнопки
+    "btn_buy_sub": {"ru": "💳 Купить подписку", "en": "💳 Buy subscription"},
+    "btn_topup": {"ru": "💰 Пополнить баланс", "en": "💰 Top up balance"},
+    "btn_support": {"ru": "🆘 Поддержка", "en": "🆘 Support"},
+    "btn_contact_support": {"ru": "💬 Написать в поддержку", "en": "💬 Contact support"},
+    "btn_home": {"ru": "🏠 В начало", "en": "🏠 Home"},
+    "btn_cancel": {"ru": "❌ Отменить", "en": "❌ Cancel"},
+    "btn_back": {"ru": "⬅️ Назад", "en": "⬅️ Back"},
+    "btn_sbp": {"ru": "🏦 СБП / Карта РФ", "en": "🏦 SBP / RU card"},
+    "btn_crypto": {"ru": "₿ Crypto"},
+    "btn_custom": {"ru": "⚡ Custom"},
+    "btn_topup_amount": {"ru": "${usd} | {rub} ₽", "en": "${usd} | {rub} RUB"},
+    "btn_approve": {"ru": "✅ Подтвердить"},
+    "btn_reject": {"ru": "❌ Отклонить"},
+    "btn_next": {"ru": "Далее ▶"},
+    "btn_dg_approve_sel": {"ru": "✅ Выбранные ({n})"},
+    "btn_dg_reject_sel": {"ru": "❌ Выбранные ({n})"},
+    "btn_dg_approve_page": {"ru": "✅ Всю страницу"},
+    "btn_dg_refresh": {"ru": "🔄"},
+    "sub_title_1": {"ru": "1 месяц", "en": "1 month"},
+    "sub_title_12": {"ru": "Год", "en": "1 year"},
+    "sub_title_n": {"ru": "{months} месяца", "en": "{months} months"},
+    "sub_label_disc": {"ru": " 🔥 −{discount}%"},
+    "sub_label": {"ru": "{title}{disc} — {rub} ₽ (${usd})", "en": "{title}{disc} — ${usd} ({rub} RUB)"},
+}
+
+def _static_slots(lang: str) -> dict[str, Any]:
+    # значения из CONFIG, которые не меняются от запроса к запросу
+    return {
+        "work_hours": WORK_HOURS_TEXT.get(lang, WORK_HOURS_TEXT[FALLBACK_LANG]),
+        "after_hours": AFTER_HOURS_NOTE.get(lang, AFTER_HOURS_NOTE[FALLBACK_LANG]),
+        "admin_username": ADMIN_USERNAME,
+        "sbp_bank": SBP_BANK,
+        "sbp_receiver": SBP_RECEIVER,
+        "sbp_to": SBP_TO,
+    }
+
+_FORMATTER = string.Formatter()
+
+def _escape_braces(s: str) -> str:
+    return s.replace("{", "{{").replace("}", "}}")
+
+def _compile_message(msg_id: str, lang: str, static: dict[str, Any], done: dict[tuple[str, str], tuple[str, bool]]):
+    key = (msg_id, lang)
+    if key in done:
+        return done[key]
+    variants = MESSAGES[msg_id]
+    tpl = variants.get(lang) or variants.get(FALLBACK_LANG) or next(iter(variants.values()))
+    out = []
+    dynamic = False
+    for literal, field, spec, conv in _FORMATTER.parse(tpl):
+        out.append(_escape_braces(literal))
+        if field is None:
+            continue
+        value = None
+        if not spec and not conv:
+            if field in static:
+                value = str(static[field])
+            elif field in MESSAGES and field != msg_id:
+                sub, sub_dynamic = _compile_message(field, lang, static, done)
+                if not sub_dynamic:
+                    value = sub
+        if value is None:
+            dynamic = True
+            out.append("{" + field + (f"!{conv}" if conv else "") + (f":{spec}" if spec else "") + "}")
+        else:
+            out.append(_escape_braces(value))
+    compiled = "".join(out)
+    # постоянное сообщение храним уже готовой строкой, без format() на каждый запрос
+    done[key] = (compiled, True) if dynamic else (compiled.format(), False)
+    return done[key]
+
+CATALOG: Mapping[tuple[str, str], tuple[str, bool]] = MappingProxyType({})
+
+def compile_messages():
+    global CATALOG
+    done: dict[tuple[str, str], tuple[str, bool]] = {}
+    for lang in LANGS:
+        static = _static_slots(lang)
+        for msg_id in MESSAGES:
+            _compile_message(msg_id, lang, static, done)
+    CATALOG = MappingProxyType(done)
+
+compile_messages()
+
+def norm_lang(lang: str) -> str:
+    return lang if lang in LANG_NAMES else FALLBACK_LANG
+
+def t(msg_id: str, lang: str, **slots) -> str:
+    tpl, dynamic = CATALOG[msg_id, norm_lang(lang)]
+    return tpl.format_map(slots) if dynamic else tpl
+
 # =====================
 # VALIDATION HELPERS
 # =====================
@@ -65,27 +440,102 @@ def is_txid(s: str) -> bool:
     s = (s or "").strip()
     return len(s) >= 8 and " " not in s
 
-def usd_to_rub_rounded(usd: int) -> int:
-    rub = usd * USD_TO_RUB
+def usd_to_rub_rounded(usd: int, rate: float | None = None) -> int:
+    rub = usd * (USD_TO_RUB if rate is None else rate)
     return int(round(rub / 10.0) * 10)
 
-SUB_PRICES = {
-    m: {
-        "usd":      SUB_PRICES_USD[m],
-        "rub":      usd_to_rub_rounded(SUB_PRICES_USD[m]),
-        "usd_orig": SUB_PRICES_ORIG[m],
-        "rub_orig": usd_to_rub_rounded(SUB_PRICES_ORIG[m]),
-        "discount": SUB_DISCOUNTS[m],
+class PriceTable(NamedTuple):
+    rate: float
+    sub: Mapping[int, dict]
+    topup: Mapping[int, dict]
+
+def build_price_table(rate: float) -> PriceTable:
+    sub = {
+        m: {
+            "usd":      SUB_PRICES_USD[m],
+            "rub":      usd_to_rub_rounded(SUB_PRICES_USD[m], rate),
+            "usd_orig": SUB_PRICES_ORIG[m],
+            "rub_orig": usd_to_rub_rounded(SUB_PRICES_ORIG[m], rate),
+            "discount": SUB_DISCOUNTS[m],
+        }
+        for m in SUB_PRICES_USD
     }
-    for m in SUB_PRICES_USD
-}
-TOPUP_PRICES = {usd: {"usd": usd, "rub": usd_to_rub_rounded(usd)} for usd in TOPUP_AMOUNTS_USD}
+    topup = {usd: {"usd": usd, "rub": usd_to_rub_rounded(usd, rate)} for usd in TOPUP_AMOUNTS_USD}
+    return PriceTable(rate, MappingProxyType(sub), MappingProxyType(topup))
+
+# Текущие цены. Меняются только целиком (apply_rates), хендлеры читают готовые значения.
+PRICES = build_price_table(USD_TO_RUB)
+# таблицы по курсам, которые ещё могут числиться за сессиями (цена фиксируется при показе)
+_PRICE_HISTORY: OrderedDict[float, PriceTable] = OrderedDict({PRICES.rate: PRICES})
+
+def prices_at(rate: float | None) -> PriceTable:
+    if rate is None or rate == PRICES.rate:
+        return PRICES
+    table = _PRICE_HISTORY.get(rate)
+    if table is None:
+        # курс старше истории (сессия пролежала много обновлений) — собираем один раз заново
+        table = _PRICE_HISTORY[rate] = build_price_table(rate)
+        if len(_PRICE_HISTORY) > 32:
+            _PRICE_HISTORY.popitem(last=False)
+    return table
 
 def now_str() -> str:
     return datetime.now().strftime("%Y-%m-%d %H:%M:%S")
 
-def make_order_id(uid: int) -> str:
-    return f"ORD-{uid}-{int(datetime.now().timestamp())}"
+# Order ID — snowflake: 42 бита миллисекунд от ORDER_EPOCH_MS | 10 бит узла | 12 бит счётчика,
+# в base32 Crockford фиксированной длины (13 символов). Алфавит идёт по возрастанию ASCII,
+# поэтому строки сравниваются так же, как числа: id сортируются в порядке создания.
+# Уникальность между процессами — за счёт узла: ORDER_NODE_ID из ENV или узел, взятый в аренду
+# у хранилища при старте (pid для этого не годится: в контейнерах он у всех 1),
+# между рестартами — время + observe() самого свежего id из хранилища.
+ORDER_EPOCH_MS = 1_700_000_000_000
+ORDER_ID_LEN = 13
+_B32 = "0123456789ABCDEFGHJKMNPQRSTVWXYZ"
+_B32_INDEX = {c: i for i, c in enumerate(_B32)}
+
+class OrderIds:
+    def __init__(self, node: int):
+        if not 0 <= node < 1024:
+            raise ValueError("ORDER_NODE_ID must be in 0..1023")
+        self.node = node
+        self.last_ms = 0
+        self.seq = 0
+
+    def observe(self, order_id: str | None):
+        # не выдавать id меньше уже выданных, даже если часы ушли назад
+        ms = order_id_ms(order_id) if order_id else None
+        if ms is not None and ms > self.last_ms:
+            self.last_ms, self.seq = ms, 0xFFF
+
+    def next(self) -> str:
+        ms = time.time_ns() // 1_000_000 - ORDER_EPOCH_MS
+        if ms > self.last_ms:
+            self.last_ms, self.seq = ms, 0
+        else:
+            self.seq = (self.seq + 1) & 0xFFF
+            if not self.seq:
+                self.last_ms += 1  # 4096 id за одну мс — занимаем следующую
+        n = self.last_ms << 22 | self.node << 12 | self.seq
+        return "".join(_B32[n >> shift & 31] for shift in range(5 * (ORDER_ID_LEN - 1), -1, -5))
+
+def order_id_ms(order_id: str) -> int | None:
+    """Миллисекунды от ORDER_EPOCH_MS, зашитые в id; None для старых ORD-<uid>-<ts>."""
+    if len(order_id) != ORDER_ID_LEN:
+        return None
+    n = 0
+    for c in order_id:
+        i = _B32_INDEX.get(c)
+        if i is None:
+            return None
+        n = n << 5 | i
+    return n >> 22
+
+ORDER_NODE_ID = os.getenv("ORDER_NODE_ID", "").strip()
+ORDER_NODE_TTL = float(os.getenv("ORDER_NODE_TTL", "3600"))   # аренда узла, продлевается каждую треть срока
+ORDER_IDS = OrderIds(int(ORDER_NODE_ID) if ORDER_NODE_ID else 0)
+
+def make_order_id() -> str:
+    return ORDER_IDS.next()
 
 def format_user(obj: Message | CallbackQuery) -> str:
     u = obj.from_user
@@ -124,65 +574,1123 @@ def save_admin_id(admin_id: int):
 # =====================
 # STATE STORAGE
 # =====================
-def _safe_load_json(path: str, default: Any):
+def _write_json_atomic(path: str, data: Any):
+    # temp-файл + rename: при падении посреди записи старый файл остаётся целым
+    tmp = f"{path}.tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(data, f, ensure_ascii=False, separators=(",", ":"))
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
+
+def _append_lines(path: str, lines: list[str]) -> int:
+    data = "".join(lines).encode("utf-8")
+    with open(path, "ab") as f:
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+    return len(data)
+
+def _json_line(key, rec: dict) -> str:
+    return json.dumps([key, rec], ensure_ascii=False, separators=(",", ":")) + "\n"
+
+def _load_snapshot(path: str, key=int) -> dict:
     if not os.path.exists(path):
-        return default
+        return {}
     try:
         with open(path, "r", encoding="utf-8") as f:
-            return json.load(f)
-    except Exception:
-        return default
-
-def save_state():
-    try:
-        with open(STATE_FILE, "w", encoding="utf-8") as f:
-            json.dump(USER, f, ensure_ascii=False, indent=2)
-    except Exception:
-        pass
-
-def load_state():
-    data = _safe_load_json(STATE_FILE, {})
+            data = json.load(f)
+    except Exception as e:
+        # не теряем данные молча: битый снапшот откладываем в сторону, дальше поднимемся из журнала
+        bad = f"{path}.corrupt-{int(time.time())}"
+        os.replace(path, bad)
+        print(f"⚠️ {path} is corrupted ({e}), moved to {bad}")
+        return {}
+    out = {}
     if isinstance(data, dict):
-        out = {}
         for k, v in data.items():
             try:
-                out[int(k)] = v
+                out[key(k)] = v
             except Exception:
                 continue
-        return out
-    return {}
+    return out
+
+def _replay_journal(path: str, out: dict, key=int) -> int:
+    if not os.path.exists(path):
+        return 0
+    n = 0
+    good_end = 0
+    with open(path, "rb") as f:
+        for line in f:
+            try:
+                k, rec = json.loads(line)
+                out[key(k)] = rec
+                n += 1
+                good_end = f.tell()
+            except Exception:
+                # недописанный хвост после падения — дальше него не читаем
+                break
+    if good_end != os.path.getsize(path):
+        # обрезаем хвост, иначе следующая запись склеится с мусором
+        os.truncate(path, good_end)
+    return n
+
+class _JsonTable:
+    """Снапшот + append-only журнал: одна строка [key, {...}] на изменение, свёртка по STATE_COMPACT_LINES."""
+
+    def __init__(self, snapshot: str, journal: str, key=int):
+        self.snapshot = snapshot
+        self.journal = journal
+        self.rows = _load_snapshot(snapshot, key)
+        self.journal_lines = _replay_journal(journal, self.rows, key)
+
+    def put(self, items: list[tuple[Any, dict]], compact: bool = False) -> int:
+        # O(1) от размера таблицы; возвращает, сколько байт записано на диск
+        written = 0
+        if items:
+            written += _append_lines(self.journal, [_json_line(k, rec) for k, rec in items])
+            for k, rec in items:
+                self.rows[k] = rec
+            self.journal_lines += len(items)
+        if self.journal_lines and (compact or self.journal_lines >= STATE_COMPACT_LINES):
+            try:
+                _write_json_atomic(self.snapshot, self.rows)
+                # снапшот уже содержит всё из журнала; если упадём до обрезки — повторный replay идемпотентен
+                open(self.journal, "w", encoding="utf-8").close()
+                self.journal_lines = 0
+                written += os.path.getsize(self.snapshot)
+            except Exception as e:
+                print(f"⚠️ {self.snapshot} compaction failed: {e}")
+        return written
+
+def _str_key(raw: bytes) -> str:
+    return raw.decode()
+
+class _SortedSnapshotTable:
+    """Сессии: state.json — по строке "uid":[...] на юзера, отсортированных по uid (это всё ещё
+    обычный JSON). Снапшот не грузится целиком: get() ищет строку бинарным поиском по mmap,
+    в памяти только изменения с последней свёртки (журнал). Старт не зависит от размера файла.
+    Снапшот старого формата (одна строка / dict'ы) читается целиком и переписывается при свёртке.
+    key: int (uid, хэш) или str (order_id — без кавычек и экранирования внутри).
+    """
+    HEAD, TAIL = b"{\n", b"\n}\n"
+
+    def __init__(self, snapshot: str, journal: str, key=int):
+        self.snapshot = snapshot
+        self.journal = journal
+        self.rows: dict[Any, Any] = {}
+        self._raw_key = int if key is int else _str_key
+        self._file = None
+        self._mm: mmap.mmap | None = None
+        # старый формат переписываем при первой же свёртке, даже если изменений не было
+        self._rewrite = not self._open_snapshot()
+        if self._rewrite:
+            self.rows = _load_snapshot(snapshot, key)
+        self.journal_lines = _replay_journal(journal, self.rows, key)
+
+    def _open_snapshot(self) -> bool:
+        if not os.path.exists(self.snapshot) or os.path.getsize(self.snapshot) < len(self.HEAD) + 2:
+            return False
+        f = open(self.snapshot, "rb")
+        mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        # первая запись сразу после "{\n" (без отступа) — иначе это старый формат
+        if mm[:2] != self.HEAD or mm[-3:] != self.TAIL or mm[2:3] not in (b'"', b"}"):
+            mm.close()
+            f.close()
+            return False
+        self._file, self._mm = f, mm
+        return True
+
+    def _close_snapshot(self):
+        if self._mm is not None:
+            self._mm.close()
+            self._file.close()
+            self._file = self._mm = None
+
+    def get(self, key):
+        row = self.rows.get(key)
+        if row is not None or self._mm is None:
+            return row
+        # бинарный поиск по строкам: lo/hi всегда стоят на началах строк
+        mm = self._mm
+        lo, hi = len(self.HEAD), len(mm) - len(self.TAIL) + 1
+        while lo < hi:
+            mid = (lo + hi) // 2
+            start = mm.rfind(b"\n", lo - 1, mid) + 1
+            end = mm.find(b"\n", start)
+            quote = mm.find(b'"', start + 1)
+            k = self._raw_key(mm[start + 1:quote])
+            if k == key:
+                return json.loads(mm[quote + 2:end].rstrip(b","))
+            if k < key:
+                lo = end + 1
+            else:
+                hi = start
+        return None
+
+    def last_key(self, below):
+        # наибольший ключ < below (снапшот + журнал) тем же бинарным поиском, что и get()
+        found = max((k for k in self.rows if k < below), default=None)
+        if self._mm is not None:
+            mm = self._mm
+            lo, hi = len(self.HEAD), len(mm) - len(self.TAIL) + 1
+            while lo < hi:
+                mid = (lo + hi) // 2
+                start = mm.rfind(b"\n", lo - 1, mid) + 1
+                end = mm.find(b"\n", start)
+                k = self._raw_key(mm[start + 1:mm.find(b'"', start + 1)])
+                if k < below:
+                    if found is None or k > found:
+                        found = k
+                    lo = end + 1
+                else:
+                    hi = start
+        return found
+
+    def keys(self):
+        # все ключи таблицы (снапшот + журнал), без разбора значений; возможны повторы
+        for k, _ in self._snapshot_lines():
+            yield k
+        yield from list(self.rows)
+
+    def items(self, needle: bytes | None = None):
+        """(key, value) всей таблицы по одной строке за раз. needle: строки снапшота без этой
+        подстроки пропускаются без разбора (поиск по mmap); записи журнала отдаются все."""
+        if self._mm is not None:
+            mm, pos, stop = self._mm, len(self.HEAD), len(self._mm) - len(self.TAIL)
+            while pos < stop:
+                if needle is not None:
+                    hit = mm.find(needle, pos, stop)
+                    if hit < 0:
+                        break
+                    pos = mm.rfind(b"\n", 0, hit) + 1
+                end = mm.find(b"\n", pos)
+                if end < 0 or end > stop:
+                    end = stop
+                quote = mm.find(b'"', pos + 1)
+                k = self._raw_key(mm[pos + 1:quote])
+                if k not in self.rows:
+                    yield k, json.loads(mm[quote + 2:end].rstrip(b","))
+                pos = end + 1
+        yield from list(self.rows.items())
+
+    def _snapshot_lines(self):
+        # (uid, b'"uid":[...]') в порядке файла
+        if self._mm is None:
+            return
+        mm, pos, stop = self._mm, len(self.HEAD), len(self._mm) - len(self.TAIL)
+        while pos < stop:
+            end = mm.find(b"\n", pos)
+            if end < 0 or end > stop:
+                end = stop
+            line = mm[pos:end].rstrip(b",")
+            yield self._raw_key(line[1:line.index(b'"', 1)]), line
+            pos = end + 1
+
+    def _write_snapshot(self):
+        # слияние отсортированного снапшота и отсортированных изменений, старые строки копируются как есть
+        fresh = [(k, json.dumps({str(k): rec}, ensure_ascii=False, separators=(",", ":"))[1:-1].encode())
+                 for k, rec in sorted(self.rows.items())]
+        tmp = f"{self.snapshot}.tmp"
+        with open(tmp, "wb") as f:
+            f.write(self.HEAD)
+            sep = b""
+            old = self._snapshot_lines()
+            cur = next(old, None)
+            for k, line in fresh:
+                while cur is not None and cur[0] < k:
+                    f.write(sep + cur[1])
+                    sep = b",\n"
+                    cur = next(old, None)
+                if cur is not None and cur[0] == k:
+                    cur = next(old, None)
+                f.write(sep + line)
+                sep = b",\n"
+            while cur is not None:
+                f.write(sep + cur[1])
+                sep = b",\n"
+                cur = next(old, None)
+            f.write(self.TAIL if sep else b"}\n")
+            f.flush()
+            os.fsync(f.fileno())
+        self._close_snapshot()
+        os.replace(tmp, self.snapshot)
+        self._open_snapshot()
+
+    def put(self, items: list[tuple[int, Any]], compact: bool = False) -> int:
+        written = 0
+        if items:
+            written += _append_lines(self.journal, [_json_line(k, rec) for k, rec in items])
+            for k, rec in items:
+                self.rows[k] = rec
+            self.journal_lines += len(items)
+        if (self.journal_lines or self._rewrite) and (compact or self.journal_lines >= STATE_COMPACT_LINES):
+            try:
+                self._write_snapshot()
+                open(self.journal, "w", encoding="utf-8").close()
+                self.journal_lines = 0
+                self._rewrite = False
+                self.rows = {}  # всё уже в снапшоте
+                written += os.path.getsize(self.snapshot)
+            except Exception as e:
+                print(f"⚠️ {self.snapshot} compaction failed: {e}")
+                if self._mm is None:
+                    self._open_snapshot()
+        return written
+
+    def close(self):
+        self._close_snapshot()
+
+USER_FIELDS = ("lang", "flow", "step", "sub_months", "topup_usd", "pay_method", "coin", "order_id", "email",
+               "rate", "amount_coin")  # rate: курс USD→RUB, по которому юзеру показали цену;
+# amount_coin: сколько монет показали к оплате при выборе монеты — с этим сверяет автопроверка
+
+# Кодбуки состояний сессии: в памяти и в state.json хранится номер, а не строка.
+# Номера уже лежат на диске — только дописывать в конец, не переставлять.
+LANG_CODES = ("ru", "en")
+FLOW_CODES = (None, "sub", "topup")
+STEP_CODES = (None, "wait_topup_email", "wait_txid", "wait_sbp_receipt", "choose_coin")
+PAY_METHOD_CODES = (None, "sbp", "crypto")
+COIN_CODES = (None, "USDT_TRC20", "BTC", "ETH")
+
+_CODEBOOKS = {"lang": LANG_CODES, "flow": FLOW_CODES, "step": STEP_CODES,
+              "pay_method": PAY_METHOD_CODES, "coin": COIN_CODES}
+_CODE_OF = {field: {v: i for i, v in enumerate(book)} for field, book in _CODEBOOKS.items()}
+if not set(LANGS) <= set(LANG_CODES) or not set(CRYPTO_ADDR) <= set(COIN_CODES):
+    raise RuntimeError("New language/coin must be appended to LANG_CODES/COIN_CODES as well.")
+_ROW_DEFAULTS = tuple(0 if f in _CODEBOOKS else None for f in USER_FIELDS)
+
+class Session:
+    """Сессия юзера: __slots__ + номера из кодбуков вместо dict на 9 строковых ключей.
+
+    Для хендлеров ведёт себя как dict (u["step"], u.get(...), u.update(...)) и отдаёт строки.
+    На диск пишется позиционной строкой в порядке USER_FIELDS без хвостовых значений по умолчанию:
+    новая сессия — [0] вместо 9-ключевого объекта.
+    """
+    __slots__ = USER_FIELDS
+
+    def __init__(self, *row):
+        for field, value in zip(USER_FIELDS, row + _ROW_DEFAULTS[len(row):]):
+            setattr(self, field, value)
+
+    def __getitem__(self, field: str):
+        book = _CODEBOOKS.get(field)
+        return book[getattr(self, field)] if book else getattr(self, field)
+
+    def __setitem__(self, field: str, value):
+        codes = _CODE_OF.get(field)
+        setattr(self, field, codes[value] if codes else value)
+
+    def get(self, field: str, default=None):
+        return self[field] if field in USER_FIELDS else default
+
+    def update(self, values: Mapping[str, Any]):
+        for field, value in values.items():
+            self[field] = value
+
+    def to_row(self) -> list:
+        row = [getattr(self, f) for f in USER_FIELDS]
+        while row and row[-1] == _ROW_DEFAULTS[len(row) - 1]:
+            row.pop()
+        return row
+
+    def to_dict(self) -> dict:
+        return {f: self[f] for f in USER_FIELDS}
+
+    @classmethod
+    def from_record(cls, rec: list | dict) -> "Session":
+        """Строка нового формата или dict из старого state.json (миграция на лету)."""
+        if isinstance(rec, list):
+            return cls(*rec)
+        s = cls()
+        for field in USER_FIELDS:
+            value = rec.get(field)
+            codes = _CODE_OF.get(field)
+            if codes is None:
+                setattr(s, field, value)
+            else:
+                # мусор из старых данных (например, coin из подделанного callback) — в значение по умолчанию
+                setattr(s, field, codes.get(value, 0))
+        return s
+
+ORDERS_PAGE = 10
+
+def make_order(order_id: str, uid: int, u: Session, usd: int, **proof) -> dict:
+    # proof: txid=... или receipt=file_id, receipt_type=photo/document — чтобы заявку можно было проверить без переписки
+    req = {
+        "order_id": order_id,
+        "user_id": uid,
+        "kind": u["flow"],             # sub / topup
+        "status": "pending",           # pending / approved / rejected
+        "created_at": time.time(),
+        "amount_usd": usd,
+        "method": u.get("pay_method"), # sbp / crypto
+        "rate": quoted(u).rate,        # курс USD→RUB, по которому юзеру назвали сумму
+    }
+    if u["flow"] == "sub":
+        req["months"] = u["sub_months"]
+        req["amount_rub"] = quoted(u).sub[u["sub_months"]]["rub"]
+    else:
+        req["amount_rub"] = quoted(u).topup[usd]["rub"]
+        req["usd"] = usd
+        req["email"] = u.get("email")
+    req.update(proof)
+    return req
+
+def quoted(u: Session) -> PriceTable:
+    """Цены по курсу, который юзер видел в начале оплаты."""
+    return prices_at(u.get("rate"))
+
+class JsonStorage:
+    """state.json / orders.json (снапшоты) + журналы изменений. Сессии, заявки и их индекс по юзеру
+    лежат в отсортированных снапшотах и читаются с диска по ключу; в памяти — только журналы
+    с последней свёртки и открытые заявки с индексом по (created_at, order_id)."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.users = _SortedSnapshotTable(STATE_FILE, STATE_JOURNAL)
+        # старый state.json/журнал хранили dict'ы — переводим в строки, на диск уйдут при следующей свёртке
+        for uid, rec in self.users.rows.items():
+            if isinstance(rec, dict):
+                self.users.rows[uid] = Session.from_record(rec).to_row()
+        self.orders = _SortedSnapshotTable(ORDERS_FILE, ORDERS_JOURNAL, str)
+        if self.orders._rewrite:
+            # orders.json старого формата (один dict) переписываем сразу, а не держим до первой свёртки
+            self.orders.put([], compact=True)
+        # открытые заявки и их индекс, отсортированный по (created_at, order_id); закрытые — только на диске
+        self.open_orders = {oid: req for oid, req in self.orders.items(b'"status":"pending"')
+                            if req["status"] == "pending"}
+        self.open_keys = sorted((req["created_at"], oid) for oid, req in self.open_orders.items())
+        # uid -> order_id юзера по времени создания
+        self.user_orders = _SortedSnapshotTable(ORDERS_BY_USER_FILE, ORDERS_BY_USER_JOURNAL)
+        if self.user_orders._rewrite and not self.user_orders.rows:
+            self._index_user_orders()
+        # индекс принятых TXID/чеков: 63-битный хэш -> кто его уже предъявил. Растёт вечно,
+        # поэтому как сессии: в памяти только журнал, снапшот ищется бинарным поиском по mmap
+        self.proofs = _SortedSnapshotTable(PROOFS_FILE, PROOFS_JOURNAL)
+        # пул адресов: address -> {coin, state, order_id, user_id, until}; свободные — стек на монету
+        self.deposits = _JsonTable(DEPOSITS_FILE, DEPOSITS_JOURNAL, str)
+        self.free_addrs: dict[str, list[str]] = {}
+        self.held_addrs: set[str] = set()
+        # JSON-файлы держит один процесс — аренда узлов нужна только для единого API с SQLite
+        self.order_nodes: dict[int, tuple[str, float]] = {}
+        for addr, row in self.deposits.rows.items():
+            if row["state"] == "free":
+                self.free_addrs.setdefault(row["coin"], []).append(addr)
+            else:
+                self.held_addrs.add(addr)
+
+    def _index_user_orders(self):
+        # первый старт с этим индексом: один проход по всем заявкам
+        by_user: dict[int, list[tuple[float, str]]] = {}
+        for oid, req in self.orders.items():
+            by_user.setdefault(req["user_id"], []).append((req["created_at"], oid))
+        self.user_orders.put([(uid, [oid for _, oid in sorted(keys)]) for uid, keys in by_user.items()], compact=True)
+
+    def get_user(self, uid: int) -> Session | None:
+        with self.lock:
+            row = self.users.get(uid)
+        return Session.from_record(row) if row is not None else None
+
+    def put_users(self, items: list[tuple[int, list]], compact: bool = False) -> int:
+        # items: (uid, Session.to_row()) — строки снимаются на loop'е, сюда приходят уже неизменяемыми
+        with self.lock:
+            written = self.users.put(items, compact)
+            if compact:
+                written += self.orders.put([], compact)
+                written += self.user_orders.put([], compact)
+                written += self.deposits.put([], compact)
+                written += self.proofs.put([], compact)
+        return written
+
+    def get_order(self, order_id: str) -> dict | None:
+        with self.lock:
+            req = self.open_orders.get(order_id) or self.orders.get(order_id)
+            return dict(req) if req is not None else None
+
+    def put_order(self, req: dict):
+        with self.lock:
+            self._put_order(req)
+
+    def _put_order(self, req: dict):
+        # в open_keys только pending: повторная запись заменяет ключ, смена статуса его убирает
+        oid, uid = req["order_id"], req["user_id"]
+        new = oid not in self.open_orders and self.orders.get(oid) is None
+        self.orders.put([(oid, req)])
+        if new:
+            self.user_orders.put([(uid, (self.user_orders.get(uid) or []) + [oid])])
+        old = self.open_orders.pop(oid, None)
+        if old is not None:
+            del self.open_keys[bisect.bisect_left(self.open_keys, (old["created_at"], oid))]
+        if req["status"] == "pending":
+            self.open_orders[oid] = req
+            bisect.insort(self.open_keys, (req["created_at"], oid))
+
+    def settle_order(self, order_id: str, status: str) -> dict | None:
+        # атомарно pending -> status; повторное нажатие получит None
+        settled = self.settle_orders([order_id], status)
+        return settled[0] if settled else None
+
+    def settle_orders(self, order_ids: list[str], status: str) -> list[dict]:
+        # пачкой: одна запись в журнал; уже закрытые/неизвестные заявки пропускаются
+        with self.lock:
+            settled = []
+            for oid in dict.fromkeys(order_ids):
+                req = self.open_orders.get(oid)
+                if req is not None:
+                    settled.append({**req, "status": status})
+            self.orders.put([(req["order_id"], req) for req in settled])
+            for req in settled:
+                del self.open_orders[req["order_id"]]
+                del self.open_keys[bisect.bisect_left(self.open_keys, (req["created_at"], req["order_id"]))]
+            return settled
+
+    def count_open_orders(self) -> int:
+        with self.lock:
+            return len(self.open_keys)
+
+    def last_order_id(self) -> str | None:
+        # как в SQLite: snowflake-id ниже "O", старые "ORD-..." выше — бинарный поиск по снапшоту
+        with self.lock:
+            oid = self.orders.last_key("O")
+        return oid if oid and order_id_ms(oid) is not None else None
+
+    def list_open_orders(self, after: str | None = None, limit: int = ORDERS_PAGE) -> list[dict]:
+        with self.lock:
+            i = 0
+            # курсор мог уже закрыться — его created_at берём с диска
+            if after and (cur := self.open_orders.get(after) or self.orders.get(after)):
+                i = bisect.bisect_right(self.open_keys, (cur["created_at"], after))
+            return [dict(self.open_orders[oid]) for _, oid in self.open_keys[i:i + limit]]
+
+    def list_user_orders(self, uid: int, limit: int = ORDERS_PAGE) -> list[dict]:
+        with self.lock:
+            ids = self.user_orders.get(uid) or []
+            return [dict(self.open_orders.get(oid) or self.orders.get(oid)) for oid in reversed(ids[-limit:])]
+
+    def claim_proof(self, h: int, proof: str, order_id: str, uid: int, known_new: bool = False,
+                    order: dict | None = None) -> dict | None:
+        """Закрепить TXID/чек за заявкой. Вернёт запись другой заявки, если он уже был; None — закреплён.
+        known_new: Bloom-фильтр сказал "точно не было" — поиск по снапшоту пропускаем.
+        order: сама заявка — пишется под тем же локом до закрепления, упадёт запись — не закрепится и proof."""
+        with self.lock:
+            old = None if known_new else self.proofs.get(h)
+            while old is not None and old["proof"] != proof:
+                h = proof_probe(h, proof)
+                old = self.proofs.get(h)
+            if old is not None and old["order_id"] != order_id:
+                return old
+            if order is not None:
+                self._put_order(order)
+            if old is None:
+                self.proofs.put([(h, {"proof": proof, "order_id": order_id, "user_id": uid, "at": time.time()})])
+            return None
+
+    def proof_hashes(self) -> list[int]:
+        with self.lock:
+            return list(self.proofs.keys())
+
+    def add_addresses(self, pairs: list[tuple[str, str]]) -> int:
+        # (coin, address); уже известные адреса не трогаем — пополнение идемпотентно
+        with self.lock:
+            new = [(addr, {"coin": coin, "state": "free", "order_id": None, "user_id": None, "until": None})
+                   for addr, coin in dict((a, c) for c, a in pairs).items() if addr not in self.deposits.rows]
+            self.deposits.put(new)
+            for addr, row in new:
+                self.free_addrs.setdefault(row["coin"], []).append(addr)
+            return len(new)
+
+    def lease_address(self, coin: str, order_id: str, uid: int, until: float) -> str | None:
+        with self.lock:
+            free = self.free_addrs.get(coin)
+            if not free:
+                return None
+            addr = free.pop()
+            self.held_addrs.add(addr)
+            self.deposits.put([(addr, {"coin": coin, "state": "leased", "order_id": order_id, "user_id": uid,
+                                       "until": until})])
+            return addr
+
+    def release_addresses(self, order_ids: list[str], until: float):
+        # заявка закрыта: адрес больше не ждёт оплату, но до until ещё привязан к ней
+        wanted = set(order_ids)
+        with self.lock:
+            self.deposits.put([(addr, {**row, "state": "cooling", "until": until})
+                               for addr in self.held_addrs if (row := self.deposits.rows[addr])["state"] == "leased"
+                               and row["order_id"] in wanted])
+
+    def expire_addresses(self, now: float, cooldown: float) -> int:
+        # leased с истёкшим сроком -> cooling, остывшие cooling -> снова свободны
+        with self.lock:
+            changed = []
+            for addr in self.held_addrs:
+                row = self.deposits.rows[addr]
+                if row["until"] > now:
+                    continue
+                if row["state"] == "leased":
+                    changed.append((addr, {**row, "state": "cooling", "until": now + cooldown}))
+                else:
+                    changed.append((addr, {**row, "state": "free", "order_id": None, "user_id": None, "until": None}))
+            self.deposits.put(changed)
+            for addr, row in changed:
+                if row["state"] == "free":
+                    self.held_addrs.discard(addr)
+                    self.free_addrs.setdefault(row["coin"], []).append(addr)
+            return len(changed)
+
+    def list_held_addresses(self) -> list[dict]:
+        with self.lock:
+            return [{"address": addr, **self.deposits.rows[addr]} for addr in self.held_addrs]
+
+    def count_free_addresses(self) -> dict[str, int]:
+        with self.lock:
+            return {coin: len(addrs) for coin, addrs in self.free_addrs.items()}
+
+    def claim_order_node(self, owner: str, now: float, ttl: float, node: int | None = None) -> int | None:
+        with self.lock:
+            if node is not None and self.order_nodes.get(node, ("",))[0] == owner:
+                self.order_nodes[node] = (owner, now + ttl)
+                return node
+            free = next((n for n in range(1024) if self.order_nodes.get(n, ("", 0.0))[1] <= now), None)
+            if free is not None:
+                self.order_nodes[free] = (owner, now + ttl)
+            return free
+
+    def release_order_node(self, owner: str, node: int):
+        with self.lock:
+            if self.order_nodes.get(node, ("",))[0] == owner:
+                del self.order_nodes[node]
+
+    def close(self):
+        with self.lock:
+            self.users.close()
+            self.orders.close()
+            self.user_orders.close()
+            self.proofs.close()
+
+SQLITE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS users (
+    uid        INTEGER PRIMARY KEY,
+    lang       TEXT,
+    flow       TEXT,
+    step       TEXT,
+    sub_months INTEGER,
+    topup_usd  INTEGER,
+    pay_method TEXT,
+    coin       TEXT,
+    order_id   TEXT,
+    email      TEXT,
+    rate       REAL,
+    amount_coin TEXT
+);
+CREATE INDEX IF NOT EXISTS users_step ON users(step);
+CREATE INDEX IF NOT EXISTS users_order_id ON users(order_id);
+
+CREATE TABLE IF NOT EXISTS orders (
+    order_id   TEXT PRIMARY KEY,
+    user_id    INTEGER NOT NULL,
+    kind       TEXT,
+    status     TEXT NOT NULL,
+    created_at REAL,
+    amount_usd INTEGER,
+    method     TEXT,
+    data       TEXT NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS proofs (
+    hash       INTEGER PRIMARY KEY,  -- 63 бита blake2b от "txid:..." / "receipt:..."
+    proof      TEXT NOT NULL,
+    order_id   TEXT NOT NULL,
+    user_id    INTEGER,
+    at         REAL
+);
+
+CREATE TABLE IF NOT EXISTS deposits (
+    address    TEXT PRIMARY KEY,
+    coin       TEXT NOT NULL,
+    state      TEXT NOT NULL,       -- free / leased / cooling
+    order_id   TEXT,
+    user_id    INTEGER,
+    until      REAL
+);
+CREATE INDEX IF NOT EXISTS deposits_coin_state ON deposits(coin, state);
+CREATE INDEX IF NOT EXISTS deposits_state_until ON deposits(state, until);
+CREATE INDEX IF NOT EXISTS deposits_order_id ON deposits(order_id);
+
+CREATE TABLE IF NOT EXISTS order_nodes (
+    node       INTEGER PRIMARY KEY,  -- 10 бит узла в order_id
+    owner      TEXT NOT NULL,
+    expires    REAL NOT NULL
+);
+"""
+
+SQLITE_ORDER_COLUMNS = {"kind": "TEXT", "created_at": "REAL", "amount_usd": "INTEGER", "method": "TEXT"}
+SQLITE_USER_COLUMNS = {"rate": "REAL", "amount_coin": "TEXT"}
+
+SQLITE_INDEXES = """
+DROP INDEX IF EXISTS orders_status;
+DROP INDEX IF EXISTS orders_user_id;
+CREATE INDEX IF NOT EXISTS orders_status_created ON orders(status, created_at, order_id);
+CREATE INDEX IF NOT EXISTS orders_user_created ON orders(user_id, created_at);
+"""
+
+class SqliteStorage:
+    """SQLite (WAL): сессии и заявки читаются точечно по ключу, в памяти ничего не копится.
+    Методы синхронные — из хендлеров их зовут через db_call() в отдельном потоке."""
+
+    def __init__(self, path: str):
+        self.db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self.lock = threading.Lock()
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.executescript(SQLITE_SCHEMA)
+        # старые базы: таблица orders без колонок для индексов, users без новых полей сессии
+        for table, columns in (("orders", SQLITE_ORDER_COLUMNS), ("users", SQLITE_USER_COLUMNS)):
+            have = {row[1] for row in self.db.execute(f"PRAGMA table_info({table})")}
+            for col, typ in columns.items():
+                if col not in have:
+                    self.db.execute(f"ALTER TABLE {table} ADD COLUMN {col} {typ}")
+        self.db.executescript(SQLITE_INDEXES)
+        self._migrate_json()
+
+    def _migrate_json(self):
+        # первый запуск на SQLite: забираем сессии и заявки из json-снапшотов + журналов
+        if self.db.execute("SELECT 1 FROM users LIMIT 1").fetchone():
+            return
+        users = _load_snapshot(STATE_FILE)
+        _replay_journal(STATE_JOURNAL, users)
+        orders = _load_snapshot(ORDERS_FILE, str)
+        _replay_journal(ORDERS_JOURNAL, orders, str)
+        if users:
+            self.put_users([(uid, Session.from_record(rec).to_row()) for uid, rec in users.items()])
+        for req in orders.values():
+            self.put_order(req)
+        if users or orders:
+            print(f"✅ Migrated {len(users)} sessions and {len(orders)} orders to SQLite")
+
+    def get_user(self, uid: int) -> Session | None:
+        with self.lock:
+            row = self.db.execute(f"SELECT {', '.join(USER_FIELDS)} FROM users WHERE uid = ?", (uid,)).fetchone()
+        return Session.from_record(dict(zip(USER_FIELDS, row))) if row else None
+
+    def put_users(self, items: list[tuple[int, list]], compact: bool = False) -> int:
+        # в колонках — строки, а не номера: по step есть индекс, и базу удобно смотреть руками
+        if not items:
+            return 0
+        cols = ", ".join(("uid",) + USER_FIELDS)
+        marks = ", ".join("?" * (len(USER_FIELDS) + 1))
+        rows = [(uid, *Session(*row).to_dict().values()) for uid, row in items]
+        with self.lock:
+            self.db.execute("BEGIN IMMEDIATE")
+            try:
+                self.db.executemany(f"INSERT OR REPLACE INTO users ({cols}) VALUES ({marks})", rows)
+                self.db.execute("COMMIT")
+            except Exception:
+                self.db.execute("ROLLBACK")
+                raise
+        # размер полезной нагрузки (страницы и WAL SQLite считает сам)
+        return sum(len(_json_line(uid, row)) for uid, row in items)
+
+    def get_order(self, order_id: str) -> dict | None:
+        with self.lock:
+            row = self.db.execute("SELECT data FROM orders WHERE order_id = ?", (order_id,)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def put_order(self, req: dict):
+        with self.lock:
+            self._put_order(req)
+
+    def _put_order(self, req: dict):
+        self.db.execute(
+            "INSERT OR REPLACE INTO orders (order_id, user_id, kind, status, created_at, amount_usd, method, data) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+            (req["order_id"], req["user_id"], req["kind"], req["status"], req["created_at"],
+             req["amount_usd"], req["method"], json.dumps(req, ensure_ascii=False)))
+
+    def settle_order(self, order_id: str, status: str) -> dict | None:
+        # атомарно pending -> status; повторное нажатие получит None
+        settled = self.settle_orders([order_id], status)
+        return settled[0] if settled else None
+
+    def settle_orders(self, order_ids: list[str], status: str) -> list[dict]:
+        # одна транзакция на всю пачку; IN (...) кусками, чтобы не упереться в лимит параметров
+        order_ids = list(dict.fromkeys(order_ids))
+        rows = []
+        with self.lock:
+            self.db.execute("BEGIN IMMEDIATE")
+            try:
+                for i in range(0, len(order_ids), 500):
+                    chunk = order_ids[i:i + 500]
+                    rows += self.db.execute(
+                        "UPDATE orders SET status = ?, data = json_set(data, '$.status', ?) "
+                        f"WHERE order_id IN ({', '.join('?' * len(chunk))}) AND status = 'pending' RETURNING data",
+                        (status, status, *chunk)).fetchall()
+                self.db.execute("COMMIT")
+            except Exception:
+                self.db.execute("ROLLBACK")
+                raise
+        return [json.loads(r[0]) for r in rows]
+
+    def count_open_orders(self) -> int:
+        with self.lock:
+            return self.db.execute("SELECT count(*) FROM orders WHERE status = 'pending'").fetchone()[0]
+
+    def last_order_id(self) -> str | None:
+        # первый символ snowflake-id — старшие биты 42-битного времени, не дальше "F"; старые "ORD-..."
+        # лежат выше "O" — один диапазон по первичному ключу вместо полного прохода
+        with self.lock:
+            row = self.db.execute("SELECT max(order_id) FROM orders WHERE order_id < 'O'").fetchone()
+        return row[0] if row[0] and order_id_ms(row[0]) is not None else None
+
+    def list_open_orders(self, after: str | None = None, limit: int = ORDERS_PAGE) -> list[dict]:
+        # keyset-пагинация по (created_at, order_id): каждая страница — один проход по индексу
+        with self.lock:
+            if after:
+                rows = self.db.execute(
+                    "SELECT data FROM orders WHERE status = 'pending' "
+                    "AND (created_at, order_id) > (SELECT created_at, order_id FROM orders WHERE order_id = ?) "
+                    "ORDER BY created_at, order_id LIMIT ?", (after, limit)).fetchall()
+            else:
+                rows = self.db.execute(
+                    "SELECT data FROM orders WHERE status = 'pending' "
+                    "ORDER BY created_at, order_id LIMIT ?", (limit,)).fetchall()
+        return [json.loads(r[0]) for r in rows]
+
+    def list_user_orders(self, uid: int, limit: int = ORDERS_PAGE) -> list[dict]:
+        with self.lock:
+            rows = self.db.execute("SELECT data FROM orders WHERE user_id = ? ORDER BY created_at DESC LIMIT ?",
+                                   (uid, limit)).fetchall()
+        return [json.loads(r[0]) for r in rows]
+
+    def claim_proof(self, h: int, proof: str, order_id: str, uid: int, known_new: bool = False,
+                    order: dict | None = None) -> dict | None:
+        # known_new не помогает: INSERT по первичному ключу всё равно ищет конфликт, а фильтр
+        # соседнего воркера мог ещё не видеть свежий хэш. order — одной транзакцией с proof
+        with self.lock:
+            self.db.execute("BEGIN IMMEDIATE")
+            try:
+                dup = None
+                while not self.db.execute(
+                        "INSERT INTO proofs (hash, proof, order_id, user_id, at) VALUES (?, ?, ?, ?, ?) "
+                        "ON CONFLICT(hash) DO NOTHING RETURNING hash", (h, proof, order_id, uid, time.time())).fetchone():
+                    old = self.db.execute("SELECT proof, order_id, user_id, at FROM proofs WHERE hash = ?",
+                                          (h,)).fetchone()
+                    old = dict(zip(("proof", "order_id", "user_id", "at"), old))
+                    if old["proof"] == proof:
+                        dup = old if old["order_id"] != order_id else None
+                        break
+                    h = proof_probe(h, proof)
+                if dup is None and order is not None:
+                    self._put_order(order)
+                self.db.execute("COMMIT")
+            except Exception:
+                self.db.execute("ROLLBACK")
+                raise
+        return dup
+
+    def proof_hashes(self) -> list[int]:
+        with self.lock:
+            return [r[0] for r in self.db.execute("SELECT hash FROM proofs")]
+
+    def add_addresses(self, pairs: list[tuple[str, str]]) -> int:
+        with self.lock:
+            before = self.db.total_changes
+            self.db.executemany("INSERT OR IGNORE INTO deposits (address, coin, state) VALUES (?, ?, 'free')",
+                                [(addr, coin) for coin, addr in pairs])
+            return self.db.total_changes - before
+
+    def lease_address(self, coin: str, order_id: str, uid: int, until: float) -> str | None:
+        # один UPDATE: воркеры в разных процессах не получат один и тот же адрес
+        with self.lock:
+            row = self.db.execute(
+                "UPDATE deposits SET state = 'leased', order_id = ?, user_id = ?, until = ? "
+                "WHERE address = (SELECT address FROM deposits WHERE coin = ? AND state = 'free' LIMIT 1) "
+                "RETURNING address", (order_id, uid, until, coin)).fetchone()
+        return row[0] if row else None
+
+    def release_addresses(self, order_ids: list[str], until: float):
+        with self.lock:
+            self.db.executemany("UPDATE deposits SET state = 'cooling', until = ? "
+                                "WHERE order_id = ? AND state = 'leased'", [(until, oid) for oid in order_ids])
+
+    def expire_addresses(self, now: float, cooldown: float) -> int:
+        with self.lock:
+            self.db.execute("BEGIN IMMEDIATE")
+            try:
+                freed = self.db.execute("UPDATE deposits SET state = 'free', order_id = NULL, user_id = NULL, "
+                                        "until = NULL WHERE state = 'cooling' AND until <= ?", (now,)).rowcount
+                cooled = self.db.execute("UPDATE deposits SET state = 'cooling', until = ? "
+                                         "WHERE state = 'leased' AND until <= ?", (now + cooldown, now)).rowcount
+                self.db.execute("COMMIT")
+            except Exception:
+                self.db.execute("ROLLBACK")
+                raise
+        return freed + cooled
+
+    def list_held_addresses(self) -> list[dict]:
+        with self.lock:
+            rows = self.db.execute("SELECT address, coin, state, order_id, user_id, until FROM deposits "
+                                   "WHERE state != 'free'").fetchall()
+        return [dict(zip(("address", "coin", "state", "order_id", "user_id", "until"), r)) for r in rows]
+
+    def count_free_addresses(self) -> dict[str, int]:
+        with self.lock:
+            return dict(self.db.execute("SELECT coin, count(*) FROM deposits WHERE state = 'free' GROUP BY coin"))
+
+    def claim_order_node(self, owner: str, now: float, ttl: float, node: int | None = None) -> int | None:
+        """Продлить свою аренду node или взять наименьший свободный узел; None — заняты все 1024."""
+        with self.lock:
+            self.db.execute("BEGIN IMMEDIATE")
+            try:
+                if node is not None and self.db.execute(
+                        "UPDATE order_nodes SET expires = ? WHERE node = ? AND owner = ?",
+                        (now + ttl, node, owner)).rowcount:
+                    self.db.execute("COMMIT")
+                    return node
+                taken = {n for (n,) in self.db.execute("SELECT node FROM order_nodes WHERE expires > ?", (now,))}
+                free = next((n for n in range(1024) if n not in taken), None)
+                if free is not None:
+                    self.db.execute("INSERT OR REPLACE INTO order_nodes (node, owner, expires) VALUES (?, ?, ?)",
+                                    (free, owner, now + ttl))
+                self.db.execute("COMMIT")
+            except Exception:
+                self.db.execute("ROLLBACK")
+                raise
+        return free
+
+    def release_order_node(self, owner: str, node: int):
+        with self.lock:
+            self.db.execute("DELETE FROM order_nodes WHERE node = ? AND owner = ?", (node, owner))
+
+    def close(self):
+        with self.lock:
+            self.db.close()
+
+def make_storage():
+    if STORAGE_BACKEND == "sqlite":
+        return SqliteStorage(STATE_DB)
+    return JsonStorage()
+
+async def db_call(fn, *args):
+    # любые обращения к бэкенду (диск / SQLite) — в отдельном потоке, чтобы не блокировать loop
+    trace = _TRACE.get()
+    if trace is None:
+        return await asyncio.to_thread(fn, *args)
+    t0 = time.perf_counter()
+    try:
+        return await asyncio.to_thread(fn, *args)
+    finally:
+        trace.storage += time.perf_counter() - t0
+        trace.storage_calls += 1
+
+# Write-behind: хендлеры только помечают uid "грязным", фоновая задача раз в
+# STATE_FLUSH_INTERVAL сек (или сразу при STATE_FLUSH_THRESHOLD грязных сессий)
+# отдаёт их бэкенду одной пачкой.
+_DIRTY: set[int] = set()
+_FLUSHING: set[int] = set()     # uid, чьи строки сейчас пишет flush_state (до успеха — ещё не на диске)
+_FLUSH_WAKE = asyncio.Event()
+_FLUSH_LOCK = asyncio.Lock()
+
+def save_state(uid: int):
+    _DIRTY.add(uid)
+    if len(_DIRTY) >= STATE_FLUSH_THRESHOLD:
+        _FLUSH_WAKE.set()
+
+async def flush_state(compact: bool = False):
+    async with _FLUSH_LOCK:
+        dirty = list(_DIRTY)
+        _DIRTY.clear()
+        # копии делаем на loop'е (их мало), запись — в отдельном потоке
+        items = [(uid, row) for uid in dirty if (row := USER.dirty_row(uid)) is not None]
+        if not items and not compact:
+            return
+        t0 = time.perf_counter()
+        _FLUSHING.update(dirty)
+        try:
+            written = await asyncio.to_thread(STORAGE.put_users, items, compact)
+        except Exception as e:
+            # вытесненные за время записи строки остались в USER.evicted — уйдут следующим flush
+            _DIRTY.update(dirty)
+            METRICS.save_state_errors += 1
+            print(f"⚠️ save_state failed: {e}")
+            return
+        finally:
+            _FLUSHING.clear()
+        METRICS.save_state.observe(time.perf_counter() - t0)
+        METRICS.save_state_bytes += written
+        USER.written(dirty)
+
+async def state_flusher():
+    while True:
+        try:
+            await asyncio.wait_for(_FLUSH_WAKE.wait(), STATE_FLUSH_INTERVAL)
+        except asyncio.TimeoutError:
+            pass
+        _FLUSH_WAKE.clear()
+        USER.sweep()
+        await flush_state()
 
 # =====================
 # BOT INIT
 # =====================
 if not TOKEN or ":" not in TOKEN:
     raise RuntimeError("BOT_TOKEN is not set. Put token into Render -> Environment (BOT_TOKEN).")
+if BOT_MODE == "webhook" and not WEBHOOK_BASE_URL:
+    raise RuntimeError("BOT_MODE=webhook needs WEBHOOK_BASE_URL (public https URL of this service).")
+
+if WORKERS and STORAGE_BACKEND != "sqlite":
+    raise RuntimeError("WORKERS needs STORAGE=sqlite: json storage lives in one process.")
+if WORKERS and not ADMIN_ID_ENV.isdigit():
+    raise RuntimeError("WORKERS needs ADMIN_ID in ENV: /admin would only reach one worker.")
 
-bot = Bot(token=TOKEN)
+bot = Bot(token=TOKEN, session=AiohttpSession(api=TelegramAPIServer.from_base(TELEGRAM_API_URL))
+          if TELEGRAM_API_URL else None)
 dp = Dispatcher()
 
 ADMIN_ID: int | None = load_admin_id()
 
-USER: dict[int, dict] = load_state()
-PENDING: dict[str, dict] = {}
-
-def get_user(uid: int) -> dict:
-    if uid not in USER:
-        USER[uid] = {
-            "lang": "ru",
-            "flow": None,          # sub / topup
-            "step": None,          # wait_topup_email / wait_txid / wait_sbp_receipt / choose_coin
-            "sub_months": None,
-            "topup_usd": None,
-            "pay_method": None,    # sbp / crypto
-            "coin": None,
-            "order_id": None,
-            "email": None,
-        }
-        save_state()
-    return USER[uid]
+STORAGE = make_storage()
+
+# владелец аренды узла: hostname и pid повторяются между контейнерами, случайный хвост — нет
+_NODE_OWNER = f"{os.uname().nodename}/{os.getpid()}/{os.urandom(4).hex()}"
+
+def claim_order_node(keep: int | None = None):
+    """Взять узел в аренду или продлить keep. Если keep уже у другого (процесс спал дольше
+    аренды), дальше id выдаются под новым узлом."""
+    node = STORAGE.claim_order_node(_NODE_OWNER, time.time(), ORDER_NODE_TTL, keep)
+    if node is None:
+        raise RuntimeError("All 1024 order nodes are leased: set ORDER_NODE_ID or wait for ORDER_NODE_TTL.")
+    if keep is not None and node != keep:
+        print(f"⚠️ Order node {keep}: lease lost, switching to {node}")
+    ORDER_IDS.node = node
+
+async def order_node_keeper():
+    while True:
+        await asyncio.sleep(ORDER_NODE_TTL / 3)
+        try:
+            await db_call(claim_order_node, ORDER_IDS.node)
+        except Exception as e:
+            print(f"⚠️ Order node lease renewal failed: {e!r}")
+
+if not ORDER_NODE_ID:
+    claim_order_node()
+ORDER_IDS.observe(STORAGE.last_order_id())
+class SessionCache:
+    """Горячие сессии перед STORAGE: LRU до size штук + выгрузка простаивающих дольше ttl.
 
-def reset_flow(u: dict):
+    Грязная сессия при вытеснении не теряется: её строка ждёт в evicted до ближайшего
+    успешного flush_state (и отдаётся get_user, если юзер вернулся раньше). Это касается
+    и сессии, которую вытеснили, пока flush_state писал её строку. Сессии, чей апдейт
+    сейчас обрабатывается (держат USER_LOCKS), не вытесняются.
+    """
+
+    def __init__(self, size: int = SESSION_CACHE_SIZE, ttl: float = SESSION_TTL):
+        self.size, self.ttl = size, ttl
+        self._data: OrderedDict[int, Session] = OrderedDict()
+        self._stamps: dict[int, float] = {}
+        self.evicted: dict[int, list] = {}
+        self.hits = self.misses = self.evictions = 0
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def __contains__(self, uid: int) -> bool:
+        return uid in self._data
+
+    def __getitem__(self, uid: int) -> Session:
+        return self._data[uid]
+
+    def get(self, uid: int) -> Session | None:
+        u = self._data.get(uid)
+        if u is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self._data.move_to_end(uid)
+        self._stamps[uid] = time.monotonic()
+        return u
+
+    def peek(self, uid: int) -> Session | None:
+        # без счётчиков и без продления LRU — для решений до хендлера
+        return self._data.get(uid)
+
+    def put(self, uid: int, u: Session):
+        self._data[uid] = u
+        self._data.move_to_end(uid)
+        self._stamps[uid] = time.monotonic()
+        busy = 0
+        while len(self._data) > self.size and busy < len(self._data):
+            oldest = next(iter(self._data))
+            if USER_LOCKS.busy(oldest):
+                self._data.move_to_end(oldest)
+                busy += 1
+                continue
+            self._evict(oldest)
+
+    def sweep(self):
+        if not self.ttl:
+            return
+        deadline = time.monotonic() - self.ttl
+        for uid in list(self._data):
+            if self._stamps[uid] >= deadline:
+                break  # дальше по LRU только более свежие
+            if not USER_LOCKS.busy(uid):
+                self._evict(uid)
+
+    def _evict(self, uid: int):
+        u = self._data.pop(uid)
+        del self._stamps[uid]
+        self.evictions += 1
+        if uid in _DIRTY or uid in _FLUSHING:
+            self.evicted[uid] = u.to_row()
+
+    def take_evicted(self, uid: int) -> Session | None:
+        row = self.evicted.pop(uid, None)
+        return Session(*row) if row is not None else None
+
+    def dirty_row(self, uid: int) -> list | None:
+        u = self._data.get(uid)
+        return u.to_row() if u is not None else self.evicted.get(uid)
+
+    def written(self, uids: list[int]):
+        for uid in uids:
+            if uid not in _DIRTY:  # после снимка не меняли — вытесненную строку можно забыть
+                self.evicted.pop(uid, None)
+
+    def values(self):
+        return self._data.values()
+
+    def clear(self):
+        self._data.clear()
+        self._stamps.clear()
+        self.evicted.clear()
+
+    def stats(self) -> dict[str, int]:
+        total = self.hits + self.misses
+        return {"resident": len(self._data), "size": self.size, "hits": self.hits, "misses": self.misses,
+                "hit_rate": round(100 * self.hits / total) if total else 0,
+                "evictions": self.evictions, "pending_writeback": len(self.evicted)}
+
+# Горячие сессии; остальные лежат в STORAGE и поднимаются лениво в get_user
+USER = SessionCache()
+
+async def get_user(uid: int) -> Session:
+    u = USER.get(uid)
+    if u is not None:
+        return u
+    u = USER.take_evicted(uid)
+    if u is None:
+        u = await db_call(STORAGE.get_user, uid)
+        if uid in USER:
+            # пока ждали бэкенд, сессию уже подняло другое обновление
+            return USER[uid]
+        if u is None:
+            u = Session()  # lang=ru, без активного флоу
+            save_state(uid)
+    USER.put(uid, u)
+    return u
+
+def reset_flow(uid: int, u: Session):
     u.update({
         "flow": None,
         "step": None,
@@ -192,377 +1700,1262 @@ def reset_flow(u: dict):
         "coin": None,
         "order_id": None,
         "email": None,
+        "amount_coin": None,
     })
-    save_state()
+    save_state(uid)
+
+# =====================
+# RENDER CACHE
+# =====================
+# Что сейчас показано в каждом сообщении бота: (chat_id, message_id) -> хэш текста и клавиатуры.
+# Пишет RenderCacheMiddleware по ответам API (sendMessage/editMessageText), читает safe_edit:
+# nav:home на главном меню или повторный back_pay не уходят в сеть ради "message is not modified".
+_MARKUP_DIGESTS: OrderedDict[int, tuple[Any, int]] = OrderedDict()
+
+def markup_digest(markup) -> int:
+    if markup is None:
+        return 0
+    # клавиатуры из KEYBOARDS — одни и те же объекты, сериализуем каждую один раз
+    hit = _MARKUP_DIGESTS.get(id(markup))
+    if hit is not None and hit[0] is markup:
+        return hit[1]
+    digest = hash(markup.model_dump_json(exclude_none=True))
+    _MARKUP_DIGESTS[id(markup)] = (markup, digest)
+    if len(_MARKUP_DIGESTS) > 512:
+        _MARKUP_DIGESTS.popitem(last=False)
+    return digest
+
+def render_key(text: str, markup) -> int:
+    return hash((text, markup_digest(markup)))
+
+class RenderCache:
+    """LRU (chat_id, message_id) -> render_key последней отрисовки."""
+
+    def __init__(self, size: int = RENDER_CACHE_SIZE):
+        self.size = size
+        self._data: OrderedDict[tuple[int, int], int] = OrderedDict()
+        self.lookups = self.skipped = self.evictions = 0
+
+    def same(self, chat_id: int, message_id: int, digest: int) -> bool:
+        self.lookups += 1
+        if self._data.get((chat_id, message_id)) != digest:
+            return False
+        self._data.move_to_end((chat_id, message_id))
+        self.skipped += 1
+        return True
+
+    def put(self, chat_id: int, message_id: int, digest: int):
+        self._data[chat_id, message_id] = digest
+        self._data.move_to_end((chat_id, message_id))
+        if len(self._data) > self.size:
+            self._data.popitem(last=False)
+            self.evictions += 1
+
+    def drop(self, chat_id: int, message_id: int):
+        self._data.pop((chat_id, message_id), None)
+
+    def stats(self) -> dict[str, int]:
+        return {"resident": len(self._data), "lookups": self.lookups, "skipped": self.skipped,
+                "hit_rate": round(100 * self.skipped / self.lookups) if self.lookups else 0,
+                "evictions": self.evictions}
+
+RENDERED = RenderCache()
+
+class RenderCacheMiddleware(BaseRequestMiddleware):
+    """Запоминает, что отрисовано в сообщении, по фактическим ответам API. Любой другой метод,
+    трогающий сообщение (правка подписи/клавиатуры, удаление), забывает его — дальше правка уйдёт в сеть."""
+
+    async def __call__(self, make_request, bot: Bot, method):
+        chat_id = getattr(method, "chat_id", None)
+        message_id = getattr(method, "message_id", None)
+        try:
+            result = await make_request(bot, method)
+        except TelegramBadRequest as e:
+            if isinstance(method, EditMessageText) and chat_id is not None and "message is not modified" in str(e).lower():
+                RENDERED.put(chat_id, message_id, render_key(method.text, method.reply_markup))
+            elif message_id is not None:
+                RENDERED.drop(chat_id, message_id)
+            raise
+        if isinstance(method, SendMessage) and isinstance(result, Message):
+            RENDERED.put(result.chat.id, result.message_id, render_key(method.text, method.reply_markup))
+        elif isinstance(method, EditMessageText) and chat_id is not None:
+            RENDERED.put(chat_id, message_id, render_key(method.text, method.reply_markup))
+        elif message_id is not None and chat_id is not None:
+            RENDERED.drop(chat_id, message_id)
+        return result
 
 async def safe_edit(cb: CallbackQuery, text: str, reply_markup=None):
+    msg = cb.message
+    if not msg:
+        return
+    if RENDERED.same(msg.chat.id, msg.message_id, render_key(text, reply_markup)):
+        return  # на экране уже ровно это
+    try:
+        await msg.edit_text(text, reply_markup=reply_markup)
+    except TelegramBadRequest as e:
+        if "message is not modified" in str(e).lower():
+            pass
+        else:
+            raise
+
+# =====================
+# UPDATE SCHEDULER
+# =====================
+# Polling (handle_as_tasks) и webhook (handle_in_background) обрабатывают апдейты
+# параллельно. Чтобы двойной тап по pay:/coin: или чек посреди перехода не
+# перемешивали USER[uid], апдейты одного юзера идут строго по порядку прихода
+# (asyncio.Lock будит ожидающих FIFO), разные юзеры — параллельно.
+class UserLocks:
+    """uid -> asyncio.Lock; лок живёт, пока его кто-то держит или ждёт."""
+
+    def __init__(self):
+        self._locks: dict[int, asyncio.Lock] = {}
+        self._refs: dict[int, int] = {}
+        self.contended = 0  # сколько апдейтов ждали предыдущий апдейт того же юзера
+
+    def __len__(self) -> int:
+        return len(self._locks)
+
+    def busy(self, uid: int) -> bool:
+        return uid in self._locks
+
+    async def acquire(self, uid: int):
+        lock = self._locks.get(uid)
+        if lock is None:
+            lock = self._locks[uid] = asyncio.Lock()
+        self._refs[uid] = self._refs.get(uid, 0) + 1
+        if lock.locked():
+            self.contended += 1
+        try:
+            await lock.acquire()
+        except BaseException:
+            self._release_ref(uid)
+            raise
+
+    def release(self, uid: int):
+        self._locks[uid].release()
+        self._release_ref(uid)
+
+    def _release_ref(self, uid: int):
+        self._refs[uid] -= 1
+        if not self._refs[uid]:
+            del self._refs[uid], self._locks[uid]
+
+USER_LOCKS = UserLocks()
+
+# Трейс апдейта: куда ушло время от входа в диспетчер до ответа. Контекст копируется
+# в задачи, созданные из хендлера, — фоновые отправки (Outbox.post) его сбрасывают.
+class UpdateTrace:
+    __slots__ = ("started", "lock", "api", "api_net", "api_calls", "storage", "storage_calls")
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.lock = self.api = self.api_net = self.storage = 0.0
+        self.api_calls = self.storage_calls = 0
+
+    def breakdown(self, total: float) -> dict[str, Any]:
+        # handler — остаток: логика хендлеров, фильтры и всё, что блокировало loop
+        def ms(v: float) -> float:
+            return round(v * 1e3, 2)
+
+        return {"total_ms": ms(total), "lock_ms": ms(self.lock),
+                "api_ms": ms(self.api), "api_queue_ms": ms(max(self.api - self.api_net, 0)), "api_calls": self.api_calls,
+                "storage_ms": ms(self.storage), "storage_calls": self.storage_calls,
+                "handler_ms": ms(max(total - self.lock - self.api - self.storage, 0))}
+
+_TRACE: contextvars.ContextVar[UpdateTrace | None] = contextvars.ContextVar("update_trace", default=None)
+
+class UpdateTraceMiddleware(BaseMiddleware):
+    async def __call__(self, handler: Callable[[TelegramObject, dict[str, Any]], Awaitable[Any]],
+                       event: TelegramObject, data: dict[str, Any]) -> Any:
+        trace = UpdateTrace()
+        token = _TRACE.set(trace)
+        try:
+            return await handler(event, data)
+        finally:
+            _TRACE.reset(token)
+            total = time.perf_counter() - trace.started
+            if SLOW_UPDATE_MS and total * 1e3 >= SLOW_UPDATE_MS:
+                user: User | None = data.get("event_from_user")
+                record = {"update_id": getattr(event, "update_id", None),
+                          "type": getattr(event, "event_type", type(event).__name__),
+                          "user": user.id if user else None, **trace.breakdown(total)}
+                print(f"🐢 slow update {json.dumps(record)}")
+
+class UserSerialMiddleware(BaseMiddleware):
+    async def __call__(self, handler: Callable[[TelegramObject, dict[str, Any]], Awaitable[Any]],
+                       event: TelegramObject, data: dict[str, Any]) -> Any:
+        user: User | None = data.get("event_from_user")
+        if user is None:
+            return await handler(event, data)
+        trace = _TRACE.get()
+        if trace is not None and USER_LOCKS.busy(user.id):
+            t0 = time.perf_counter()
+            await USER_LOCKS.acquire(user.id)
+            trace.lock += time.perf_counter() - t0
+        else:
+            await USER_LOCKS.acquire(user.id)
+        try:
+            return await handler(event, data)
+        finally:
+            USER_LOCKS.release(user.id)
+
+# =====================
+# FLOOD CONTROL
+# =====================
+class LoopLag:
+    """На сколько event loop опаздывает: раз в INTERVAL засыпаем и смотрим, насколько позже проснулись."""
+    INTERVAL = 0.1
+
+    def __init__(self):
+        self.lag = self.peak = 0.0
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            t0 = loop.time()
+            await asyncio.sleep(self.INTERVAL)
+            self.lag = max(0.0, loop.time() - t0 - self.INTERVAL)
+            self.peak = max(self.peak, self.lag)
+
+LOOP_LAG = LoopLag()
+
+# важное решается без бэкенда: по callback data, вложению и шагу сессии, если она в кэше
+URGENT_CALLBACKS = {"pay", "coin", "adm", "dg"}
+URGENT_STEPS = {"wait_topup_email", "wait_txid", "wait_sbp_receipt"}
+
+def is_urgent(update: Update, uid: int) -> bool:
+    """Оплата и действия админа — их не сбрасываем никогда; меню, навигация и болтовня — можно."""
+    if uid == ADMIN_ID:
+        return True
+    if update.callback_query is not None:
+        return (update.callback_query.data or "").split(":", 1)[0] in URGENT_CALLBACKS
+    msg = update.message
+    if msg is None:
+        return False
+    if msg.photo or msg.document:
+        return True
+    u = USER.peek(uid)
+    return u is not None and u["step"] in URGENT_STEPS
+
+class FloodControlMiddleware(BaseMiddleware):
+    """Outer на update, до лока юзера: лишние апдейты не встают в очередь за его локом.
+
+    Сверх ведра апдейт резервирует следующий токен и ждёт его, если ждать не дольше
+    THROTTLE_MAX_WAIT, — ждущие выходят по очереди, в порядке прихода. Callback'и схлопываются:
+    новый тап того же юзера занимает место ждущего, выполнится только последний. Оплата
+    (is_urgent) не отбрасывается никогда — ждёт своего токена сколько нужно. Отброшенный
+    callback всё равно получает answer, иначе у юзера крутятся часики на кнопке.
+    """
+    SWEEP_INTERVAL = 30.0
+
+    def __init__(self):
+        self.buckets: dict[int, TokenBucket] = {}
+        self.waiting: dict[int, list] = {}     # uid -> [update_id, когда его токен] ждущего callback'а
+        self.notified: dict[int, float] = {}
+        self.inflight = 0
+        self.swept = time.monotonic()
+        self.throttled = self.coalesced = self.shed_lag = self.shed_inflight = self.notices = 0
+
+    async def __call__(self, handler: Callable[[TelegramObject, dict[str, Any]], Awaitable[Any]],
+                       event: TelegramObject, data: dict[str, Any]) -> Any:
+        user: User | None = data.get("event_from_user")
+        if user is None or not isinstance(event, Update):
+            return await handler(event, data)
+        urgent = is_urgent(event, user.id)
+        if not urgent:
+            if THROTTLE_LAG_MS and LOOP_LAG.lag * 1e3 > THROTTLE_LAG_MS:
+                self.shed_lag += 1
+                self.dismiss(user, event)
+                return UNHANDLED
+            if THROTTLE_INFLIGHT and self.inflight >= THROTTLE_INFLIGHT:
+                self.shed_inflight += 1
+                self.dismiss(user, event)
+                return UNHANDLED
+        if THROTTLE_RATE and user.id != ADMIN_ID and not await self.admit(user, event, urgent):
+            return UNHANDLED
+        self.inflight += 1
+        try:
+            return await handler(event, data)
+        finally:
+            self.inflight -= 1
+
+    async def admit(self, user: User, event: Update, urgent: bool) -> bool:
+        now = time.monotonic()
+        if now - self.swept >= self.SWEEP_INTERVAL:
+            self.sweep(now)
+        bucket = self.buckets.get(user.id)
+        if bucket is None:
+            bucket = self.buckets[user.id] = TokenBucket(THROTTLE_RATE, THROTTLE_BURST, now)
+        if urgent:
+            wait = bucket.reserve(now)
+            if wait:
+                await asyncio.sleep(wait)
+            return True
+
+        slot = None
+        if event.callback_query is not None and (slot := self.waiting.get(user.id)) is not None:
+            slot[0] = event.update_id  # занимаем место (и токен) уже ждущего тапа
+            wait = slot[1] - now
+        else:
+            wait = bucket.reserve_within(now, THROTTLE_MAX_WAIT)
+            if wait is None:
+                self.throttled += 1
+                self.dismiss(user, event, self.notice(user, now))
+                return False
+            if not wait:
+                return True
+            if event.callback_query is not None:
+                slot = self.waiting[user.id] = [event.update_id, now + wait]
+        await asyncio.sleep(wait)
+        if slot is not None:
+            if slot[0] != event.update_id:
+                self.coalesced += 1  # пока ждали, юзер нажал что-то ещё — выполнится то
+                self.dismiss(user, event)
+                return False
+            if self.waiting.get(user.id) is slot:
+                del self.waiting[user.id]
+        return True
+
+    def notice(self, user: User, now: float) -> str | None:
+        """Текст "не так быстро" — не чаще раза в THROTTLE_NOTICE_INTERVAL на юзера."""
+        if now - self.notified.get(user.id, -THROTTLE_NOTICE_INTERVAL) < THROTTLE_NOTICE_INTERVAL:
+            return None
+        self.notified[user.id] = now
+        self.notices += 1
+        u = USER.peek(user.id)
+        return t("slow_down", u["lang"] if u is not None else norm_lang(user.language_code or ""))
+
+    @staticmethod
+    def dismiss(user: User, event: Update, text: str | None = None):
+        if event.callback_query is not None:
+            OUTBOX.post(bot.answer_callback_query(event.callback_query.id, text))
+        elif text:
+            OUTBOX.post(bot.send_message(user.id, text))
+
+    def sweep(self, now: float):
+        # полные вёдра — то же, что новые; предупреждения старше интервала больше ничего не значат
+        self.buckets = {uid: b for uid, b in self.buckets.items() if not b.idle(now)}
+        self.notified = {uid: ts for uid, ts in self.notified.items() if now - ts < THROTTLE_NOTICE_INTERVAL}
+        self.swept = now
+
+    def stats(self) -> dict[str, int]:
+        return {"throttled": self.throttled, "coalesced": self.coalesced, "shed_lag": self.shed_lag,
+                "shed_inflight": self.shed_inflight, "notices": self.notices, "inflight": self.inflight,
+                "buckets": len(self.buckets)}
+
+FLOOD = FloodControlMiddleware()
+
+# outer на update: трейс — самым внешним (в total попадает и ожидание лока), флуд-контроль
+# до лока (отброшенное не ждёт очереди юзера), лок — до фильтров и хендлеров
+dp.update.outer_middleware(UpdateTraceMiddleware())
+dp.update.outer_middleware(FLOOD)
+dp.update.outer_middleware(UserSerialMiddleware())
+
+# =====================
+# OUTBOUND QUEUE
+# =====================
+# Все исходящие вызовы с chat_id (send*/edit*/copy*) проходят через request-middleware
+# сессии бота: per-chat token bucket (FIFO внутри чата), затем общий глобальный лимит,
+# который раздаётся по приоритету — ответы юзерам раньше уведомлений админу.
+# TelegramRetryAfter ставит чат на паузу и повторяет запрос, 5xx — повтор с backoff.
+PRIO_USER, PRIO_ADMIN = 0, 1
+
+class TokenBucket:
+    """Ведро токенов с резервированием: токены уходят в минус, reserve() говорит, сколько ждать."""
+    __slots__ = ("rate", "burst", "tokens", "stamp")
+
+    def __init__(self, rate: float, burst: float, now: float):
+        self.rate, self.burst = rate, burst
+        self.tokens, self.stamp = burst, now
+
+    def _refill(self, now: float):
+        self.tokens = min(self.burst, self.tokens + (now - self.stamp) * self.rate)
+        self.stamp = now
+
+    def reserve(self, now: float) -> float:
+        self._refill(now)
+        self.tokens -= 1
+        return 0.0 if self.tokens >= 0 else -self.tokens / self.rate
+
+    def pause(self, now: float, seconds: float):
+        self._refill(now)
+        self.tokens = min(self.tokens, 0) - seconds * self.rate
+
+    def idle(self, now: float) -> bool:
+        return self.tokens + (now - self.stamp) * self.rate >= self.burst
+
+    def reserve_within(self, now: float, max_wait: float) -> float | None:
+        """reserve(), но только если ждать не дольше max_wait; иначе None и токен не тратится."""
+        self._refill(now)
+        wait = max(0.0, (1 - self.tokens) / self.rate)
+        if wait > max_wait:
+            return None
+        self.tokens -= 1
+        return wait
+
+class SharedTokenBucket:
+    """Тот же TokenBucket, но состояние в разделяемой памяти — одно ведро на все процессы-воркеры.
+
+    time.monotonic() на Linux общий для процессов, так что stamp из разных воркеров сравним.
+    """
+
+    def __init__(self, rate: float, burst: float, ctx=multiprocessing):
+        self.rate, self.burst = rate, burst
+        self.state = ctx.Array("d", [burst, time.monotonic()])
+
+    def _apply(self, op, now: float, *args):
+        with self.state.get_lock():
+            bucket = TokenBucket(self.rate, self.burst, now)
+            bucket.tokens, bucket.stamp = self.state[0], self.state[1]
+            result = op(bucket, max(now, bucket.stamp), *args)
+            self.state[0], self.state[1] = bucket.tokens, bucket.stamp
+        return result
+
+    def reserve(self, now: float) -> float:
+        return self._apply(TokenBucket.reserve, now)
+
+    def pause(self, now: float, seconds: float):
+        self._apply(TokenBucket.pause, now, seconds)
+
+    def idle(self, now: float) -> bool:
+        return self._apply(TokenBucket.idle, now)
+
+class Outbox(BaseRequestMiddleware):
+    def __init__(self, global_rate: float = OUTBOX_GLOBAL_RATE, global_burst: float = OUTBOX_GLOBAL_BURST,
+                 chat_rate: float = OUTBOX_CHAT_RATE, chat_burst: float = OUTBOX_CHAT_BURST,
+                 max_retries: int = OUTBOX_MAX_RETRIES):
+        self.global_rate, self.global_burst = global_rate, global_burst
+        self.chat_rate, self.chat_burst = chat_rate, chat_burst
+        self.max_retries = max_retries
+        self._chats: dict[int | str, TokenBucket] = {}
+        self._global: TokenBucket | SharedTokenBucket | None = None
+        self._heap: list[tuple[int, int, asyncio.Future]] = []
+        self._seq = 0
+        self._pump_task: asyncio.Task | None = None
+        self._detached: set[asyncio.Task] = set()
+        self._pruned_at = 0.0
+        self._shared: dict[int | str, SharedTokenBucket] = {}
+        self._chat_tail: dict[int | str, asyncio.Future] = {}
+        self.chat_waiting = 0
+        self.sent = self.retried = self.failed = 0
+
+    async def __call__(self, make_request, bot: Bot, method):
+        trace = _TRACE.get()
+        if trace is None:
+            return await self._send(make_request, bot, method)
+        t0 = time.perf_counter()
+        try:
+            return await self._send(make_request, bot, method)
+        finally:
+            trace.api += time.perf_counter() - t0
+            trace.api_calls += 1
+
+    async def _send(self, make_request, bot: Bot, method):
+        chat_id = getattr(method, "chat_id", None)
+        if chat_id is None:
+            return await make_request(bot, method)
+        prio = PRIO_ADMIN if chat_id == ADMIN_ID else PRIO_USER
+        for attempt in range(self.max_retries + 1):
+            await self._acquire(chat_id, prio)
+            try:
+                result = await make_request(bot, method)
+            except TelegramRetryAfter as e:
+                if attempt == self.max_retries:
+                    self.failed += 1
+                    raise
+                self.retried += 1
+                self._chat(chat_id, time.monotonic()).pause(time.monotonic(), e.retry_after)
+            except TelegramServerError:
+                if attempt == self.max_retries:
+                    self.failed += 1
+                    raise
+                self.retried += 1
+                await asyncio.sleep(min(OUTBOX_BACKOFF * 2 ** attempt, 30))
+            else:
+                self.sent += 1
+                return result
+
+    def share(self, global_bucket: SharedTokenBucket, chats: dict[int | str, SharedTokenBucket]):
+        """Шардированный режим: глобальный лимит и чаты, куда пишут все воркеры (админ), — общие.
+        Чат юзера живёт в одном воркере, его ведро остаётся локальным."""
+        self._global = global_bucket
+        self._shared = dict(chats)
+
+    def _chat(self, chat_id: int | str, now: float) -> TokenBucket | SharedTokenBucket:
+        if self._shared and chat_id in self._shared:
+            return self._shared[chat_id]
+        bucket = self._chats.get(chat_id)
+        if bucket is None:
+            if len(self._chats) > 4096 and now - self._pruned_at > 60:
+                # вёдра простаивающих чатов полные — их можно забыть без потери лимита
+                self._chats = {k: b for k, b in self._chats.items() if not b.idle(now)}
+                self._pruned_at = now
+            bucket = self._chats[chat_id] = TokenBucket(self.chat_rate, self.chat_burst, now)
+        return bucket
+
+    async def _acquire(self, chat_id: int | str, prio: int):
+        # отправки в один чат идут цепочкой: токен чата берётся, только когда предыдущая отправка
+        # в него получила глобальный токен. Иначе очередь за глобальным ведром копит уже "оплаченные"
+        # отправки одного чата и потом выпускает их подряд со скоростью глобального лимита.
+        fut = asyncio.get_running_loop().create_future()
+        prev = self._chat_tail.get(chat_id)
+        self._chat_tail[chat_id] = fut
+        try:
+            if prev is not None and not prev.done():
+                await asyncio.wait([prev])
+            delay = self._chat(chat_id, time.monotonic()).reserve(time.monotonic())
+            if delay:
+                self.chat_waiting += 1
+                try:
+                    await asyncio.sleep(delay)
+                finally:
+                    self.chat_waiting -= 1
+            self._seq += 1
+            heapq.heappush(self._heap, (prio, self._seq, fut))
+            if self._pump_task is None or self._pump_task.done():
+                self._pump_task = asyncio.create_task(self._pump())
+            await fut
+        finally:
+            if not fut.done():
+                fut.cancel()  # следующий в цепочке не должен ждать отменённого
+            if self._chat_tail.get(chat_id) is fut:
+                del self._chat_tail[chat_id]
+
+    async def _pump(self):
+        # единственный потребитель глобального ведра: после ожидания токена отдаёт его
+        # текущей голове кучи, так что приоритет учитывается на момент выдачи
+        if self._global is None:
+            self._global = TokenBucket(self.global_rate, self.global_burst, time.monotonic())
+        while self._heap:
+            delay = self._global.reserve(time.monotonic())
+            if delay:
+                await asyncio.sleep(delay)
+            while self._heap:
+                _, _, fut = heapq.heappop(self._heap)
+                if not fut.done():  # ожидавший мог быть отменён
+                    fut.set_result(None)
+                    break
+
+    def post(self, coro: Awaitable[Any]):
+        """Отправить в фоне (уведомления админу): хендлер не ждёт своей очереди."""
+        task = asyncio.create_task(self._detached_send(coro))
+        self._detached.add(task)
+        task.add_done_callback(self._detached.discard)
+
+    @staticmethod
+    async def _detached_send(coro: Awaitable[Any]):
+        _TRACE.set(None)  # своя копия контекста: время отправки не пишется в апдейт, который её запустил
+        try:
+            await coro
+        except Exception as e:
+            print(f"⚠️ Background send failed: {e!r}")
+
+    async def drain(self):
+        await asyncio.gather(*self._detached, return_exceptions=True)
+
+    def stats(self) -> dict[str, int]:
+        waiting = [p for p, _, fut in self._heap if not fut.done()]
+        return {
+            "queued_user": waiting.count(PRIO_USER),
+            "queued_admin": waiting.count(PRIO_ADMIN),
+            "chat_waiting": self.chat_waiting,
+            "background": len(self._detached),
+            "sent": self.sent,
+            "retried": self.retried,
+            "failed": self.failed,
+        }
+
+OUTBOX = Outbox()
+bot.session.middleware(OUTBOX)
+
+# =====================
+# METRICS
+# =====================
+# Без prometheus_client: несколько счётчиков и гистограмм + текстовый формат экспозиции.
+# Данные собирают middleware диспетчера и сессии бота, хендлеры ничего не знают о метриках.
+LATENCY_BUCKETS = (.001, .0025, .005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10)
+
+def _labels(**labels) -> str:
+    return "{" + ",".join(f'{k}="{v}"' for k, v in labels.items()) + "}" if labels else ""
+
+class Histogram:
+    __slots__ = ("bounds", "counts", "sum")
+
+    def __init__(self, bounds: tuple[float, ...] = LATENCY_BUCKETS):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.sum = 0.0
+
+    def observe(self, value: float):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.sum += value
+
+    def expose(self, name: str, **labels) -> list[str]:
+        lines, total = [], 0
+        for bound, n in zip(self.bounds + ("+Inf",), self.counts):
+            total += n
+            lines.append(f"{name}_bucket{_labels(**labels, le=bound)} {total}")
+        lines.append(f"{name}_sum{_labels(**labels)} {self.sum}")
+        lines.append(f"{name}_count{_labels(**labels)} {total}")
+        return lines
+
+class Metrics:
+    RATE_WINDOW = 10  # сек, окно для bot_updates_per_second
+
+    def __init__(self):
+        self.updates = 0
+        self.update_errors = 0
+        self.handlers: dict[str, Histogram] = {}
+        self.api: dict[str, Histogram] = {}
+        self.api_errors: dict[tuple[str, str], int] = {}
+        self.save_state = Histogram()
+        self.save_state_bytes = 0
+        self.save_state_errors = 0
+        self._window = [0] * self.RATE_WINDOW
+        self._window_sec = 0
+
+    def _roll(self) -> int:
+        # кольцо по секундам: обнуляем ячейки, пропущенные с прошлого вызова
+        sec = int(time.monotonic())
+        if sec != self._window_sec:
+            for s in range(max(self._window_sec + 1, sec - self.RATE_WINDOW + 1), sec + 1):
+                self._window[s % self.RATE_WINDOW] = 0
+            self._window_sec = sec
+        return sec % self.RATE_WINDOW
+
+    def count_update(self):
+        self.updates += 1
+        self._window[self._roll()] += 1
+
+    def updates_per_second(self) -> float:
+        self._roll()
+        return sum(self._window) / self.RATE_WINDOW
+
+    async def render(self) -> str:
+        out = [
+            "# TYPE bot_updates_total counter", f"bot_updates_total {self.updates}",
+            "# TYPE bot_update_errors_total counter", f"bot_update_errors_total {self.update_errors}",
+            "# TYPE bot_updates_per_second gauge", f"bot_updates_per_second {self.updates_per_second()}",
+            "# TYPE bot_handler_seconds histogram",
+        ]
+        for name, h in sorted(self.handlers.items()):
+            out += h.expose("bot_handler_seconds", handler=name)
+        out.append("# TYPE bot_api_request_seconds histogram")
+        for method, h in sorted(self.api.items()):
+            out += h.expose("bot_api_request_seconds", method=method)
+        out.append("# TYPE bot_api_errors_total counter")
+        for (method, error), n in sorted(self.api_errors.items()):
+            out.append(f"bot_api_errors_total{_labels(method=method, error=error)} {n}")
+        out.append("# TYPE bot_save_state_seconds histogram")
+        out += self.save_state.expose("bot_save_state_seconds")
+        out += ["# TYPE bot_save_state_bytes_total counter", f"bot_save_state_bytes_total {self.save_state_bytes}",
+                "# TYPE bot_save_state_errors_total counter", f"bot_save_state_errors_total {self.save_state_errors}",
+                "# TYPE bot_pending_orders gauge",
+                f"bot_pending_orders {await db_call(STORAGE.count_open_orders)}",
+                "# TYPE bot_sessions gauge"]
+        steps = [0] * len(STEP_CODES)
+        for u in USER.values():
+            steps[u.step] += 1
+        out += [f"bot_sessions{_labels(step=step or 'none')} {n}" for step, n in zip(STEP_CODES, steps)]
+        out.append("# TYPE bot_session_cache gauge")
+        out += [f"bot_session_cache{_labels(stat=k)} {v}" for k, v in USER.stats().items()]
+        out.append("# TYPE bot_outbox gauge")
+        out += [f"bot_outbox{_labels(stat=k)} {v}" for k, v in OUTBOX.stats().items()]
+        out += ["# TYPE bot_event_loop_lag_seconds gauge", f"bot_event_loop_lag_seconds {LOOP_LAG.lag}",
+                "# TYPE bot_flood_control gauge"]
+        out += [f"bot_flood_control{_labels(stat=k)} {v}" for k, v in FLOOD.stats().items()]
+        out.append("# TYPE bot_render_cache gauge")
+        out += [f"bot_render_cache{_labels(stat=k)} {v}" for k, v in RENDERED.stats().items()]
+        return "\n".join(out) + "\n"
+
+METRICS = Metrics()
+
+class UpdateMetricsMiddleware(BaseMiddleware):
+    async def __call__(self, handler, event: TelegramObject, data: dict[str, Any]) -> Any:
+        METRICS.count_update()
+        try:
+            return await handler(event, data)
+        except Exception:
+            METRICS.update_errors += 1
+            raise
+
+class HandlerMetricsMiddleware(BaseMiddleware):
+    """Inner: срабатывает только когда хендлер найден; callback'и подписываются именем хендлера,
+    которого нашёл роутер (data["callback_route"] от CallbackRouteMiddleware)."""
+
+    async def __call__(self, handler, event: TelegramObject, data: dict[str, Any]) -> Any:
+        t0 = time.perf_counter()
+        try:
+            return await handler(event, data)
+        finally:
+            if isinstance(event, CallbackQuery):
+                target = data.get("callback_route", (None,))[0]
+                name = target.__name__ if target else "unhandled"
+            else:
+                name = data["handler"].callback.__name__
+            hist = METRICS.handlers.get(name)
+            if hist is None:
+                hist = METRICS.handlers[name] = Histogram()
+            hist.observe(time.perf_counter() - t0)
+
+class ApiMetricsMiddleware(BaseRequestMiddleware):
+    """Регистрируется после OUTBOX, поэтому меряет сам запрос к API без ожидания в очереди."""
+
+    async def __call__(self, make_request, bot: Bot, method):
+        name = type(method).__name__
+        t0 = time.perf_counter()
+        try:
+            return await make_request(bot, method)
+        except Exception as e:
+            key = (name, type(e).__name__)
+            METRICS.api_errors[key] = METRICS.api_errors.get(key, 0) + 1
+            raise
+        finally:
+            elapsed = time.perf_counter() - t0
+            hist = METRICS.api.get(name)
+            if hist is None:
+                hist = METRICS.api[name] = Histogram()
+            hist.observe(elapsed)
+            trace = _TRACE.get()
+            if trace is not None:
+                trace.api_net += elapsed
+
+dp.update.outer_middleware(UpdateMetricsMiddleware())
+dp.callback_query.middleware(HandlerMetricsMiddleware())
+dp.message.middleware(HandlerMetricsMiddleware())
+bot.session.middleware(ApiMetricsMiddleware())
+bot.session.middleware(RenderCacheMiddleware())
+
+async def metrics_view(request: web.Request) -> web.Response:
+    return web.Response(body=(await METRICS.render()).encode(),
+                        headers={"Content-Type": "text/plain; version=0.0.4; charset=utf-8"})
+
+async def start_metrics_server() -> web.AppRunner:
+    app = web.Application()
+    app.router.add_get("/metrics", metrics_view)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, METRICS_HOST, METRICS_PORT).start()
+    return runner
+
+# =====================
+# PROFILER (/profile)
+# =====================
+# Захват на N секунд без передеплоя: cpu — cProfile на потоке event loop'а (всё, что его
+# занимало: хендлеры, сериализация, синхронные вызовы), mem — прирост аллокаций по tracemalloc.
+PROFILE_MODES = ("cpu", "mem")
+_PROFILE_TASK: asyncio.Task | None = None
+
+async def capture_cpu(seconds: float) -> str:
+    prof = cProfile.Profile()
+    prof.enable()
+    try:
+        await asyncio.sleep(seconds)
+    finally:
+        prof.disable()
+    out = io.StringIO()
+    stats = pstats.Stats(prof, stream=out)
+    stats.sort_stats("cumulative").print_stats(PROFILE_TOP)
+    stats.sort_stats("tottime").print_stats(PROFILE_TOP)
+    return out.getvalue()
+
+async def capture_mem(seconds: float) -> str:
+    started = not tracemalloc.is_tracing()
+    if started:
+        tracemalloc.start(10)
+    try:
+        before = tracemalloc.take_snapshot()
+        await asyncio.sleep(seconds)
+        after = tracemalloc.take_snapshot()
+        current, peak = tracemalloc.get_traced_memory()
+    finally:
+        if started:
+            tracemalloc.stop()
+    lines = [f"traced: current {current / 2**20:.1f} MiB, peak {peak / 2**20:.1f} MiB", "",
+             f"top {PROFILE_TOP} by growth over {seconds:g}s:"]
+    lines += [str(stat) for stat in after.compare_to(before, "lineno")[:PROFILE_TOP]]
+    lines += ["", f"top {PROFILE_TOP} by size:"]
+    lines += [str(stat) for stat in after.statistics("lineno")[:PROFILE_TOP]]
+    return "\n".join(lines) + "\n"
+
+async def run_profile(mode: str, seconds: int):
+    _TRACE.set(None)  # задача живёт дольше апдейта с командой
     try:
-        if cb.message:
-            await cb.message.edit_text(text, reply_markup=reply_markup)
-    except TelegramBadRequest as e:
-        if "message is not modified" in str(e).lower():
-            pass
-        else:
-            raise
+        report = await (capture_cpu if mode == "cpu" else capture_mem)(seconds)
+        stamp = datetime.now().strftime("%Y%m%d-%H%M%S")
+        await bot.send_document(ADMIN_ID, BufferedInputFile(report.encode("utf-8"), f"profile-{mode}-{stamp}.txt"),
+                                caption=t("profile_done", "ru", mode=mode, seconds=seconds))
+    except Exception as e:
+        print(f"⚠️ profile {mode} failed: {e!r}")
+
+def start_profile(mode: str, seconds: int) -> bool:
+    global _PROFILE_TASK
+    if _PROFILE_TASK is not None and not _PROFILE_TASK.done():
+        return False
+    _PROFILE_TASK = asyncio.create_task(run_profile(mode, seconds))
+    return True
 
 # =====================
 # KEYBOARDS
 # =====================
-def kb_language():
+def _build_kb_language():
     kb = InlineKeyboardBuilder()
-    kb.button(text="🇷🇺 Русский", callback_data="lang:ru")
-    kb.button(text="🇬🇧 English", callback_data="lang:en")
+    for lang, name in LANG_NAMES.items():
+        kb.button(text=name, callback_data=f"lang:{lang}")
     kb.adjust(1)
     return kb.as_markup()
 
-def kb_main(lang: str):
+def _build_kb_main(lang: str):
     kb = InlineKeyboardBuilder()
-    if lang == "ru":
-        kb.button(text="💳 Купить подписку", callback_data="menu:buy_sub")
-        kb.button(text="💰 Пополнить баланс", callback_data="menu:topup")
-        kb.button(text="🆘 Поддержка", callback_data="menu:support")
-        kb.button(text="🏠 В начало", callback_data="nav:home")
-    else:
-        kb.button(text="💳 Buy subscription", callback_data="menu:buy_sub")
-        kb.button(text="💰 Top up balance", callback_data="menu:topup")
-        kb.button(text="🆘 Support", callback_data="menu:support")
-        kb.button(text="🏠 Home", callback_data="nav:home")
+    kb.button(text=t("btn_buy_sub", lang), callback_data="menu:buy_sub")
+    kb.button(text=t("btn_topup", lang), callback_data="menu:topup")
+    kb.button(text=t("btn_support", lang), callback_data="menu:support")
+    kb.button(text=t("btn_home", lang), callback_data="nav:home")
     kb.adjust(1)
     return kb.as_markup()
 
-def kb_support(lang: str):
+def _build_kb_support(lang: str):
     kb = InlineKeyboardBuilder()
-    kb.button(text="💬 Написать в поддержку" if lang == "ru" else "💬 Contact support", url=SUPPORT_URL)
-    kb.button(text="🏠 В начало" if lang == "ru" else "🏠 Home", callback_data="nav:home")
+    kb.button(text=t("btn_contact_support", lang), url=SUPPORT_URL)
+    kb.button(text=t("btn_home", lang), callback_data="nav:home")
     kb.adjust(1)
     return kb.as_markup()
 
-def kb_admin_decision(order_id: str):
-    kb = InlineKeyboardBuilder()
-    kb.button(text="✅ Подтвердить", callback_data=f"adm:approve:{order_id}")
-    kb.button(text="❌ Отклонить", callback_data=f"adm:reject:{order_id}")
-    kb.adjust(2)
-    return kb.as_markup()
-
-def kb_cancel_payment(lang: str):
+def _build_kb_cancel_payment(lang: str):
     kb = InlineKeyboardBuilder()
-    kb.button(text="❌ Отменить" if lang == "ru" else "❌ Cancel", callback_data="nav:cancel")
-    kb.button(text="🏠 В начало" if lang == "ru" else "🏠 Home", callback_data="nav:home")
+    kb.button(text=t("btn_cancel", lang), callback_data="nav:cancel")
+    kb.button(text=t("btn_home", lang), callback_data="nav:home")
     kb.adjust(1)
     return kb.as_markup()
 
-def sub_label(lang: str, months: int) -> str:
-    usd      = SUB_PRICES[months]["usd"]
-    rub      = SUB_PRICES[months]["rub"]
-    discount = SUB_PRICES[months]["discount"]
-    if lang == "ru":
-        title = "1 месяц" if months == 1 else ("Год" if months == 12 else f"{months} месяца")
-        disc  = f" 🔥 −{discount}%" if discount > 0 else ""
-        return f"{title}{disc} — {rub} ₽ (${usd})"
-    title = "1 month" if months == 1 else ("1 year" if months == 12 else f"{months} months")
-    disc  = f" 🔥 −{discount}%" if discount > 0 else ""
-    return f"{title}{disc} — ${usd} ({rub} RUB)"
+def sub_label(lang: str, months: int, prices: PriceTable | None = None) -> str:
+    sub = (prices or PRICES).sub
+    usd      = sub[months]["usd"]
+    rub      = sub[months]["rub"]
+    discount = sub[months]["discount"]
+    title = t("sub_title_1", lang) if months == 1 else (t("sub_title_12", lang) if months == 12
+                                                        else t("sub_title_n", lang, months=months))
+    disc  = t("sub_label_disc", lang, discount=discount) if discount > 0 else ""
+    return t("sub_label", lang, title=title, disc=disc, rub=rub, usd=usd)
 
-def kb_sub_months(lang: str):
+def _build_kb_sub_months(lang: str):
     kb = InlineKeyboardBuilder()
-    kb.button(text=sub_label(lang, 1), callback_data="sub:1")
-    kb.button(text=sub_label(lang, 3), callback_data="sub:3")
-    kb.button(text=sub_label(lang, 6), callback_data="sub:6")
-    kb.button(text=sub_label(lang, 12), callback_data="sub:12")
-    kb.button(text="⚡ Custom", callback_data="sub:custom")
-    kb.button(text="🏠 В начало" if lang == "ru" else "🏠 Home", callback_data="nav:home")
+    kb.button(text=SUB_LABELS[lang, 1], callback_data="sub:1")
+    kb.button(text=SUB_LABELS[lang, 3], callback_data="sub:3")
+    kb.button(text=SUB_LABELS[lang, 6], callback_data="sub:6")
+    kb.button(text=SUB_LABELS[lang, 12], callback_data="sub:12")
+    kb.button(text=t("btn_custom", lang), callback_data="sub:custom")
+    kb.button(text=t("btn_home", lang), callback_data="nav:home")
     kb.adjust(1)
     return kb.as_markup()
 
-def kb_topup_amounts(lang: str):
+def _build_kb_topup_amounts(lang: str):
     kb = InlineKeyboardBuilder()
     for usd in TOPUP_AMOUNTS_USD:
-        rub = TOPUP_PRICES[usd]["rub"]
-        text = f"${usd} | {rub} ₽" if lang == "ru" else f"${usd} | {rub} RUB"
-        kb.button(text=text, callback_data=f"topup:{usd}")
-    kb.button(text="🏠 В начало" if lang == "ru" else "🏠 Home", callback_data="nav:home")
+        kb.button(text=t("btn_topup_amount", lang, usd=usd, rub=PRICES.topup[usd]["rub"]), callback_data=f"topup:{usd}")
+    kb.button(text=t("btn_home", lang), callback_data="nav:home")
     kb.adjust(1)
     return kb.as_markup()
 
-def kb_pay_method(lang: str):
+def _build_kb_pay_method(lang: str):
     kb = InlineKeyboardBuilder()
-    if lang == "ru":
-        kb.button(text="🏦 СБП / Карта РФ", callback_data="pay:sbp")
-        kb.button(text="₿ Crypto", callback_data="pay:crypto")
-        kb.button(text="⬅️ Назад", callback_data="nav:back_prev")
-        kb.button(text="❌ Отменить", callback_data="nav:cancel")
-        kb.button(text="🏠 В начало", callback_data="nav:home")
-    else:
-        kb.button(text="🏦 SBP / RU card", callback_data="pay:sbp")
-        kb.button(text="₿ Crypto", callback_data="pay:crypto")
-        kb.button(text="⬅️ Back", callback_data="nav:back_prev")
-        kb.button(text="❌ Cancel", callback_data="nav:cancel")
-        kb.button(text="🏠 Home", callback_data="nav:home")
+    kb.button(text=t("btn_sbp", lang), callback_data="pay:sbp")
+    kb.button(text=t("btn_crypto", lang), callback_data="pay:crypto")
+    kb.button(text=t("btn_back", lang), callback_data="nav:back_prev")
+    kb.button(text=t("btn_cancel", lang), callback_data="nav:cancel")
+    kb.button(text=t("btn_home", lang), callback_data="nav:home")
     kb.adjust(1)
     return kb.as_markup()
 
-def kb_crypto_coin(lang: str):
+def _build_kb_crypto_coin(lang: str):
     kb = InlineKeyboardBuilder()
     kb.button(text="USDT TRC20", callback_data="coin:USDT_TRC20")
     kb.button(text="BTC", callback_data="coin:BTC")
     kb.button(text="ETH", callback_data="coin:ETH")
-    kb.button(text="⬅️ Назад" if lang == "ru" else "⬅️ Back", callback_data="nav:back_pay")
-    kb.button(text="❌ Отменить" if lang == "ru" else "❌ Cancel", callback_data="nav:cancel")
-    kb.button(text="🏠 В начало" if lang == "ru" else "🏠 Home", callback_data="nav:home")
+    kb.button(text=t("btn_back", lang), callback_data="nav:back_pay")
+    kb.button(text=t("btn_cancel", lang), callback_data="nav:cancel")
+    kb.button(text=t("btn_home", lang), callback_data="nav:home")
     kb.adjust(1)
     return kb.as_markup()
 
+# Всё выше зависит только от lang и конфига, поэтому клавиатуры собираются один раз на язык
+# (при старте или rebuild_keyboards() после смены конфига) и дальше отдаются из неизменяемого кэша.
+_KB_BUILDERS = {
+    "main": _build_kb_main,
+    "support": _build_kb_support,
+    "cancel_payment": _build_kb_cancel_payment,
+    "sub_months": _build_kb_sub_months,
+    "topup_amounts": _build_kb_topup_amounts,
+    "pay_method": _build_kb_pay_method,
+    "crypto_coin": _build_kb_crypto_coin,
+}
+# клавиатуры с ценами: при смене курса пересобираются только они
+_KB_PRICED = ("sub_months", "topup_amounts")
+KEYBOARDS: Mapping[tuple[str, str], InlineKeyboardMarkup] = MappingProxyType({})
+KB_LANGUAGE = _build_kb_language()
+
+def build_sub_labels(prices: PriceTable) -> Mapping[tuple[str, int], str]:
+    return MappingProxyType({(lang, m): sub_label(lang, m, prices) for lang in LANGS for m in prices.sub})
+
+SUB_LABELS = build_sub_labels(PRICES)
+
+def rebuild_keyboards(names: tuple[str, ...] | None = None):
+    global KEYBOARDS
+    fresh = {(name, lang): _KB_BUILDERS[name](lang) for name in names or _KB_BUILDERS for lang in LANGS}
+    KEYBOARDS = MappingProxyType({**KEYBOARDS, **fresh})
+
+rebuild_keyboards()
+
+def _kb(name: str, lang: str) -> InlineKeyboardMarkup:
+    return KEYBOARDS[name, norm_lang(lang)]
+
+def kb_language():
+    return KB_LANGUAGE
+
+def kb_main(lang: str):
+    return _kb("main", lang)
+
+def kb_support(lang: str):
+    return _kb("support", lang)
+
+def kb_cancel_payment(lang: str):
+    return _kb("cancel_payment", lang)
+
+def kb_sub_months(lang: str):
+    return _kb("sub_months", lang)
+
+def kb_topup_amounts(lang: str):
+    return _kb("topup_amounts", lang)
+
+def kb_pay_method(lang: str):
+    return _kb("pay_method", lang)
+
+def kb_crypto_coin(lang: str):
+    return _kb("crypto_coin", lang)
+
+def kb_admin_decision(order_id: str):
+    # зависит от order_id, поэтому без билдера: сразу готовая разметка по шаблону
+    return InlineKeyboardMarkup(inline_keyboard=[[
+        InlineKeyboardButton(text=t("btn_approve", "ru"), callback_data=f"adm:approve:{order_id}"),
+        InlineKeyboardButton(text=t("btn_reject", "ru"), callback_data=f"adm:reject:{order_id}"),
+    ]])
+
 def main_menu_text(lang: str) -> str:
-    if lang == "ru":
-        return f"Главное меню\n\n{WORK_HOURS_TEXT_RU}"
-    return f"Main menu\n\n{WORK_HOURS_TEXT_EN}"
+    return t("main_menu", lang)
+
+# =====================
+# CALLBACK ROUTER
+# =====================
+# Вместо цепочки F.data-фильтров: один хендлер на все callback_query. callback_data разбирается
+# один раз в Callback(prefix, args) и уходит в нужный хендлер по словарю:
+# сначала (prefix, args[0]) — для точных кнопок вроде nav:home, затем (prefix, None).
+class Callback(NamedTuple):
+    prefix: str
+    args: tuple[str, ...]
+
+CallbackHandler = Callable[[CallbackQuery, Callback], Awaitable[Any]]
+CALLBACK_ROUTES: dict[tuple[str, str | None], tuple[CallbackHandler, int]] = {}
+
+def callback_route(prefix: str, action: str | None = None, nargs: int = 0):
+    def register(handler: CallbackHandler) -> CallbackHandler:
+        CALLBACK_ROUTES[prefix, action] = (handler, nargs)
+        return handler
+    return register
+
+def parse_callback(data: str | None) -> Callback:
+    prefix, *args = (data or "").split(":")
+    return Callback(prefix, tuple(args))
+
+def resolve_callback(data: str | None) -> tuple[CallbackHandler | None, Callback]:
+    cd = parse_callback(data)
+    route = CALLBACK_ROUTES.get((cd.prefix, cd.args[0])) if cd.args else None
+    if route is None:
+        route = CALLBACK_ROUTES.get((cd.prefix, None))
+    if route is None or len(cd.args) < route[1]:
+        return None, cd
+    return route[0], cd
+
+class CallbackRouteMiddleware(BaseMiddleware):
+    """Inner: callback_data разбирается один раз, маршрут — в data["callback_route"]:
+    его берёт callback_router, а метрики читают оттуда имя хендлера."""
+
+    async def __call__(self, handler, event: CallbackQuery, data: dict[str, Any]) -> Any:
+        data["callback_route"] = resolve_callback(event.data)
+        return await handler(event, data)
+
+dp.callback_query.middleware(CallbackRouteMiddleware())
+
+@dp.callback_query()
+async def callback_router(cb: CallbackQuery, callback_route: tuple[CallbackHandler | None, Callback]):
+    handler, cd = callback_route
+    if handler is None:
+        return UNHANDLED
+    return await handler(cb, cd)
 
 # =====================
 # COMMANDS (Start + Support)
 # =====================
 @dp.message(Command("support"))
 async def cmd_support(message: Message):
-    u = get_user(message.from_user.id)
-    await message.answer(f"Поддержка: {ADMIN_USERNAME}\n{WORK_HOURS_TEXT_RU}" if u["lang"] == "ru"
-                         else f"Support: {ADMIN_USERNAME}\n{WORK_HOURS_TEXT_EN}",
-                         reply_markup=kb_support(u["lang"]))
+    u = await get_user(message.from_user.id)
+    await message.answer(t("support", u["lang"]), reply_markup=kb_support(u["lang"]))
 
 @dp.message(Command("start"))
 async def start_handler(message: Message):
-    await message.answer("Выберите язык / Choose language", reply_markup=kb_language())
+    await message.answer(t("choose_language", FALLBACK_LANG), reply_markup=kb_language())
 
 # /admin по-прежнему есть (если ADMIN_ID не задан в ENV)
 @dp.message(Command("admin"))
 async def admin_bind(message: Message):
     global ADMIN_ID
     if ADMIN_ID_ENV.isdigit():
-        await message.answer("✅ ADMIN_ID задан через Environment. Привязка /admin не требуется.")
+        await message.answer(t("admin_env_bound", "ru"))
         return
     ADMIN_ID = message.from_user.id
     save_admin_id(ADMIN_ID)
-    await message.answer("✅ Админ привязан. Теперь заявки будут приходить сюда.")
+    await message.answer(t("admin_bound", "ru"))
+
+# /orders — открытые заявки постранично, /orders <user_id> — последние заявки юзера
+def format_order_line(req: dict) -> str:
+    what = f"{req['months']} мес." if req["kind"] == "sub" else "topup"
+    created = datetime.fromtimestamp(req["created_at"]).strftime("%m-%d %H:%M")
+    return f"{req['order_id']} | {req['status']} | {what} | ${req['amount_usd']} | {req['method']} | {created} | id={req['user_id']}"
+
+def kb_orders_next(last_order_id: str):
+    kb = InlineKeyboardBuilder()
+    kb.button(text=t("btn_next", "ru"), callback_data=f"orders:{last_order_id}")
+    return kb.as_markup()
+
+async def render_open_orders(after: str | None):
+    page = await db_call(STORAGE.list_open_orders, after, ORDERS_PAGE)
+    if not page:
+        return t("orders_no_more" if after else "orders_none", "ru"), None
+    text = t("orders_header", "ru", lines="\n".join(format_order_line(r) for r in page))
+    markup = kb_orders_next(page[-1]["order_id"]) if len(page) == ORDERS_PAGE else None
+    return text, markup
+
+@dp.message(Command("orders"))
+async def cmd_orders(message: Message):
+    if not ADMIN_ID or message.from_user.id != ADMIN_ID:
+        return
+    arg = (message.text or "").split(maxsplit=1)[1:]
+    if arg and arg[0].strip().isdigit():
+        orders = await db_call(STORAGE.list_user_orders, int(arg[0]), ORDERS_PAGE)
+        await message.answer("\n".join(format_order_line(r) for r in orders) or t("orders_user_none", "ru"))
+        return
+    text, markup = await render_open_orders(None)
+    await message.answer(text, reply_markup=markup)
+
+@dp.message(Command("profile"))
+async def cmd_profile(message: Message):
+    if not ADMIN_ID or message.from_user.id != ADMIN_ID:
+        return
+    args = (message.text or "").split()[1:]
+    mode = args[0].lower() if args else ""
+    seconds = args[1] if len(args) > 1 else "30"
+    if mode not in PROFILE_MODES or not seconds.isdigit() or not 1 <= int(seconds) <= PROFILE_MAX_SECONDS:
+        await message.answer(t("profile_usage", "ru", max=PROFILE_MAX_SECONDS))
+        return
+    if not start_profile(mode, int(seconds)):
+        await message.answer(t("profile_busy", "ru"))
+        return
+    await message.answer(t("profile_started", "ru", mode=mode, seconds=seconds))
+
+@dp.message(Command("queue"))
+async def cmd_queue(message: Message):
+    if not ADMIN_ID or message.from_user.id != ADMIN_ID:
+        return
+    await message.answer(t("queue_stats", "ru", **OUTBOX.stats()))
+
+@dp.message(Command("cache"))
+async def cmd_cache(message: Message):
+    if not ADMIN_ID or message.from_user.id != ADMIN_ID:
+        return
+    await message.answer(t("cache_stats", "ru", **USER.stats()))
+
+@callback_route("orders", nargs=1)
+async def orders_page(cb: CallbackQuery, cd: Callback):
+    if not ADMIN_ID or cb.from_user.id != ADMIN_ID:
+        await cb.answer(t("not_allowed", "ru"), show_alert=True)
+        return
+    text, markup = await render_open_orders(cd.args[0])
+    await safe_edit(cb, text, reply_markup=markup)
+    await cb.answer()
 
 # =====================
 # NAV
 # =====================
-@dp.callback_query(F.data == "nav:home")
-async def nav_home(cb: CallbackQuery):
-    u = get_user(cb.from_user.id)
-    reset_flow(u)
+@callback_route("nav", "home")
+async def nav_home(cb: CallbackQuery, cd: Callback):
+    u = await get_user(cb.from_user.id)
+    reset_flow(cb.from_user.id, u)
     await safe_edit(cb, main_menu_text(u["lang"]), reply_markup=kb_main(u["lang"]))
     await cb.answer()
 
-@dp.callback_query(F.data == "nav:cancel")
-async def nav_cancel(cb: CallbackQuery):
-    u = get_user(cb.from_user.id)
-    reset_flow(u)
-    await safe_edit(cb, "✅ Отменено.\n\n" + main_menu_text(u["lang"]) if u["lang"] == "ru"
-                    else "✅ Cancelled.\n\n" + main_menu_text(u["lang"]),
-                    reply_markup=kb_main(u["lang"]))
+@callback_route("nav", "cancel")
+async def nav_cancel(cb: CallbackQuery, cd: Callback):
+    u = await get_user(cb.from_user.id)
+    reset_flow(cb.from_user.id, u)
+    await safe_edit(cb, t("cancelled", u["lang"]), reply_markup=kb_main(u["lang"]))
     await cb.answer()
 
-@dp.callback_query(F.data == "nav:back_prev")
-async def back_prev(cb: CallbackQuery):
-    u = get_user(cb.from_user.id)
+@callback_route("nav", "back_prev")
+async def back_prev(cb: CallbackQuery, cd: Callback):
+    u = await get_user(cb.from_user.id)
     lang = u["lang"]
     if u.get("flow") == "sub":
-        await safe_edit(cb, "Выберите вариант подписки" if lang == "ru" else "Choose subscription option",
-                        reply_markup=kb_sub_months(lang))
+        await safe_edit(cb, t("choose_sub", lang), reply_markup=kb_sub_months(lang))
     elif u.get("flow") == "topup":
-        await safe_edit(cb, "Выберите сумму пополнения" if lang == "ru" else "Choose top up amount",
-                        reply_markup=kb_topup_amounts(lang))
+        await safe_edit(cb, t("choose_topup", lang), reply_markup=kb_topup_amounts(lang))
     else:
         await safe_edit(cb, main_menu_text(lang), reply_markup=kb_main(lang))
     await cb.answer()
 
-@dp.callback_query(F.data == "nav:back_pay")
-async def back_pay(cb: CallbackQuery):
-    u = get_user(cb.from_user.id)
-    await safe_edit(cb, "Выберите способ оплаты" if u["lang"] == "ru" else "Choose payment method",
-                    reply_markup=kb_pay_method(u["lang"]))
+@callback_route("nav", "back_pay")
+async def back_pay(cb: CallbackQuery, cd: Callback):
+    u = await get_user(cb.from_user.id)
+    await safe_edit(cb, t("choose_pay", u["lang"]), reply_markup=kb_pay_method(u["lang"]))
     await cb.answer()
 
 # =====================
 # LANGUAGE
 # =====================
-@dp.callback_query(F.data.startswith("lang:"))
-async def lang_handler(cb: CallbackQuery):
-    lang = cb.data.split(":", 1)[1]
-    u = get_user(cb.from_user.id)
+@callback_route("lang", nargs=1)
+async def lang_handler(cb: CallbackQuery, cd: Callback):
+    lang = norm_lang(cd.args[0])
+    u = await get_user(cb.from_user.id)
     u["lang"] = lang
-    reset_flow(u)
+    reset_flow(cb.from_user.id, u)
     await safe_edit(cb, main_menu_text(lang), reply_markup=kb_main(lang))
     await cb.answer()
 
 # =====================
 # MENU
 # =====================
-@dp.callback_query(F.data.startswith("menu:"))
-async def menu_handler(cb: CallbackQuery):
-    u = get_user(cb.from_user.id)
+@callback_route("menu", nargs=1)
+async def menu_handler(cb: CallbackQuery, cd: Callback):
+    u = await get_user(cb.from_user.id)
     lang = u["lang"]
-    action = cb.data.split(":", 1)[1]
+    action = cd.args[0]
 
     if action == "buy_sub":
-        reset_flow(u)
+        reset_flow(cb.from_user.id, u)
         u["flow"] = "sub"
-        save_state()
-        await safe_edit(cb, "Выберите вариант подписки" if lang == "ru" else "Choose subscription option",
-                        reply_markup=kb_sub_months(lang))
+        save_state(cb.from_user.id)
+        await safe_edit(cb, t("choose_sub", lang), reply_markup=kb_sub_months(lang))
         await cb.answer()
         return
 
     if action == "topup":
-        reset_flow(u)
+        reset_flow(cb.from_user.id, u)
         u["flow"] = "topup"
-        save_state()
-        await safe_edit(cb, "Выберите сумму пополнения" if lang == "ru" else "Choose top up amount",
-                        reply_markup=kb_topup_amounts(lang))
+        save_state(cb.from_user.id)
+        await safe_edit(cb, t("choose_topup", lang), reply_markup=kb_topup_amounts(lang))
         await cb.answer()
         return
 
     if action == "support":
-        await safe_edit(cb, (f"Поддержка: {ADMIN_USERNAME}\n{WORK_HOURS_TEXT_RU}" if lang == "ru"
-                            else f"Support: {ADMIN_USERNAME}\n{WORK_HOURS_TEXT_EN}"),
-                        reply_markup=kb_support(lang))
+        await safe_edit(cb, t("support", lang), reply_markup=kb_support(lang))
         await cb.answer()
         return
 
 # =====================
 # SUB
 # =====================
-@dp.callback_query(F.data.startswith("sub:"))
-async def sub_handler(cb: CallbackQuery):
-    u = get_user(cb.from_user.id)
+@callback_route("sub", nargs=1)
+async def sub_handler(cb: CallbackQuery, cd: Callback):
+    u = await get_user(cb.from_user.id)
     lang = u["lang"]
-    value = cb.data.split(":", 1)[1]
+    value = cd.args[0]
 
     if value == "custom":
         if not ADMIN_ID:
-            await safe_edit(cb, "❗ Админ не привязан. Админ должен написать /admin." if lang == "ru"
-                            else "❗ Admin is not set. Admin must send /admin.",
-                            reply_markup=kb_cancel_payment(lang))
+            await safe_edit(cb, t("admin_not_set", lang), reply_markup=kb_cancel_payment(lang))
             await cb.answer()
             return
 
-        order_id = make_order_id(cb.from_user.id)
-        await bot.send_message(
-            ADMIN_ID,
-            "🟣 CUSTOM REQUEST\n"
-            f"Time: {now_str()}\n"
-            f"Order: {order_id}\n"
-            f"User: {format_user(cb)}\n"
-        )
-        await safe_edit(cb, "✅ Заявка на Custom отправлена." if lang == "ru" else "✅ Custom request sent.",
-                        reply_markup=kb_main(lang))
+        order_id = make_order_id()
+        admin_text = t("admin_custom", "ru", time=now_str(), order_id=order_id, user=format_user(cb))
+        OUTBOX.post(bot.send_message(ADMIN_ID, admin_text))
+        await safe_edit(cb, t("custom_sent", lang), reply_markup=kb_main(lang))
         await cb.answer()
         return
 
     u["flow"] = "sub"
     u["sub_months"] = int(value)
-    u["order_id"] = make_order_id(cb.from_user.id)
+    u["order_id"] = make_order_id()
     u["step"] = None
-    save_state()
+    u["rate"] = PRICES.rate
+    save_state(cb.from_user.id)
 
     months = u["sub_months"]
-    usd      = SUB_PRICES[months]["usd"]
-    rub      = SUB_PRICES[months]["rub"]
-    discount = SUB_PRICES[months]["discount"]
-    disc_txt = f" (скидка {discount}%)" if discount > 0 else ""
-    disc_en  = f" ({discount}% off)"    if discount > 0 else ""
-
-    await safe_edit(
-        cb,
-        (f"💳 Подписка: {months} мес.{disc_txt}\n"
-         f"Сумма: {rub} ₽  |  ${usd}\n\nВыберите способ оплаты:"
-         if lang == "ru" else
-         f"💳 Subscription: {months} mo.{disc_en}\n"
-         f"Amount: ${usd}  |  {rub} RUB\n\nChoose payment method:"),
-        reply_markup=kb_pay_method(lang)
-    )
+    usd      = PRICES.sub[months]["usd"]
+    rub      = PRICES.sub[months]["rub"]
+    discount = PRICES.sub[months]["discount"]
+    disc = t("sub_disc_note", lang, discount=discount) if discount > 0 else ""
+
+    await safe_edit(cb, t("sub_summary", lang, months=months, disc=disc, usd=usd, rub=rub),
+                    reply_markup=kb_pay_method(lang))
     await cb.answer()
 
 # =====================
 # TOPUP
 # =====================
-@dp.callback_query(F.data.startswith("topup:"))
-async def topup_amount_handler(cb: CallbackQuery):
-    u = get_user(cb.from_user.id)
+@callback_route("topup", nargs=1)
+async def topup_amount_handler(cb: CallbackQuery, cd: Callback):
+    u = await get_user(cb.from_user.id)
     lang = u["lang"]
 
     u["flow"] = "topup"
-    u["topup_usd"] = int(cb.data.split(":", 1)[1])
-    u["order_id"] = make_order_id(cb.from_user.id)
+    u["topup_usd"] = int(cd.args[0])
+    u["order_id"] = make_order_id()
     u["email"] = None
     u["step"] = "wait_topup_email"
-    save_state()
+    u["rate"] = PRICES.rate
+    save_state(cb.from_user.id)
 
     usd = u["topup_usd"]
-    rub = TOPUP_PRICES[usd]["rub"]
-
-    await safe_edit(
-        cb,
-        (f"Пополнение: ${usd} | {rub} ₽\n\nТеперь отправьте почту от аккаунта одним сообщением.")
-        if lang == "ru" else
-        (f"Top up: ${usd} | {rub} RUB\n\nNow send your account email in one message."),
-        reply_markup=kb_cancel_payment(lang)
-    )
+    rub = PRICES.topup[usd]["rub"]
+
+    await safe_edit(cb, t("topup_ask_email", lang, usd=usd, rub=rub), reply_markup=kb_cancel_payment(lang))
     await cb.answer()
 
 # =====================
 # PAY METHOD
 # =====================
-@dp.callback_query(F.data.startswith("pay:"))
-async def pay_handler(cb: CallbackQuery):
-    u = get_user(cb.from_user.id)
+@callback_route("pay", nargs=1)
+async def pay_handler(cb: CallbackQuery, cd: Callback):
+    method = cd.args[0]
+    if method not in PAY_METHOD_CODES[1:]:
+        await cb.answer()
+        return
+    u = await get_user(cb.from_user.id)
     lang = u["lang"]
-    method = cb.data.split(":", 1)[1]
     u["pay_method"] = method
 
     # TOPUP needs email
     if u.get("flow") == "topup":
         if not u.get("email"):
-            await cb.answer("Сначала укажите email." if lang == "ru" else "Enter email first.")
+            await cb.answer(t("need_email", lang))
             return
 
         usd = u["topup_usd"]
-        rub = TOPUP_PRICES[usd]["rub"]
+        rub = quoted(u).topup[usd]["rub"]
 
         if method == "sbp":
             u["step"] = "wait_sbp_receipt"
-            save_state()
-            await safe_edit(
-                cb,
-                (f"🏦 СБП/перевод\n\n"
-                 f"Пополнение: ${usd} | {rub} ₽\n"
-                 f"Email: {u['email']}\n\n"
-                 f"Банк: {SBP_BANK}\n"
-                 f"Получатель: {SBP_RECEIVER}\n"
-                 f"Номер/телефон: {SBP_TO}\n\n"
-                 f"После оплаты пришлите сюда ЧЕК/СКРИН (как фото или файл).")
-                if lang == "ru" else
-                (f"🏦 SBP transfer\n\n"
-                 f"Top up: ${usd} | {rub} RUB\n"
-                 f"Email: {u['email']}\n\n"
-                 f"Bank: {SBP_BANK}\n"
-                 f"Receiver: {SBP_RECEIVER}\n"
-                 f"Phone/card: {SBP_TO}\n\n"
-                 f"After payment, send RECEIPT/SCREENSHOT here (photo or file)."),
-                reply_markup=kb_cancel_payment(lang)
-            )
+            save_state(cb.from_user.id)
+            await safe_edit(cb, t("sbp_topup", lang, usd=usd, rub=rub, email=u["email"]),
+                            reply_markup=kb_cancel_payment(lang))
             await cb.answer()
             return
 
         if method == "crypto":
             u["step"] = "choose_coin"
-            save_state()
-            await safe_edit(
-                cb,
-                (f"Пополнение: ${usd} | {rub} ₽\nEmail: {u['email']}\n\nВыберите монету:")
-                if lang == "ru" else
-                (f"Top up: ${usd} | {rub} RUB\nEmail: {u['email']}\n\nChoose coin:"),
-                reply_markup=kb_crypto_coin(lang)
-            )
+            save_state(cb.from_user.id)
+            await safe_edit(cb, t("topup_choose_coin", lang, usd=usd, rub=rub, email=u["email"]),
+                            reply_markup=kb_crypto_coin(lang))
             await cb.answer()
             return
 
@@ -570,128 +2963,850 @@ async def pay_handler(cb: CallbackQuery):
     if u.get("flow") == "sub":
         months = u.get("sub_months")
         if not months:
-            await cb.answer("Сначала выберите срок подписки." if lang == "ru" else "Choose period first.")
+            await cb.answer(t("need_period", lang))
             return
 
-        usd = SUB_PRICES[months]["usd"]
-        rub = SUB_PRICES[months]["rub"]
+        usd = quoted(u).sub[months]["usd"]
+        rub = quoted(u).sub[months]["rub"]
 
         if method == "sbp":
             u["step"] = "wait_sbp_receipt"
-            save_state()
-            await safe_edit(
-                cb,
-                (f"🏦 СБП/перевод\n\n"
-                 f"Подписка: {months} мес.\n"
-                 f"Сумма: {rub} ₽  |  ${usd}\n\n"
-                 f"Банк: {SBP_BANK}\n"
-                 f"Получатель: {SBP_RECEIVER}\n"
-                 f"Номер/телефон: {SBP_TO}\n\n"
-                 f"После оплаты пришлите сюда ЧЕК/СКРИН (как фото или файл).")
-                if lang == "ru" else
-                (f"🏦 SBP transfer\n\n"
-                 f"Subscription: {months} mo.\n"
-                 f"Amount: ${usd}  |  {rub} RUB\n\n"
-                 f"Bank: {SBP_BANK}\n"
-                 f"Receiver: {SBP_RECEIVER}\n"
-                 f"Phone/card: {SBP_TO}\n\n"
-                 f"After payment, send RECEIPT/SCREENSHOT here (photo or file)."),
-                reply_markup=kb_cancel_payment(lang)
-            )
+            save_state(cb.from_user.id)
+            await safe_edit(cb, t("sbp_sub", lang, months=months, usd=usd, rub=rub),
+                            reply_markup=kb_cancel_payment(lang))
             await cb.answer()
             return
 
         if method == "crypto":
             u["step"] = "choose_coin"
-            save_state()
-            await safe_edit(
-                cb,
-                (f"Подписка: {months} мес.\nСумма: {rub} ₽  |  ${usd}\n\nВыберите монету:")
-                if lang == "ru" else
-                (f"Subscription: {months} mo.\nAmount: ${usd}  |  {rub} RUB\n\nChoose coin:"),
-                reply_markup=kb_crypto_coin(lang)
-            )
+            save_state(cb.from_user.id)
+            await safe_edit(cb, t("sub_choose_coin", lang, months=months, usd=usd, rub=rub),
+                            reply_markup=kb_crypto_coin(lang))
             await cb.answer()
             return
 
-    save_state()
+    save_state(cb.from_user.id)
     await cb.answer()
 
 # =====================
 # COIN
 # =====================
-@dp.callback_query(F.data.startswith("coin:"))
-async def coin_handler(cb: CallbackQuery):
-    u = get_user(cb.from_user.id)
+@callback_route("coin", nargs=1)
+async def coin_handler(cb: CallbackQuery, cd: Callback):
+    if cd.args[0] not in CRYPTO_ADDR:
+        await cb.answer()
+        return
+    u = await get_user(cb.from_user.id)
     lang = u["lang"]
-    u["coin"] = cb.data.split(":", 1)[1]
+    u["coin"] = cd.args[0]
     u["step"] = "wait_txid"
-    save_state()
-
-    address = CRYPTO_ADDR.get(u["coin"], "ADDRESS_NOT_SET")
+    if DEPOSITS.enabled:
+        u["order_id"] = u.get("order_id") or make_order_id()
+        address = await DEPOSITS.allocate(u["coin"], u["order_id"], cb.from_user.id)
+    else:
+        address = CRYPTO_ADDR.get(u["coin"], "ADDRESS_NOT_SET")
 
     if u.get("flow") == "sub":
         months = u["sub_months"]
-        usd = SUB_PRICES[months]["usd"]
-        rub = SUB_PRICES[months]["rub"]
-        head = f"Подписка: {months} мес.\nСумма: {rub} ₽  |  ${usd}\nМонета: {u['coin']}"
+        usd = quoted(u).sub[months]["usd"]
+        rub = quoted(u).sub[months]["rub"]
+        head = t("crypto_head_sub", lang, months=months, usd=usd, rub=rub, coin=u["coin"])
     else:
         usd = u["topup_usd"]
-        rub = TOPUP_PRICES[usd]["rub"]
-        head = f"Пополнение: ${usd}  |  {rub} ₽\nEmail: {u.get('email')}\nМонета: {u['coin']}"
-
-    await safe_edit(
-        cb,
-        (f"₿ Crypto оплата\n\n{head}\n\nАдрес для оплаты:\n{address}\n\n"
-         f"После оплаты отправьте сюда txid / hash одним сообщением."),
-        reply_markup=kb_cancel_payment(lang)
-    )
+        rub = quoted(u).topup[usd]["rub"]
+        head = t("crypto_head_topup", lang, usd=usd, rub=rub, email=u.get("email"), coin=u["coin"])
+    # сумма в монете фиксируется здесь, по курсу на момент выбора: её видит юзер, с ней сверяет проверка
+    u["amount_coin"] = quote_coin_amount(u["coin"], usd)
+    save_state(cb.from_user.id)
+    if u["amount_coin"]:
+        head += "\n" + t("crypto_due", lang, amount=u["amount_coin"], coin=u["coin"])
+
+    await safe_edit(cb, t("crypto_pay", lang, head=head, address=address), reply_markup=kb_cancel_payment(lang))
     await cb.answer()
 
 # =====================
 # ADMIN APPROVE / REJECT
 # =====================
-@dp.callback_query(F.data.startswith("adm:"))
-async def admin_decision(cb: CallbackQuery):
+@callback_route("adm", nargs=2)
+async def admin_decision(cb: CallbackQuery, cd: Callback):
     if not ADMIN_ID or cb.from_user.id != ADMIN_ID:
-        await cb.answer("Not allowed", show_alert=True)
+        await cb.answer(t("not_allowed", "ru"), show_alert=True)
         return
 
-    _, action, order_id = cb.data.split(":", 2)
-    req = PENDING.get(order_id)
+    action, order_id = cd.args[0], cd.args[1]
+    status = {"approve": "approved", "reject": "rejected"}.get(action)
+    req = await db_call(STORAGE.settle_order, order_id, status) if status else None
 
     if not req:
-        await cb.answer("Заявка не найдена/уже обработана", show_alert=True)
+        await cb.answer(t("order_not_found", "ru"), show_alert=True)
         return
 
-    user_id = req["user_id"]
+    await notify_settled(req)
+    await DEPOSITS.release([order_id])
+    if ADMIN_DIGEST:
+        DIGEST_WAKE.set()
+    await cb.message.reply(t("order_approved" if action == "approve" else "order_rejected", "ru", order_id=order_id))
+    await cb.answer("OK")
+
+def notify_settled(req: dict) -> Awaitable[Message]:
+    """Сообщение юзеру о решении по заявке (корутина: ждать её или отдать в OUTBOX.post)."""
+    if req["status"] == "rejected":
+        text = t("rejected", "ru")
+    elif req["kind"] == "sub":
+        text = t("approved_sub", "ru", months=req["months"])
+    else:
+        text = t("approved_topup", "ru", usd=req["usd"])
+    return bot.send_message(req["user_id"], text, reply_markup=kb_main("ru"))
+
+# =====================
+# ADMIN DIGEST
+# =====================
+# ADMIN_DIGEST=1: новые заявки не шлются админу по одной. Фоновая задача раз в
+# ADMIN_DIGEST_INTERVAL перерисовывает одно сообщение со страницей открытых заявок;
+# номера отмечаются кнопками и закрываются пачкой одним settle_orders.
+DIGEST_PAGE = 15
+DIGEST_WAKE = asyncio.Event()
+DIGEST_SELECTED: set[str] = set()
+_DIGEST_SHOWN: list[str] = []           # order_id последней отрисованной страницы
+_DIGEST_MSG: int | None = None          # message_id дайджеста в чате админа
+# ключ страницы (в кнопке "✅ Всю страницу") -> её order_id. Фон перерисовывает дайджест в любой
+# момент, поэтому кнопка закрывает ровно ту страницу, на которой её нажали, а не последнюю.
+_DIGEST_PAGES: OrderedDict[str, list[str]] = OrderedDict()
+DIGEST_PAGES_KEPT = 32
+
+def digest_page_key(order_ids: list[str]) -> str:
+    return hashlib.blake2b(",".join(order_ids).encode(), digest_size=6).hexdigest()
+
+def notify_admin_order(order_id: str, text: str, photo: str | None = None, document: str | None = None):
+    if ADMIN_DIGEST:
+        DIGEST_WAKE.set()
+    elif photo:
+        OUTBOX.post(bot.send_photo(ADMIN_ID, photo, caption=text, reply_markup=kb_admin_decision(order_id)))
+    elif document:
+        OUTBOX.post(bot.send_document(ADMIN_ID, document, caption=text, reply_markup=kb_admin_decision(order_id)))
+    else:
+        OUTBOX.post(bot.send_message(ADMIN_ID, text, reply_markup=kb_admin_decision(order_id)))
+
+def format_digest_line(n: int, req: dict) -> str:
+    line = f"{n}. {format_order_line(req)}"
+    if req.get("txid"):
+        line += f"\n    TXID: {req['txid']}"
+    elif req.get("receipt"):
+        line += f"\n    🧾 чек — кнопка 🧾{n}"
+    return line
+
+def kb_digest(page: list[dict], page_key: str) -> InlineKeyboardMarkup:
+    kb = InlineKeyboardBuilder()
+    for n, req in enumerate(page, 1):
+        mark = "☑" if req["order_id"] in DIGEST_SELECTED else "☐"
+        kb.button(text=f"{mark}{n}", callback_data=f"dg:sel:{req['order_id']}")
+    receipts = [(n, req) for n, req in enumerate(page, 1) if req.get("receipt")]
+    for n, req in receipts:
+        kb.button(text=f"🧾{n}", callback_data=f"dg:proof:{req['order_id']}")
+    n_sel = len(DIGEST_SELECTED)
+    kb.button(text=t("btn_dg_approve_sel", "ru", n=n_sel), callback_data="dg:approve")
+    kb.button(text=t("btn_dg_reject_sel", "ru", n=n_sel), callback_data="dg:reject")
+    kb.button(text=t("btn_dg_approve_page", "ru"), callback_data=f"dg:approve_page:{page_key}")
+    kb.button(text=t("btn_dg_refresh", "ru"), callback_data="dg:refresh")
+    rows = [5] * (len(page) // 5) + ([len(page) % 5] if len(page) % 5 else [])
+    rows += [5] * (len(receipts) // 5) + ([len(receipts) % 5] if len(receipts) % 5 else [])
+    kb.adjust(*rows, 2, 2)
+    return kb.as_markup()
+
+async def render_digest() -> tuple[str, InlineKeyboardMarkup | None]:
+    page = await db_call(STORAGE.list_open_orders, None, DIGEST_PAGE)
+    _DIGEST_SHOWN[:] = [req["order_id"] for req in page]
+    DIGEST_SELECTED.intersection_update(_DIGEST_SHOWN)
+    if not page:
+        return t("digest_empty", "ru", time=now_str()), None
+    key = digest_page_key(_DIGEST_SHOWN)
+    _DIGEST_PAGES[key] = list(_DIGEST_SHOWN)
+    _DIGEST_PAGES.move_to_end(key)
+    while len(_DIGEST_PAGES) > DIGEST_PAGES_KEPT:
+        _DIGEST_PAGES.popitem(last=False)
+    lines = "\n".join(format_digest_line(n, req) for n, req in enumerate(page, 1))
+    return t("digest_header", "ru", time=now_str(), lines=lines), kb_digest(page, key)
+
+async def publish_digest():
+    global _DIGEST_MSG
+    text, markup = await render_digest()
+    if _DIGEST_MSG is not None:
+        try:
+            await bot.edit_message_text(text, chat_id=ADMIN_ID, message_id=_DIGEST_MSG, reply_markup=markup)
+            return
+        except TelegramBadRequest as e:
+            if "message is not modified" in str(e).lower():
+                return
+            # сообщение удалили — пришлём новое
+    _DIGEST_MSG = (await bot.send_message(ADMIN_ID, text, reply_markup=markup)).message_id
+
+async def digest_changed() -> bool:
+    page = await db_call(STORAGE.list_open_orders, None, DIGEST_PAGE)
+    return [req["order_id"] for req in page] != _DIGEST_SHOWN
 
-    if action == "approve":
-        if req["kind"] == "sub":
-            months = req["months"]
-            await bot.send_message(user_id, f"✅ Подписка активна на {months} мес.\nСпасибо за оплату!",
-                                   reply_markup=kb_main("ru"))
+async def admin_digest():
+    while True:
+        try:
+            # в шардах заявки создают и закрывают другие воркеры, их DIGEST_WAKE сюда не доходит:
+            # без локального сигнала раз в интервал сверяем первую страницу из базы с показанной
+            await asyncio.wait_for(DIGEST_WAKE.wait(), ADMIN_DIGEST_INTERVAL if SHARD else None)
+        except asyncio.TimeoutError:
+            pass
         else:
-            usd = req["usd"]
-            await bot.send_message(user_id, f"✅ Платёж подтверждён. Баланс пополнен на ${usd}.\nСпасибо!",
-                                   reply_markup=kb_main("ru"))
+            # копим заявки за интервал, чтобы не редактировать сообщение на каждую
+            await asyncio.sleep(ADMIN_DIGEST_INTERVAL)
+        woken = DIGEST_WAKE.is_set()
+        DIGEST_WAKE.clear()
+        if not ADMIN_ID:
+            continue
+        try:
+            if woken or await digest_changed():
+                await publish_digest()
+        except Exception as e:
+            print(f"⚠️ Admin digest failed: {e!r}")
 
-        PENDING.pop(order_id, None)
-        await cb.message.reply(f"✅ Подтверждено: {order_id}")
-        await cb.answer("OK")
+async def settle_bulk(order_ids: list[str], status: str) -> list[dict]:
+    settled = await db_call(STORAGE.settle_orders, order_ids, status)
+    for req in settled:
+        OUTBOX.post(notify_settled(req))
+    DIGEST_SELECTED.difference_update(order_ids)
+    await DEPOSITS.release([req["order_id"] for req in settled])
+    return settled
+
+@callback_route("dg", nargs=1)
+async def digest_action(cb: CallbackQuery, cd: Callback):
+    global _DIGEST_MSG
+    if not ADMIN_ID or cb.from_user.id != ADMIN_ID:
+        await cb.answer(t("not_allowed", "ru"), show_alert=True)
         return
 
-    if action == "reject":
-        await bot.send_message(user_id, f"❌ Платёж отклонён. Напишите в поддержку: {ADMIN_USERNAME}",
-                               reply_markup=kb_main("ru"))
-        PENDING.pop(order_id, None)
-        await cb.message.reply(f"❌ Отклонено: {order_id}")
-        await cb.answer("OK")
+    action = cd.args[0]
+    if action == "sel" and len(cd.args) > 1:
+        DIGEST_SELECTED.symmetric_difference_update({cd.args[1]})
+        await cb.answer()
+    elif action == "proof" and len(cd.args) > 1:
+        req = await db_call(STORAGE.get_order, cd.args[1])
+        if req and req.get("receipt"):
+            send = bot.send_photo if req.get("receipt_type") == "photo" else bot.send_document
+            await send(ADMIN_ID, req["receipt"], caption=req["order_id"], reply_markup=kb_admin_decision(req["order_id"]))
+        await cb.answer()
         return
+    elif action in ("approve", "reject"):
+        if not DIGEST_SELECTED:
+            await cb.answer(t("digest_nothing_selected", "ru"), show_alert=True)
+            return
+        n = len(await settle_bulk(list(DIGEST_SELECTED), "approved" if action == "approve" else "rejected"))
+        await cb.answer(t("digest_settled", "ru", n=n))
+    elif action == "approve_page":
+        shown = _DIGEST_PAGES.get(cd.args[1]) if len(cd.args) > 1 else None
+        if shown is None:
+            await cb.answer(t("digest_stale", "ru"), show_alert=True)
+        else:
+            n = len(await settle_bulk(shown, "approved"))
+            await cb.answer(t("digest_settled", "ru", n=n))
+    else:
+        await cb.answer()
+
+    if cb.message:
+        _DIGEST_MSG = cb.message.message_id
+    text, markup = await render_digest()
+    await safe_edit(cb, text, reply_markup=markup)
+
+# =====================
+# EXCHANGE RATES
+# =====================
+# RATES_SOURCE: фоновая задача раз в RATES_TTL берёт курсы у источников и применяет их
+# apply_rates(): новые таблицы цен, подписи кнопок и клавиатуры с ценами собираются заранее
+# и подменяются разом, без await посередине — хендлер видит либо старый набор, либо новый.
+# Юзер платит по курсу, который видел (Session.rate); он же пишется в заявку.
+class RateSource:
+    name = ""
+
+    async def fetch(self, http: ClientSession) -> dict[str, Decimal]:
+        raise NotImplementedError
+
+class CbrRates(RateSource):
+    """Курс ЦБ: {"Valute": {"USD": {"Nominal": 1, "Value": 92.5}}}."""
+    name = "cbr"
+
+    async def fetch(self, http: ClientSession) -> dict[str, Decimal]:
+        async with http.get(CBR_URL) as resp:
+            resp.raise_for_status()
+            usd = (await resp.json(content_type=None))["Valute"]["USD"]
+        return {"RUB": Decimal(str(usd["Value"])) / Decimal(usd["Nominal"])}
+
+class CoinGeckoRates(RateSource):
+    name = "coingecko"
+    IDS = {"bitcoin": "BTC", "ethereum": "ETH"}
+
+    async def fetch(self, http: ClientSession) -> dict[str, Decimal]:
+        params = {"ids": ",".join(self.IDS), "vs_currencies": "usd"}
+        async with http.get(COINGECKO_URL, params=params) as resp:
+            resp.raise_for_status()
+            data = await resp.json()
+        return {coin: Decimal(str(data[cid]["usd"])) for cid, coin in self.IDS.items() if cid in data}
+
+class FileRates(RateSource):
+    """Локальная замена для тестов и ручного управления: JSON {"RUB": 92.5, "BTC": 65000}."""
+    name = "file"
+
+    async def fetch(self, http: ClientSession) -> dict[str, Decimal]:
+        data = await asyncio.to_thread(self._read)
+        return {k: Decimal(str(v)) for k, v in data.items()}
+
+    @staticmethod
+    def _read() -> dict:
+        with open(RATES_FILE, "r", encoding="utf-8") as f:
+            return json.load(f)
+
+RATE_SOURCES: dict[str, RateSource] = {s.name: s for s in (CbrRates(), CoinGeckoRates(), FileRates())}
+
+def apply_rates(rates: Mapping[str, Decimal]) -> bool:
+    """Применить курсы; True — цены в рублях поменялись и клавиатуры пересобраны."""
+    global CRYPTO_USD_RATES, PRICES, SUB_LABELS, USD_TO_RUB
+    crypto = {coin: rate for coin, rate in rates.items() if coin in CRYPTO_ADDR and rate > 0}
+    if any(CRYPTO_USD_RATES.get(coin) != rate for coin, rate in crypto.items()):
+        CRYPTO_USD_RATES = {**CRYPTO_USD_RATES, **crypto}
+    rub = rates.get("RUB")
+    if not rub or rub <= 0 or float(rub) == PRICES.rate:
+        return False
+    table = prices_at(float(rub))
+    if table.sub == PRICES.sub and table.topup == PRICES.topup:
+        return False  # после округления до 10 ₽ ничего не поменялось — старые таблицы и кнопки остаются
+    labels = build_sub_labels(table)
+    # дальше без await: таблицы, подписи и клавиатуры меняются одним шагом loop'а
+    PRICES, SUB_LABELS, USD_TO_RUB = table, labels, table.rate
+    rebuild_keyboards(_KB_PRICED)
+    return True
+
+class RateProvider:
+    def __init__(self, sources: list[str]):
+        if unknown := set(sources) - set(RATE_SOURCES):
+            raise RuntimeError(f"Unknown RATES_SOURCE: {', '.join(sorted(unknown))} (known: {', '.join(RATE_SOURCES)})")
+        self.sources = [RATE_SOURCES[name] for name in sources]
+        self.cache: dict[str, tuple[float, dict[str, Decimal]]] = {}   # источник -> (когда, курсы)
+        self.failed = False
+        self.swaps = self.errors = 0
+
+    async def get(self, http: ClientSession) -> dict[str, Decimal]:
+        """Курсы всех источников; свежие (моложе RATES_TTL) берутся из кэша. Упавший источник
+        отдаёт последнее удачное значение."""
+        now = time.monotonic()
+        stale = [src for src in self.sources if now - self.cache.get(src.name, (-RATES_TTL, {}))[0] >= RATES_TTL]
+        results = await asyncio.gather(*(src.fetch(http) for src in stale), return_exceptions=True)
+        self.failed = any(isinstance(res, Exception) for res in results)
+        for src, res in zip(stale, results):
+            if isinstance(res, Exception):
+                self.errors += 1
+                print(f"⚠️ Rates from {src.name} failed: {res!r}")
+            else:
+                self.cache[src.name] = (now, res)
+        merged: dict[str, Decimal] = {}
+        for src in self.sources:
+            merged.update(self.cache.get(src.name, (0, {}))[1])
+        return merged
+
+    async def run(self):
+        async with ClientSession(timeout=ClientTimeout(total=15)) as http:
+            while True:
+                if apply_rates(await self.get(http)):
+                    self.swaps += 1
+                    print(f"💱 USD→RUB {PRICES.rate:g}: prices and keyboards updated")
+                # если кто-то из источников не ответил — повтор раньше, чем через полный TTL
+                await asyncio.sleep(min(RATES_TTL, 60) if self.failed else RATES_TTL)
+
+    def stats(self) -> dict[str, Any]:
+        return {"rate": PRICES.rate, "swaps": self.swaps, "errors": self.errors,
+                "crypto": {k: str(v) for k, v in CRYPTO_USD_RATES.items()}}
+
+RATES = RateProvider(RATES_SOURCE)
+
+# =====================
+# DEPOSIT ADDRESSES
+# =====================
+# DEPOSIT_POOL_FILE: каждой крипто-заявке — свой адрес из пула. Входящий перевод тогда находит
+# заявку по адресу получателя (словарь address -> заявка), без TXID от юзера и без угадывания
+# по сумме. Адрес живёт DEPOSIT_LEASE, после закрытия заявки или истечения ещё DEPOSIT_COOLDOWN
+# числится за ней (поздние платежи), потом возвращается в пул. Выдача атомарна в бэкенде —
+# в шардированном режиме воркеры делят один пул через SQLite.
+class DepositPool:
+    def __init__(self):
+        self.by_address: dict[str, dict] = {}   # занятые адреса своего шарда: address -> строка пула
+        self.by_order: dict[str, str] = {}
+        self.warned: dict[str, float] = {}
+        self.leased = self.fallbacks = 0
+
+    @property
+    def enabled(self) -> bool:
+        return bool(DEPOSIT_POOL_FILE)
+
+    @staticmethod
+    def key(address: str) -> str:
+        # ETH-адреса эксплореры отдают в нижнем регистре, base58/bech32 регистр не меняют
+        return address.lower() if address.startswith("0x") else address
+
+    def order_for(self, address: str) -> str | None:
+        row = self.by_address.get(self.key(address))
+        return row["order_id"] if row else None
+
+    def address_for(self, order_id: str | None, coin: str | None) -> str | None:
+        row = self.by_address.get(self.by_order.get(order_id or "", ""))
+        if row and row["coin"] == coin:
+            return row["address"]
+        return CRYPTO_ADDR.get(coin or "")
+
+    async def allocate(self, coin: str, order_id: str, uid: int) -> str:
+        """Адрес для заявки; повторный выбор той же монеты — тот же адрес. Пул пуст — общий CRYPTO_ADDR."""
+        row = self.by_address.get(self.by_order.get(order_id, ""))
+        if row and row["state"] == "leased":
+            if row["coin"] == coin:
+                return row["address"]
+            # юзер сменил монету: прежний адрес остывает сразу, а не висит занятым до конца аренды
+            await self.release([order_id])
+        addr = await db_call(STORAGE.lease_address, coin, order_id, uid, time.time() + DEPOSIT_LEASE)
+        if addr is None:
+            self.fallbacks += 1
+            self.warn_low(coin, 0)
+            return CRYPTO_ADDR[coin]
+        self.leased += 1
+        self._index({"address": addr, "coin": coin, "state": "leased", "order_id": order_id, "user_id": uid})
+        return addr
+
+    async def release(self, order_ids: list[str]):
+        if not self.enabled:
+            return
+        # в шардах заявки закрывает шард админа, а адреса чужих юзеров в его индексе нет —
+        # в бэкенд уходят все id, локальный индекс правится только по своим
+        ids = order_ids if SHARD else [oid for oid in order_ids if oid in self.by_order]
+        if ids:
+            await db_call(STORAGE.release_addresses, ids, time.time() + DEPOSIT_COOLDOWN)
+        for oid in order_ids:
+            if oid in self.by_order:
+                self.by_address[self.by_order[oid]]["state"] = "cooling"
+
+    def _index(self, row: dict):
+        self.by_address[self.key(row["address"])] = row
+        self.by_order[row["order_id"]] = self.key(row["address"])
+
+    async def reload(self):
+        # после свёртки сроков: индекс заново из бэкенда (его мог поменять и другой воркер)
+        rows = await db_call(STORAGE.list_held_addresses)
+        self.by_address.clear()
+        self.by_order.clear()
+        for row in rows:
+            if row["user_id"] is None or is_own_shard(row["user_id"]):
+                self._index(row)
+
+    async def refill(self):
+        try:
+            pairs = read_deposit_pool(DEPOSIT_POOL_FILE)
+        except OSError as e:
+            print(f"⚠️ Deposit pool {DEPOSIT_POOL_FILE}: {e}")
+            pairs = []
+        if added := await db_call(STORAGE.add_addresses, pairs):
+            print(f"✅ Deposit pool: +{added} addresses")
+        free = await db_call(STORAGE.count_free_addresses)
+        for coin in CRYPTO_ADDR:
+            if free.get(coin, 0) < DEPOSIT_POOL_LOW:
+                self.warn_low(coin, free.get(coin, 0))
+
+    def warn_low(self, coin: str, free: int):
+        # не чаще раза в час на монету и только из шарда админа
+        if ADMIN_ID and is_own_shard(ADMIN_ID) and time.monotonic() - self.warned.get(coin, -3600) >= 3600:
+            self.warned[coin] = time.monotonic()
+            OUTBOX.post(bot.send_message(ADMIN_ID, t("deposit_pool_low", "ru", coin=coin, free=free,
+                                                     path=DEPOSIT_POOL_FILE)))
+
+    async def keeper(self):
+        while True:
+            await asyncio.sleep(DEPOSIT_SWEEP_INTERVAL)
+            try:
+                if await db_call(STORAGE.expire_addresses, time.time(), DEPOSIT_COOLDOWN):
+                    await self.reload()
+                free = await db_call(STORAGE.count_free_addresses)
+                if any(free.get(coin, 0) < DEPOSIT_POOL_LOW for coin in CRYPTO_ADDR):
+                    await self.refill()
+            except Exception as e:
+                print(f"⚠️ Deposit pool sweep failed: {e!r}")
+
+    def stats(self) -> dict[str, int]:
+        return {"held": len(self.by_address), "leased": self.leased, "fallbacks": self.fallbacks}
+
+def read_deposit_pool(path: str) -> list[tuple[str, str]]:
+    pairs = []
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            parts = line.split("#", 1)[0].split()
+            if len(parts) == 2 and parts[0] in CRYPTO_ADDR:
+                pairs.append((parts[0], parts[1]))
+    return pairs
+
+DEPOSITS = DepositPool()
+
+# =====================
+# DUPLICATE PROOFS
+# =====================
+# Каждый принятый TXID и чек (file_unique_id — один и тот же у пересланного/повторно
+# загруженного файла) закрепляется за заявкой навсегда. Повтор по другой заявке отбивается
+# сразу, до уведомления админа, а админу уходит флаг. Перед бэкендом — Bloom-фильтр в памяти:
+# на "точно новый" (почти все) JSON-бэкенду не нужен поиск по снапшоту.
+class BloomFilter:
+    """Биты в bytearray, k позиций из одного 63-битного хэша (двойное хэширование)."""
+
+    def __init__(self, capacity: int, error_rate: float = 0.001):
+        self.capacity = max(capacity, 1024)
+        self.bits = max(8, int(-self.capacity * math.log(error_rate) / math.log(2) ** 2))
+        self.k = max(1, round(self.bits / self.capacity * math.log(2)))
+        self.array = bytearray((self.bits + 7) // 8)
+        self.count = 0
+
+    def _positions(self, h: int):
+        h1, h2 = h & 0xFFFFFFFF, (h >> 32) | 1
+        return ((h1 + i * h2) % self.bits for i in range(self.k))
+
+    def add(self, h: int):
+        for p in self._positions(h):
+            self.array[p >> 3] |= 1 << (p & 7)
+        self.count += 1
+
+    def __contains__(self, h: int) -> bool:
+        return all(self.array[p >> 3] & (1 << (p & 7)) for p in self._positions(h))
+
+def proof_hash(proof: str) -> int:
+    return int.from_bytes(hashlib.blake2b(proof.encode(), digest_size=8).digest(), "big") >> 1
+
+def proof_probe(h: int, proof: str) -> int:
+    # под хэшем уже другой proof (коллизия 63 бит) — следующая ячейка, как в открытой адресации
+    print(f"⚠️ Proof hash collision at {h}: {proof}")
+    return (h + 1) & ((1 << 63) - 1)
+
+def txid_proof(txid: str) -> str:
+    # один и тот же хэш с 0x и без, в любом регистре
+    txid = txid.strip().lower()
+    return "txid:" + (txid[2:] if txid.startswith("0x") else txid)
+
+class ProofIndex:
+    def __init__(self):
+        self.bloom = BloomFilter(0)
+        self.checks = self.bloom_negatives = self.duplicates = 0
+
+    async def load(self):
+        hashes = await db_call(STORAGE.proof_hashes)
+        self._rebuild(hashes, len(hashes) * 2)
+
+    def _rebuild(self, hashes: list[int], capacity: int):
+        bloom = BloomFilter(capacity)
+        for h in hashes:
+            bloom.add(h)
+        self.bloom = bloom
+
+    async def claim(self, proof: str, req: dict) -> dict | None:
+        """None — proof закреплён за заявкой req (или уже был за ней), и сама req записана в STORAGE
+        той же операцией; иначе запись чужой заявки, а req не записывается."""
+        h = proof_hash(proof)
+        self.checks += 1
+        known_new = h not in self.bloom
+        self.bloom_negatives += known_new
+        dup = await db_call(STORAGE.claim_proof, h, proof, req["order_id"], req["user_id"], known_new, req)
+        if dup is not None:
+            self.duplicates += 1
+            return dup
+        self.bloom.add(h)
+        if self.bloom.count > self.bloom.capacity:
+            # переполнение -> растёт доля ложных срабатываний; перестраиваем вдвое больше
+            self._rebuild(await db_call(STORAGE.proof_hashes), self.bloom.capacity * 2)
+        return None
+
+    def stats(self) -> dict[str, int]:
+        return {"checks": self.checks, "bloom_negatives": self.bloom_negatives, "duplicates": self.duplicates,
+                "bloom_items": self.bloom.count, "bloom_kb": len(self.bloom.array) // 1024}
+
+PROOFS = ProofIndex()
+
+async def reject_duplicate(message: Message, lang: str, msg_id: str, proof: str, order_id: str, dup: dict):
+    await message.answer(t(msg_id, lang), reply_markup=kb_cancel_payment(lang))
+    OUTBOX.post(bot.send_message(ADMIN_ID, t("admin_duplicate", "ru", proof=proof, user=format_user(message),
+                                             order_id=order_id, owner=dup["order_id"], owner_uid=dup["user_id"])))
+
+# =====================
+# TXID VERIFIER
+# =====================
+# TXID_VERIFY=1: заявка с TXID параллельно с уведомлением админу уходит в фоновую проверку.
+# Раз в тик все подошедшие по расписанию TXID группируются по монете, и на монету — один
+# запрос к эксплореру (или пачка параллельных, если API умеет только по одной транзакции).
+# Совпали адрес, сумма и подтверждения — заявка подтверждается тем же settle_orders, что
+# и у админа (кнопка, нажатая раньше, просто получит "уже обработана"). Сама — только если адрес
+# выдан из пула именно этой заявке: перевод на общий CRYPTO_ADDR мог сделать кто угодно.
+# Не совпало — флаг админу; не нашлась — повтор с backoff, через VERIFY_GIVE_UP — тоже к админу.
+class Transfer(NamedTuple):
+    txid: str
+    to_address: str
+    amount: Decimal
+    confirmations: int
+
+def quote_coin_amount(coin: str | None, usd: int) -> str | None:
+    """Сколько монет ждём за usd; строкой, чтобы Decimal пережил JSON. None — курса нет."""
+    if coin == "USDT_TRC20":
+        return str(Decimal(usd))
+    rate = CRYPTO_USD_RATES.get(coin or "")
+    return str((Decimal(usd) / rate).quantize(Decimal("1e-8"))) if rate else None
+
+class Explorer:
+    """Бэкенд одной сети: lookup() получает все TXID, которые пора проверить, и возвращает
+    найденные переводы на наш адрес (нет в ответе — пока не найден)."""
+    coin = ""
+
+    async def lookup(self, http: ClientSession, address: str, txids: list[str]) -> dict[str, Transfer]:
+        raise NotImplementedError
+
+class TronGridExplorer(Explorer):
+    """USDT TRC20: одна выборка последних входящих TRC20-переводов на адрес. only_confirmed —
+    только необратимые (solidified) блоки, поэтому подтверждения считаются набранными."""
+    coin = "USDT_TRC20"
+    CONTRACT = "TR7NHqjeKQxGTCi8q8ZY4pL8otSzgjLj6t"
+
+    async def lookup(self, http: ClientSession, address: str, txids: list[str]) -> dict[str, Transfer]:
+        headers = {"TRON-PRO-API-KEY": TRONGRID_API_KEY} if TRONGRID_API_KEY else None
+        params = {"only_confirmed": "true", "only_to": "true", "limit": "200", "contract_address": self.CONTRACT}
+        async with http.get(f"{TRONGRID_URL}/v1/accounts/{address}/transactions/trc20",
+                            params=params, headers=headers) as resp:
+            resp.raise_for_status()
+            data = (await resp.json())["data"]
+        wanted, found = set(txids), {}
+        for tx in data:
+            if tx["transaction_id"] in wanted:
+                amount = Decimal(tx["value"]).scaleb(-int(tx["token_info"]["decimals"]))
+                found[tx["transaction_id"]] = Transfer(tx["transaction_id"], tx["to"], amount,
+                                                       VERIFY_CONFIRMATIONS[self.coin])
+        return found
+
+class EsploraExplorer(Explorer):
+    """BTC (Blockstream/mempool.space API): высота сети — один запрос на пачку, транзакции — по одной
+    параллельно (в выдаче по адресу только 25 последних)."""
+    coin = "BTC"
+
+    async def lookup(self, http: ClientSession, address: str, txids: list[str]) -> dict[str, Transfer]:
+        async with http.get(f"{ESPLORA_URL}/blocks/tip/height") as resp:
+            resp.raise_for_status()
+            tip = int(await resp.text())
+
+        async def one(txid: str) -> Transfer | None:
+            async with http.get(f"{ESPLORA_URL}/tx/{txid}") as resp:
+                if resp.status in (400, 404):
+                    return None
+                resp.raise_for_status()
+                tx = await resp.json()
+            sats = sum(out["value"] for out in tx["vout"] if out.get("scriptpubkey_address") == address)
+            status = tx["status"]
+            conf = tip - status["block_height"] + 1 if status.get("confirmed") else 0
+            return Transfer(txid, address if sats else "", Decimal(sats).scaleb(-8), conf)
+
+        results = await asyncio.gather(*(one(txid) for txid in txids))
+        return {r.txid: r for r in results if r is not None}
+
+class EtherscanExplorer(Explorer):
+    """ETH: одна выборка последних транзакций адреса (txlist), подтверждения есть в ответе."""
+    coin = "ETH"
+
+    async def lookup(self, http: ClientSession, address: str, txids: list[str]) -> dict[str, Transfer]:
+        params = {"module": "account", "action": "txlist", "address": address, "page": "1", "offset": "200",
+                  "sort": "desc"}
+        if ETHERSCAN_API_KEY:
+            params["apikey"] = ETHERSCAN_API_KEY
+        async with http.get(ETHERSCAN_URL, params=params) as resp:
+            resp.raise_for_status()
+            body = await resp.json()
+        if body.get("status") != "1" and body.get("message") != "No transactions found":
+            raise RuntimeError(f"etherscan: {body.get('message')} {body.get('result')}")
+        wanted, found = {t.lower(): t for t in txids}, {}
+        for tx in body.get("result") or []:
+            txid = wanted.get(tx["hash"].lower())
+            if txid and tx.get("isError", "0") == "0":
+                found[txid] = Transfer(txid, tx["to"], Decimal(tx["value"]).scaleb(-18), int(tx["confirmations"]))
+        return found
+
+EXPLORERS: dict[str, Explorer] = {e.coin: e for e in (TronGridExplorer(), EsploraExplorer(), EtherscanExplorer())}
+
+class TxidCheck:
+    __slots__ = ("order_id", "coin", "address", "txid", "amount", "created", "attempt", "due")
+
+    def __init__(self, req: dict, due: float):
+        self.order_id, self.coin, self.address, self.txid = req["order_id"], req["coin"], req["address"], req["txid"]
+        self.amount = Decimal(req["amount_coin"]) if req.get("amount_coin") else None
+        self.created, self.attempt, self.due = req["created_at"], 0, due
+
+class TxidVerifier:
+    CACHE_SIZE = 10_000
+
+    def __init__(self, explorers: Mapping[str, Explorer] = EXPLORERS):
+        self.explorers = explorers
+        self.pending: dict[str, TxidCheck] = {}
+        self.wake = asyncio.Event()
+        # (coin, txid) -> (годен до, Transfer | None): найденное с нужными подтверждениями не меняется
+        self.cache: OrderedDict[tuple[str, str], tuple[float, Transfer | None]] = OrderedDict()
+        self.backend_backoff: dict[str, float] = {}
+        self.backend_fails: dict[str, int] = {}
+        self.lookups = self.cache_hits = self.approved = self.flagged = self.errors = 0
+
+    def submit(self, req: dict, delay: float | None = None):
+        if req.get("coin") in self.explorers and req.get("address"):
+            self.pending[req["order_id"]] = TxidCheck(req, time.monotonic() + (VERIFY_INTERVAL if delay is None else delay))
+            self.wake.set()
+
+    async def restore(self):
+        # после рестарта: открытые крипто-заявки с TXID своего шарда снова в очередь
+        after = None
+        while page := await db_call(STORAGE.list_open_orders, after, 500):
+            for req in page:
+                # просроченные админ уже видел во флаге до рестарта — не дублируем
+                if req.get("txid") and is_own_shard(req["user_id"]) and time.time() - req["created_at"] < VERIFY_GIVE_UP:
+                    self.submit(req, delay=0)
+            after = page[-1]["order_id"]
+
+    async def run(self):
+        restored = False
+        connector = TCPConnector(limit=VERIFY_POOL, ttl_dns_cache=300)
+        async with ClientSession(connector=connector, timeout=ClientTimeout(total=20)) as http:
+            while True:
+                # любая ошибка тика (бэкенд занят, settle упал) — в лог, задача живёт дальше
+                try:
+                    if not restored:
+                        await self.restore()
+                        restored = True
+                    await self.tick(http)
+                except Exception as e:
+                    self.errors += 1
+                    print(f"⚠️ TXID verifier tick failed: {e!r}")
+                now = time.monotonic()
+                next_due = min((c.due for c in self.pending.values()), default=now + VERIFY_MAX_INTERVAL)
+                self.wake.clear()
+                try:
+                    await asyncio.wait_for(self.wake.wait(), max(next_due - time.monotonic(), 0.05))
+                except asyncio.TimeoutError:
+                    pass
+
+    async def tick(self, http: ClientSession):
+        now = time.monotonic()
+        due: dict[str, list[TxidCheck]] = {}
+        for check in self.pending.values():
+            if check.due <= now and self.backend_backoff.get(check.coin, 0) <= now:
+                due.setdefault(check.coin, []).append(check)
+        if due:
+            results = await asyncio.gather(*(self.check_coin(http, coin, checks) for coin, checks in due.items()),
+                                           return_exceptions=True)
+            if errors := [r for r in results if isinstance(r, Exception)]:
+                raise errors[0]
+
+    async def check_coin(self, http: ClientSession, coin: str, checks: list[TxidCheck]):
+        now = time.monotonic()
+        found: dict[str, Transfer | None] = {}
+        misses: dict[str, list[str]] = {}
+        for c in checks:
+            hit = self.cache.get((coin, c.txid))
+            if hit and hit[0] > now:
+                self.cache_hits += 1
+                found[c.txid] = hit[1]
+            else:
+                misses.setdefault(c.address, []).append(c.txid)
+        try:
+            for address, txids in misses.items():
+                self.lookups += 1
+                result = await self.explorers[coin].lookup(http, address, txids)
+                for txid in txids:
+                    tr = found[txid] = result.get(txid)
+                    final = tr is not None and tr.confirmations >= VERIFY_CONFIRMATIONS[coin]
+                    self._remember((coin, txid), tr, now + (VERIFY_GIVE_UP if final else VERIFY_INTERVAL / 2))
+        except Exception as e:
+            # эксплорер лежит/лимитирует — откладываем всю монету, заявки не трогаем
+            self.errors += 1
+            fails = self.backend_fails[coin] = self.backend_fails.get(coin, 0) + 1
+            wait = min(VERIFY_INTERVAL * 2 ** min(fails, 6), VERIFY_MAX_INTERVAL)
+            self.backend_backoff[coin] = now + wait
+            print(f"⚠️ {coin} explorer failed: {e!r}, retry in {wait:.0f}s")
+            return
+        self.backend_fails.pop(coin, None)
+
+        approve: list[TxidCheck] = []
+        for c in checks:
+            verdict = self._verdict(c, found.get(c.txid))
+            if verdict == "ok":
+                approve.append(c)
+            elif verdict == "wait":
+                c.attempt += 1
+                c.due = now + min(VERIFY_INTERVAL * 2 ** c.attempt, VERIFY_MAX_INTERVAL)
+                if time.time() - c.created > VERIFY_GIVE_UP:
+                    del self.pending[c.order_id]
+                    self.flagged += 1
+                    OUTBOX.post(bot.send_message(ADMIN_ID, t("verify_timeout", "ru", order_id=c.order_id, txid=c.txid,
+                                                                hours=round(VERIFY_GIVE_UP / 3600))))
+            else:
+                del self.pending[c.order_id]
+                self.flagged += 1
+                OUTBOX.post(bot.send_message(ADMIN_ID, t("verify_flagged", "ru", order_id=c.order_id, txid=c.txid,
+                                                            reason=verdict)))
+        if approve:
+            for c in approve:
+                c.due = now + VERIFY_INTERVAL  # settle упадёт — заявки останутся в очереди до следующего тика
+            # одной транзакцией; уже закрытые админом вручную settle_orders просто пропустит
+            settled = {req["order_id"] for req in await settle_bulk([c.order_id for c in approve], "approved")}
+            for c in approve:
+                self.pending.pop(c.order_id, None)
+            self.approved += len(settled)
+            if settled:
+                lines = "\n".join(f"{c.order_id}: {found[c.txid].amount} {c.coin}"
+                                  for c in approve if c.order_id in settled)
+                OUTBOX.post(bot.send_message(ADMIN_ID, t("verify_approved", "ru", lines=lines)))
+                if ADMIN_DIGEST:
+                    DIGEST_WAKE.set()
+
+    def _verdict(self, c: TxidCheck, tr: Transfer | None) -> str:
+        """ok / wait / текст причины для админа."""
+        if tr is None:
+            return "wait"
+        if not tr.to_address or tr.to_address.lower() != c.address.lower():
+            if other := DEPOSITS.order_for(tr.to_address):
+                return f"Перевод на адрес другой заявки {other}, а не на {c.address}"
+            return f"Перевод не на наш адрес {c.address}"
+        if c.amount is None:
+            return f"Найден перевод {tr.amount} {c.coin}, но курса {c.coin} нет — сумму не сверить"
+        if tr.amount < c.amount * (1 - VERIFY_AMOUNT_TOLERANCE):
+            return f"Сумма {tr.amount} {c.coin} меньше ожидаемой {c.amount}"
+        if tr.confirmations < VERIFY_CONFIRMATIONS[c.coin]:
+            return "wait"
+        # на общий CRYPTO_ADDR платят все: чужой публичный TXID подходит по адресу и сумме,
+        # так что сам по себе перевод не доказывает, кто платил — решает админ
+        if not DEPOSITS.enabled or DEPOSITS.order_for(c.address) != c.order_id:
+            return f"Перевод {tr.amount} {c.coin} найден, но на общий адрес {c.address} — плательщика не проверить"
+        return "ok"
+
+    def _remember(self, key: tuple[str, str], tr: Transfer | None, until: float):
+        self.cache[key] = (until, tr)
+        self.cache.move_to_end(key)
+        if len(self.cache) > self.CACHE_SIZE:
+            self.cache.popitem(last=False)
+
+    def stats(self) -> dict[str, int]:
+        return {"pending": len(self.pending), "lookups": self.lookups, "cache_hits": self.cache_hits,
+                "approved": self.approved, "flagged": self.flagged, "errors": self.errors}
+
+VERIFIER = TxidVerifier()
 
 # =====================
 # USER MESSAGES
 # =====================
+def admin_order_text(msg_prefix: str, u: Session, order_id: str, user: str, **extra) -> str:
+    # admin_crypto_sub / admin_crypto_topup / admin_sbp_sub / admin_sbp_topup
+    if u.get("flow") == "sub":
+        months = u["sub_months"]
+        return t(f"{msg_prefix}_sub", "ru", time=now_str(), order_id=order_id, user=user, months=months,
+                 usd=quoted(u).sub[months]["usd"], rub=quoted(u).sub[months]["rub"], **extra)
+    usd = u["topup_usd"]
+    return t(f"{msg_prefix}_topup", "ru", time=now_str(), order_id=order_id, user=user, email=u.get("email"),
+             usd=usd, rub=quoted(u).topup[usd]["rub"], **extra)
+
+def order_amount_usd(u: Session) -> int:
+    return PRICES.sub[u["sub_months"]]["usd"] if u.get("flow") == "sub" else u["topup_usd"]
+
 @dp.message()
 async def message_handler(message: Message):
     global ADMIN_ID
@@ -699,7 +3814,7 @@ async def message_handler(message: Message):
     if ADMIN_ID is None and ADMIN_ID_ENV.isdigit():
         ADMIN_ID = int(ADMIN_ID_ENV)
 
-    u = get_user(message.from_user.id)
+    u = await get_user(message.from_user.id)
     lang = u["lang"]
     text = (message.text or "").strip()
 
@@ -708,144 +3823,359 @@ async def message_handler(message: Message):
         if is_email(text):
             u["email"] = text
             u["step"] = None
-            save_state()
+            save_state(message.from_user.id)
 
             usd = u["topup_usd"]
-            rub = TOPUP_PRICES[usd]["rub"]
-            await message.answer(
-                (f"✅ Почта сохранена: {u['email']}\nПополнение: ${usd}  |  {rub} ₽\n\nВыберите способ оплаты:")
-                if lang == "ru" else
-                (f"✅ Email saved: {u['email']}\nTop up: ${usd}  |  {rub} RUB\n\nChoose payment method:"),
-                reply_markup=kb_pay_method(lang)
-            )
+            rub = quoted(u).topup[usd]["rub"]
+            await message.answer(t("email_saved", lang, email=u["email"], usd=usd, rub=rub),
+                                 reply_markup=kb_pay_method(lang))
             return
         else:
-            await message.answer("Пришлите корректную почту (email)." if lang == "ru" else "Send a valid email.",
-                                 reply_markup=kb_cancel_payment(lang))
+            await message.answer(t("email_invalid", lang), reply_markup=kb_cancel_payment(lang))
             return
 
     # txid/hash
     if u.get("step") == "wait_txid" and is_txid(text):
         if not ADMIN_ID:
-            await message.answer("❗ Админ не привязан. Админ должен написать /admin." if lang == "ru"
-                                 else "❗ Admin is not set. Admin must send /admin.",
-                                 reply_markup=kb_cancel_payment(lang))
+            await message.answer(t("admin_not_set", lang), reply_markup=kb_cancel_payment(lang))
             return
 
-        order_id = u.get("order_id") or make_order_id(message.from_user.id)
+        order_id = u.get("order_id") or make_order_id()
         u["order_id"] = order_id
-
-        if u.get("flow") == "sub":
-            months = u["sub_months"]
-            usd = SUB_PRICES[months]["usd"]
-            rub = SUB_PRICES[months]["rub"]
-            PENDING[order_id] = {"kind": "sub", "user_id": message.from_user.id, "months": months}
-            admin_text = (
-                "🟢 PAYMENT (CRYPTO) — SUBSCRIPTION\n"
-                f"Time: {now_str()}\n"
-                f"Order: {order_id}\n"
-                f"User: {format_user(message)}\n"
-                f"Subscription: {months} months\n"
-                f"Amount: ${usd} | {rub} RUB\n"
-                f"Coin: {u.get('coin')}\n"
-                f"TXID: {text}\n"
-            )
-        else:
-            usd = u["topup_usd"]
-            rub = TOPUP_PRICES[usd]["rub"]
-            PENDING[order_id] = {"kind": "topup", "user_id": message.from_user.id, "usd": usd, "email": u.get("email")}
-            admin_text = (
-                "🟢 PAYMENT (CRYPTO) — TOPUP\n"
-                f"Time: {now_str()}\n"
-                f"Order: {order_id}\n"
-                f"User: {format_user(message)}\n"
-                f"Email: {u.get('email')}\n"
-                f"Topup: ${usd} | {rub} RUB\n"
-                f"Coin: {u.get('coin')}\n"
-                f"TXID: {text}\n"
-            )
-
-        await bot.send_message(ADMIN_ID, admin_text, reply_markup=kb_admin_decision(order_id))
+        usd = order_amount_usd(u)
+        req = make_order(order_id, message.from_user.id, u, usd, txid=text, coin=u.get("coin"),
+                         address=DEPOSITS.address_for(order_id, u.get("coin")),
+                         amount_coin=u.get("amount_coin") or quote_coin_amount(u.get("coin"), usd))
+        # TXID закрепляется вместе с записью заявки: без заявки он не повиснет "чужим"
+        if dup := await PROOFS.claim(txid_proof(text), req):
+            await reject_duplicate(message, lang, "txid_duplicate", f"TXID {text}", order_id, dup)
+            return
+        admin_text = admin_order_text("admin_crypto", u, order_id, format_user(message), coin=u.get("coin"), txid=text)
+        notify_admin_order(order_id, admin_text)
+        if TXID_VERIFY:
+            VERIFIER.submit(req)
         u["step"] = None
-        save_state()
+        u["order_id"] = None  # заявка уже в STORAGE; следующая оплата получит новый id
+        save_state(message.from_user.id)
 
-        note = AFTER_HOURS_NOTE_RU if lang == "ru" else AFTER_HOURS_NOTE_EN
-        await message.answer(f"✅ Данные получены. Ожидайте подтверждения.\n\n{note}",
-                             reply_markup=kb_main(lang))
+        await message.answer(t("txid_received", lang), reply_markup=kb_main(lang))
         return
 
     if u.get("step") == "wait_txid":
-        await message.answer("Пришлите txid/hash одним сообщением." if lang == "ru" else "Send txid/hash in one message.",
-                             reply_markup=kb_cancel_payment(lang))
+        await message.answer(t("txid_ask", lang), reply_markup=kb_cancel_payment(lang))
         return
 
     # SBP receipt
     if u.get("step") == "wait_sbp_receipt":
         if not ADMIN_ID:
-            await message.answer("❗ Админ не привязан. Админ должен написать /admin." if lang == "ru"
-                                 else "❗ Admin is not set. Admin must send /admin.",
-                                 reply_markup=kb_cancel_payment(lang))
+            await message.answer(t("admin_not_set", lang), reply_markup=kb_cancel_payment(lang))
+            return
+
+        if not (message.photo or message.document):
+            await message.answer(t("receipt_ask", lang), reply_markup=kb_cancel_payment(lang))
             return
 
-        order_id = u.get("order_id") or make_order_id(message.from_user.id)
+        order_id = u.get("order_id") or make_order_id()
         u["order_id"] = order_id
 
-        if u.get("flow") == "sub":
-            months = u["sub_months"]
-            usd = SUB_PRICES[months]["usd"]
-            rub = SUB_PRICES[months]["rub"]
-            PENDING[order_id] = {"kind": "sub", "user_id": message.from_user.id, "months": months}
-            caption = (
-                "🟠 PAYMENT (SBP) — SUBSCRIPTION\n"
-                f"Time: {now_str()}\n"
-                f"Order: {order_id}\n"
-                f"User: {format_user(message)}\n"
-                f"Subscription: {months} months\n"
-                f"Amount: ${usd} | {rub} RUB\n"
-            )
-        else:
-            usd = u["topup_usd"]
-            rub = TOPUP_PRICES[usd]["rub"]
-            PENDING[order_id] = {"kind": "topup", "user_id": message.from_user.id, "usd": usd, "email": u.get("email")}
-            caption = (
-                "🟠 PAYMENT (SBP) — TOPUP\n"
-                f"Time: {now_str()}\n"
-                f"Order: {order_id}\n"
-                f"User: {format_user(message)}\n"
-                f"Email: {u.get('email')}\n"
-                f"Topup: ${usd} | {rub} RUB\n"
-            )
-
-        sent = False
         if message.photo:
-            file_id = message.photo[-1].file_id
-            await bot.send_photo(ADMIN_ID, file_id, caption=caption, reply_markup=kb_admin_decision(order_id))
-            sent = True
-        elif message.document:
-            file_id = message.document.file_id
-            await bot.send_document(ADMIN_ID, file_id, caption=caption, reply_markup=kb_admin_decision(order_id))
-            sent = True
-
-        if sent:
-            u["step"] = None
-            save_state()
-            note = AFTER_HOURS_NOTE_RU if lang == "ru" else AFTER_HOURS_NOTE_EN
-            await message.answer(f"✅ Чек получен. Ожидайте подтверждения.\n\n{note}",
-                                 reply_markup=kb_main(lang))
+            receipt, receipt_type, unique_id = message.photo[-1].file_id, "photo", message.photo[-1].file_unique_id
+        else:
+            receipt, receipt_type, unique_id = message.document.file_id, "document", message.document.file_unique_id
+        req = make_order(order_id, message.from_user.id, u, order_amount_usd(u),
+                         receipt=receipt, receipt_type=receipt_type)
+        if dup := await PROOFS.claim(f"receipt:{unique_id}", req):
+            await reject_duplicate(message, lang, "receipt_duplicate", "чек", order_id, dup)
             return
+        caption = admin_order_text("admin_sbp", u, order_id, format_user(message))
+        notify_admin_order(order_id, caption, **{receipt_type: receipt})
 
-        await message.answer("Пришлите чек как ФОТО или ФАЙЛ (document)." if lang == "ru"
-                             else "Send receipt as PHOTO or FILE (document).",
-                             reply_markup=kb_cancel_payment(lang))
+        u["step"] = None
+        u["order_id"] = None
+        save_state(message.from_user.id)
+        await message.answer(t("receipt_received", lang), reply_markup=kb_main(lang))
         return
 
-    await message.answer(("Откройте меню ниже 👇\n" + WORK_HOURS_TEXT_RU) if lang == "ru"
-                         else ("Open the menu below 👇\n" + WORK_HOURS_TEXT_EN),
-                         reply_markup=kb_main(lang))
+    await message.answer(t("open_menu", lang), reply_markup=kb_main(lang))
+
+# =====================
+# STARTUP / SHUTDOWN
+# =====================
+_BG_TASKS: list[asyncio.Task] = []
+_METRICS_RUNNER: web.AppRunner | None = None
+
+@dp.startup()
+async def on_startup():
+    global _METRICS_RUNNER
+    if METRICS_PORT:
+        _METRICS_RUNNER = await start_metrics_server()
+    await PROOFS.load()
+    _BG_TASKS.append(asyncio.create_task(state_flusher()))
+    if not ORDER_NODE_ID:
+        await db_call(claim_order_node, ORDER_IDS.node)
+        _BG_TASKS.append(asyncio.create_task(order_node_keeper()))
+    if THROTTLE_LAG_MS:
+        _BG_TASKS.append(asyncio.create_task(LOOP_LAG.run()))
+    if ADMIN_DIGEST and is_own_shard(ADMIN_ID):
+        _BG_TASKS.append(asyncio.create_task(admin_digest()))
+    if RATES_SOURCE:
+        _BG_TASKS.append(asyncio.create_task(RATES.run()))
+    if DEPOSITS.enabled:
+        await DEPOSITS.refill()
+        await DEPOSITS.reload()
+        _BG_TASKS.append(asyncio.create_task(DEPOSITS.keeper()))
+    if TXID_VERIFY:
+        _BG_TASKS.append(asyncio.create_task(VERIFIER.run()))
+    if BOT_MODE == "webhook" and SHARD is None:
+        await bot.set_webhook(f"{WEBHOOK_BASE_URL}{WEBHOOK_PATH}", secret_token=WEBHOOK_SECRET or None,
+                              allowed_updates=dp.resolve_used_update_types())
+
+@dp.shutdown()
+async def on_shutdown():
+    if _PROFILE_TASK is not None:
+        _BG_TASKS.append(_PROFILE_TASK)
+    for task in _BG_TASKS:
+        task.cancel()
+    await asyncio.gather(*_BG_TASKS, return_exceptions=True)
+    _BG_TASKS.clear()
+    await OUTBOX.drain()
+    if _METRICS_RUNNER is not None:
+        await _METRICS_RUNNER.cleanup()
+    # гарантированный сброс всего, что не успел записать state_flusher, + чистый снапшот
+    await flush_state(compact=True)
+    if not ORDER_NODE_ID:
+        await db_call(STORAGE.release_order_node, _NODE_OWNER, ORDER_IDS.node)
+    STORAGE.close()
+
+# =====================
+# WEBHOOK
+# =====================
+def build_webhook_app() -> web.Application:
+    # Telegram сразу получает 200, апдейты обрабатываются параллельно в задачах; задачи держим сами,
+    # чтобы на остановке дождаться их до on_shutdown диспетчера
+    feeding: set[asyncio.Task] = set()
+
+    async def feed(raw: dict):
+        result = await dp.feed_raw_update(bot, raw)
+        if isinstance(result, TelegramMethod):
+            await dp.silent_call_request(bot, result)
+
+    async def receive(request: web.Request) -> web.Response:
+        if WEBHOOK_SECRET and request.headers.get("X-Telegram-Bot-Api-Secret-Token") != WEBHOOK_SECRET:
+            return web.Response(status=401)
+        task = asyncio.create_task(feed(await request.json()))
+        feeding.add(task)
+        task.add_done_callback(feeding.discard)
+        return web.Response()
+
+    async def drain_updates(_app: web.Application):
+        await asyncio.gather(*feeding, return_exceptions=True)
+
+    async def on_cleanup(_app: web.Application):
+        await bot.session.close()
+
+    app = web.Application()
+    app.router.add_post(WEBHOOK_PATH, receive)
+    app.on_shutdown.append(drain_updates)
+    setup_application(app, dp, bot=bot)
+    app.on_cleanup.append(on_cleanup)
+    return app
+
+# =====================
+# SHARDED MODE (WORKERS > 0)
+# =====================
+# Ingress-процесс ничего не разбирает: сырые апдейты (dict из JSON) раскладываются по очередям
+# воркеров по from_user.id, пачкой на воркер. Все апдейты юзера попадают в один воркер, поэтому
+# его сессия, лок и ведро чата живут в одном процессе, а порядок сохраняется как в polling.
+# Воркеры — обычный dp.feed_raw_update поверх общего SQLite; глобальный лимит исходящих
+# и ведро чата админа — SharedTokenBucket. Воркеры запускаются через spawn: у каждого своё
+# соединение с базой и свой event loop.
+_MP = multiprocessing.get_context("spawn")
+SHARD: tuple[int, int] | None = None  # (номер воркера, всего) — только в процессе-воркере
+
+def update_user_id(raw: dict) -> int | None:
+    for key, event in raw.items():
+        if key != "update_id" and isinstance(event, dict):
+            user = event.get("from") or event.get("user")
+            return user.get("id") if user else None
+    return None
+
+def shard_of(uid: int | None, shards: int) -> int:
+    return uid % shards if uid else 0
+
+def is_own_shard(uid: int | None) -> bool:
+    return SHARD is None or shard_of(uid, SHARD[1]) == SHARD[0]
+
+def run_worker(index: int, shards: int, node: int | None, inbox, ready, global_bucket: SharedTokenBucket,
+               admin_bucket: SharedTokenBucket):
+    # Ctrl+C / SIGTERM получает ingress и останавливает воркеров через очередь — иначе они
+    # умерли бы посреди апдейтов, не сбросив state
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    asyncio.run(worker_main(index, shards, node, inbox, ready, global_bucket, admin_bucket))
+
+async def worker_main(index: int, shards: int, node: int | None, inbox, ready, global_bucket: SharedTokenBucket,
+                      admin_bucket: SharedTokenBucket):
+    global SHARD, METRICS_PORT
+    SHARD = (index, shards)
+    if node is not None:
+        ORDER_IDS.node = node  # ORDER_NODE_ID задан: воркеры берут следующие за ним; иначе свой узел уже в аренде
+    OUTBOX.share(global_bucket, {ADMIN_ID: admin_bucket})
+    if METRICS_PORT:
+        METRICS_PORT += 1 + index  # ingress ничего не считает, у воркеров — свои порты подряд
+    await dp.emit_startup(bot=bot)
+    ready.set()
+
+    loop = asyncio.get_running_loop()
+    slots = asyncio.Semaphore(UPDATE_CONCURRENCY)
+    tasks: set[asyncio.Task] = set()
+
+    async def feed(raw: dict):
+        try:
+            await dp.feed_raw_update(bot, raw)
+        except Exception as e:
+            print(f"⚠️ worker {index}: update {raw.get('update_id')} failed: {e!r}")
+        finally:
+            slots.release()
+
+    # очередь блокирующая — ждём пачку в потоке; None от ingress — сигнал остановки
+    while (batch := await loop.run_in_executor(None, _next_batch, inbox)) is not None:
+        for raw in batch:
+            await slots.acquire()
+            task = asyncio.create_task(feed(raw))
+            tasks.add(task)
+            task.add_done_callback(tasks.discard)
+    await asyncio.gather(*tasks, return_exceptions=True)
+    await dp.emit_shutdown(bot=bot)
+    await bot.session.close()
+
+def _next_batch(inbox) -> list[dict] | None:
+    while True:
+        try:
+            return inbox.get(timeout=1)
+        except queue.Empty:
+            if not multiprocessing.parent_process().is_alive():
+                return None  # ingress убит без остановки — дорабатываем и выходим
+
+class Ingress:
+    def __init__(self, workers: int = WORKERS):
+        self.queues = [_MP.Queue() for _ in range(workers)]
+        self.ready = [_MP.Event() for _ in range(workers)]
+        self.global_bucket = SharedTokenBucket(OUTBOX_GLOBAL_RATE, OUTBOX_GLOBAL_BURST, _MP)
+        self.admin_bucket = SharedTokenBucket(OUTBOX_CHAT_RATE, OUTBOX_CHAT_BURST, _MP)
+        self.procs: list = []
+        self.dispatched = [0] * workers
+
+    def start(self, timeout: float = 60):
+        shards = len(self.queues)
+        for i, (inbox, ready) in enumerate(zip(self.queues, self.ready)):
+            node = (ORDER_IDS.node + 1 + i) % 1024 if ORDER_NODE_ID else None
+            proc = _MP.Process(target=run_worker, name=f"bot-worker-{i}",
+                               args=(i, shards, node, inbox, ready, self.global_bucket, self.admin_bucket))
+            proc.start()
+            self.procs.append(proc)
+        for i, ready in enumerate(self.ready):
+            if not ready.wait(timeout):
+                raise RuntimeError(f"worker {i} did not start in {timeout}s")
+
+    def dispatch(self, updates: list[dict]):
+        batches: list[list[dict]] = [[] for _ in self.queues]
+        for raw in updates:
+            batches[shard_of(update_user_id(raw), len(batches))].append(raw)
+        for i, batch in enumerate(batches):
+            if batch:
+                if not self.procs[i].is_alive():
+                    # очередь мёртвого воркера никто не разберёт — пусть перезапустят весь сервис
+                    raise RuntimeError(f"worker {i} exited with code {self.procs[i].exitcode}")
+                self.queues[i].put(batch)
+                self.dispatched[i] += len(batch)
+
+    def stop(self, timeout: float | None = None):
+        # воркеры дорабатывают свои очереди, сбрасывают state и выходят
+        for inbox in self.queues:
+            inbox.put(None)
+        for proc in self.procs:
+            proc.join(timeout)
+
+async def poll_into(ingress: Ingress):
+    """getUpdates без разбора в Update: ingress только раскладывает сырые апдейты по воркерам.
+    Отмена безопасна: offset сдвигается только после раздачи, неподтверждённое Telegram пришлёт снова."""
+    await bot.delete_webhook()
+    url = bot.session.api.api_url(token=bot.token, method="getUpdates")
+    params: dict[str, Any] = {"timeout": 25, "allowed_updates": json.dumps(dp.resolve_used_update_types())}
+    backoff = 1.0
+    async with ClientSession(timeout=ClientTimeout(total=40)) as http:
+        while True:
+            try:
+                async with http.post(url, data=params) as resp:
+                    body = await resp.json()
+                if not body.get("ok"):
+                    raise RuntimeError(body.get("description"))
+            except Exception as e:
+                print(f"⚠️ getUpdates failed: {e!r}, retry in {backoff:.0f}s")
+                await asyncio.sleep(backoff)
+                backoff = min(backoff * 2, 30)
+                continue
+            backoff = 1.0
+            if body["result"]:
+                params["offset"] = body["result"][-1]["update_id"] + 1
+                ingress.dispatch(body["result"])
+
+def build_ingress_webhook_app(ingress: Ingress) -> web.Application:
+    async def receive(request: web.Request) -> web.Response:
+        if WEBHOOK_SECRET and request.headers.get("X-Telegram-Bot-Api-Secret-Token") != WEBHOOK_SECRET:
+            return web.Response(status=401)
+        ingress.dispatch([await request.json()])
+        return web.Response()
+
+    async def on_startup(_app: web.Application):
+        await asyncio.to_thread(ingress.start)
+        await bot.set_webhook(f"{WEBHOOK_BASE_URL}{WEBHOOK_PATH}", secret_token=WEBHOOK_SECRET or None,
+                              allowed_updates=dp.resolve_used_update_types())
+
+    async def on_cleanup(_app: web.Application):
+        await asyncio.to_thread(ingress.stop)
+        await bot.session.close()
+
+    app = web.Application()
+    app.router.add_post(WEBHOOK_PATH, receive)
+    app.on_startup.append(on_startup)
+    app.on_cleanup.append(on_cleanup)
+    return app
+
+async def main_sharded():
+    print(f"✅ Bot started: polling ingress + {WORKERS} workers")
+    ingress = Ingress()
+    stop = asyncio.Event()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        asyncio.get_running_loop().add_signal_handler(sig, stop.set)
+    await asyncio.to_thread(ingress.start)
+    poller = asyncio.create_task(poll_into(ingress))
+    stopping = asyncio.create_task(stop.wait())
+    try:
+        await asyncio.wait([poller, stopping], return_when=asyncio.FIRST_COMPLETED)
+        if poller.done():
+            poller.result()  # poll_into сам не завершается — только с ошибкой (например, умер воркер)
+    finally:
+        poller.cancel()
+        stopping.cancel()
+        await asyncio.to_thread(ingress.stop)
+        await bot.session.close()
 
 async def main():
     print("✅ Bot started. Waiting for messages...")
-    await dp.start_polling(bot)
+    # если раньше работали через webhook — снимаем его, иначе getUpdates вернёт конфликт
+    await bot.delete_webhook()
+    await dp.start_polling(bot, tasks_concurrency_limit=UPDATE_CONCURRENCY)
 
 if __name__ == "__main__":
-    asyncio.run(main())
+    if WORKERS and BOT_MODE == "webhook":
+        print(f"✅ Bot started in webhook mode on {WEB_HOST}:{WEB_PORT}{WEBHOOK_PATH}, {WORKERS} workers")
+        web.run_app(build_ingress_webhook_app(Ingress()), host=WEB_HOST, port=WEB_PORT, print=None)
+    elif WORKERS:
+        asyncio.run(main_sharded())
+    elif BOT_MODE == "webhook":
+        print(f"✅ Bot started in webhook mode on {WEB_HOST}:{WEB_PORT}{WEBHOOK_PATH}")
+        web.run_app(build_webhook_app(), host=WEB_HOST, port=WEB_PORT, print=None)
+    else:
+        asyncio.run(main())